@@ -0,0 +1,62 @@
+"""
+Validazione delle pipeline di aggregazione inoltrate al gateway.
+
+Sono ammessi solo gli stadi che lavorano sulla collezione indicata e riducono o trasformano i suoi
+documenti: gli stadi che leggono o scrivono altre collezioni (`$lookup`, `$out`, `$merge`, ...)
+aggirerebbero il controllo dei permessi sul database, e gli operatori che eseguono JavaScript non
+hanno limiti di costo prevedibili. Alla pipeline viene sempre aggiunto un `$limit` finale, e il gateway
+riceve `maxTimeMS` e `allowDiskUse: false`, così che ogni stadio resti entro il limite di memoria di MongoDB.
+"""
+from typing import Any, Dict, List
+
+from app.settings import AggregationSettings
+
+# Stadi ammessi nelle pipeline dei client
+ALLOWED_STAGES = frozenset({
+    "$match", "$group", "$count", "$sort", "$limit", "$skip", "$project", "$unwind",
+    "$addFields", "$set", "$unset", "$sortByCount", "$bucket", "$bucketAuto", "$replaceRoot",
+})
+
+# Operatori vietati a qualsiasi profondità (esecuzione di JavaScript)
+FORBIDDEN_OPERATORS = frozenset({"$where", "$function", "$accumulator"})
+
+
+class PipelineError(ValueError):
+    """
+    La pipeline non rispetta le restrizioni; il messaggio è destinato al client.
+    """
+
+
+def _check_operators(value: Any, path: str):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in FORBIDDEN_OPERATORS:
+                raise PipelineError(f"Operatore non ammesso in {path}: {key}")
+            _check_operators(item, path)
+    elif isinstance(value, list):
+        for item in value:
+            _check_operators(item, path)
+
+
+def validate_pipeline(pipeline: List[Dict[str, Any]], limits: AggregationSettings) -> List[Dict[str, Any]]:
+    """
+    Verifica la pipeline e restituisce quella da inoltrare, con il `$limit` finale.
+    """
+    if not isinstance(pipeline, list) or not pipeline:
+        raise PipelineError("La pipeline deve essere una lista non vuota di stadi")
+    if len(pipeline) > limits.max_stages:
+        raise PipelineError(f"La pipeline può contenere al massimo {limits.max_stages} stadi")
+    for index, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise PipelineError(f"Lo stadio {index} deve essere un oggetto con un solo operatore")
+        (name, spec), = stage.items()
+        if name not in ALLOWED_STAGES:
+            raise PipelineError(f"Stadio non ammesso: {name}")
+        if name in ("$limit", "$skip") and (not isinstance(spec, int) or isinstance(spec, bool) or spec < 0):
+            raise PipelineError(f"{name} deve essere un intero non negativo")
+        _check_operators(spec, f"stadio {index} ({name})")
+    return pipeline + [{"$limit": limits.max_results}]
+
+
+def aggregate_options(limits: AggregationSettings) -> Dict[str, Any]:
+    return {"maxTimeMS": limits.max_time_ms, "allowDiskUse": False}
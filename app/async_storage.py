@@ -0,0 +1,259 @@
+"""
+Accesso asincrono ai documenti dei database degli utenti, usato dalle rotte `async def` di
+`app.mongodb_route` senza occupare un thread per tutta la richiesta.
+
+Due implementazioni dell'interfaccia `AsyncStorage`, scelte con `storage_backend`:
+- `AsyncMongoStorage`: MongoDB con il driver asincrono di `pymongo` (`AsyncMongoClient`) e il suo pool
+  di connessioni, nel loop degli eventi del worker;
+- `ThreadedStorage`: l'archivio sincrono (`app.storage`) del gateway o della memoria, le cui chiamate
+  bloccanti vengono eseguite in thread, al più `storage_threads` alla volta per worker.
+
+Gli id e i documenti restituiti sono quelli dell'archivio sincrono: stringhe e soli tipi JSON.
+"""
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence
+
+import anyio.to_thread
+from anyio import CapacityLimiter
+
+from app.settings import Settings
+from app.storage import (ResultBuffer, Storage, StorageError, id_condition, id_filter, mongo_error, plain,
+                         pymongo)
+
+if pymongo is not None:
+    from pymongo.errors import CollectionInvalid, PyMongoError
+
+
+class AsyncStorage(ABC):
+    """
+    Le operazioni di `Storage` usate dalle rotte sui documenti, con la stessa semantica.
+    """
+
+    @abstractmethod
+    async def create_collection(self, db_name: str, collection_name: str):
+        """Crea la collezione (nessun errore se esiste già)."""
+
+    @abstractmethod
+    async def list_collections(self, db_name: str) -> List[str]:
+        """Nomi delle collezioni del database."""
+
+    @abstractmethod
+    async def delete_collection(self, db_name: str, collection_name: str):
+        """Elimina la collezione."""
+
+    @abstractmethod
+    async def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        """Associa alla collezione gli schemi YAML (`filename`, `content`)."""
+
+    @abstractmethod
+    async def add_item(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+        """Inserisce il documento e restituisce la risposta della rotta `add_item`, con l'id in `id`."""
+
+    @abstractmethod
+    async def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+                   fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        """Documenti che corrispondono al filtro, limitati ai campi `fields` se indicati."""
+
+    @abstractmethod
+    async def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        """Il documento con id `item_id`, o None."""
+
+    @abstractmethod
+    async def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        """Sovrascrive i campi indicati del documento; False se non esiste."""
+
+    @abstractmethod
+    async def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        """Elimina il documento; False se non esiste."""
+
+    @abstractmethod
+    async def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        """Documenti di tutte le collezioni del database che corrispondono al filtro, paginati."""
+
+    @abstractmethod
+    async def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                        options: Dict[str, Any], max_bytes: int) -> bytes:
+        """Esegue la pipeline e restituisce il risultato come lista JSON; `ResultTooLarge` oltre `max_bytes`."""
+
+    async def close(self):
+        """Rilascia le connessioni dell'archivio."""
+
+
+# ----------------------------------------------------------------------------------
+# Archivio sincrono in thread
+# ----------------------------------------------------------------------------------
+class ThreadedStorage(AsyncStorage):
+    """
+    Un `Storage` sincrono eseguito in thread. Le chiamate hanno un limite proprio di `threads`
+    thread concorrenti, separato da quello di AnyIO per le rotte e le dipendenze sincrone: una
+    raffica di richieste sui documenti non esaurisce i thread dell'autenticazione, e viceversa.
+    """
+
+    def __init__(self, storage: Storage, threads: int):
+        self.storage = storage
+        self.limiter = CapacityLimiter(threads)
+
+    async def _call(self, call, *args):
+        return await anyio.to_thread.run_sync(partial(call, *args), limiter=self.limiter)
+
+    async def create_collection(self, db_name: str, collection_name: str):
+        await self._call(self.storage.create_collection, db_name, collection_name)
+
+    async def list_collections(self, db_name: str) -> List[str]:
+        return await self._call(self.storage.list_collections, db_name)
+
+    async def delete_collection(self, db_name: str, collection_name: str):
+        await self._call(self.storage.delete_collection, db_name, collection_name)
+
+    async def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        await self._call(self.storage.upload_schema, db_name, collection_name, files)
+
+    async def add_item(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._call(self.storage.add_item, db_name, collection_name, document)
+
+    async def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+                   fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        return await self._call(self.storage.find, db_name, collection_name, filter_data, fields)
+
+    async def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        return await self._call(self.storage.get, db_name, collection_name, item_id)
+
+    async def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        return await self._call(self.storage.update, db_name, collection_name, item_id, fields)
+
+    async def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        return await self._call(self.storage.delete, db_name, collection_name, item_id)
+
+    async def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        return await self._call(self.storage.search, db_name, filter_data, skip, size)
+
+    async def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                        options: Dict[str, Any], max_bytes: int) -> bytes:
+        return await self._call(self.storage.aggregate, db_name, collection_name, pipeline, options, max_bytes)
+
+    # L'archivio sincrono è condiviso con il resto del worker e viene chiuso con le altre risorse
+
+
+# ----------------------------------------------------------------------------------
+# MongoDB con il driver asincrono
+# ----------------------------------------------------------------------------------
+class AsyncMongoStorage(AsyncStorage):
+    """
+    MongoDB tramite `pymongo.AsyncMongoClient`, con un pool di `pool_size` connessioni per processo,
+    separato da quello del client sincrono usato da utenti, token e job. Il client si collega al
+    primo utilizzo, nel loop degli eventi del worker.
+
+    Id e filtri seguono `MongoStorage`: un id ricevuto come stringa corrisponde sia all'`ObjectId`
+    equivalente sia alla stringa stessa.
+    """
+
+    def __init__(self, uri: str, pool_size: int, timeout_seconds: float):
+        if pymongo is None:
+            raise RuntimeError("Il backend 'mongodb' richiede il pacchetto pymongo")
+        timeout_ms = int(timeout_seconds * 1000)
+        self.client = pymongo.AsyncMongoClient(uri, maxPoolSize=pool_size, connect=False,
+                                               serverSelectionTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms,
+                                               connectTimeoutMS=timeout_ms)
+
+    def _collection(self, db_name: str, collection_name: str):
+        return self.client[db_name][collection_name]
+
+    @staticmethod
+    async def _run(operation: str, awaitable):
+        try:
+            return await awaitable
+        except PyMongoError as error:
+            raise mongo_error(operation, error) from error
+
+    async def create_collection(self, db_name: str, collection_name: str):
+        try:
+            await self._run("create_collection", self.client[db_name].create_collection(collection_name))
+        except CollectionInvalid:
+            pass
+
+    async def list_collections(self, db_name: str) -> List[str]:
+        return await self._run("list_collections", self.client[db_name].list_collection_names())
+
+    async def delete_collection(self, db_name: str, collection_name: str):
+        await self._run("delete_collection", self.client[db_name].drop_collection(collection_name))
+
+    async def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        raise StorageError("Gli schemi YAML sono gestiti dal gateway: non disponibili con il backend mongodb")
+
+    async def add_item(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+        result = await self._run("add_item", self._collection(db_name, collection_name).insert_one(dict(document)))
+        return {"message": "Item added successfully.", "id": str(result.inserted_id)}
+
+    async def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+                   fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        projection = None
+        if fields is not None:
+            projection = {field: 1 for field in fields}
+            if "_id" not in projection:
+                projection["_id"] = 0
+        cursor = self._collection(db_name, collection_name).find(id_filter(filter_data), projection)
+        return [plain(document) for document in await self._run("get_items", cursor.to_list())]
+
+    async def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        document = await self._run("get_item", self._collection(db_name, collection_name).find_one(
+            {"_id": id_condition(item_id)}))
+        return plain(document) if document is not None else None
+
+    async def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        fields = {field: value for field, value in fields.items() if field != "_id"}
+        if not fields:
+            return await self.get(db_name, collection_name, item_id) is not None
+        result = await self._run("update_item", self._collection(db_name, collection_name).update_one(
+            {"_id": id_condition(item_id)}, {"$set": fields}))
+        return result.matched_count > 0
+
+    async def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        result = await self._run("delete_item", self._collection(db_name, collection_name).delete_one(
+            {"_id": id_condition(item_id)}))
+        return result.deleted_count > 0
+
+    async def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        # Stesso ordine del gateway: le collezioni una dopo l'altra, con la paginazione sull'insieme
+        filter_data = id_filter(filter_data)
+        results: List[Dict[str, Any]] = []
+        for collection_name in await self.list_collections(db_name):
+            if len(results) >= size:
+                break
+            collection = self._collection(db_name, collection_name)
+            if skip:
+                matched = await self._run("search", collection.count_documents(filter_data))
+                if matched <= skip:
+                    skip -= matched
+                    continue
+            cursor = collection.find(filter_data).skip(skip).limit(size - len(results))
+            results.extend(plain(document) for document in await self._run("search", cursor.to_list()))
+            skip = 0
+        return results
+
+    async def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                        options: Dict[str, Any], max_bytes: int) -> bytes:
+        collection = self._collection(db_name, collection_name)
+        pipeline = [{"$match": id_filter(stage["$match"])} if "$match" in stage else stage for stage in pipeline]
+        cursor = await self._run("aggregate", collection.aggregate(pipeline, **options))
+        buffer = ResultBuffer(max_bytes)
+        try:
+            async for document in cursor:
+                buffer.add(plain(document))
+        except PyMongoError as error:
+            raise mongo_error("aggregate", error) from error
+        finally:
+            await cursor.close()
+        return buffer.result()
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_async_storage(settings: Settings, storage: Storage) -> AsyncStorage:
+    """
+    Archivio asincrono per `storage_backend`; `storage` è l'archivio sincrono dello stesso backend.
+    """
+    if settings.storage_backend == "mongodb":
+        return AsyncMongoStorage(settings.mongodb_uri, settings.mongodb_pool_size, settings.mongodb_timeout_seconds)
+    return ThreadedStorage(storage, settings.storage_threads)
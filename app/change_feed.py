@@ -0,0 +1,196 @@
+"""
+Change feed per collezione, consegnato ai client con Server-Sent Events.
+
+Le rotte di scrittura pubblicano un evento (`insert`, `update`, `delete`) sul canale tra i worker,
+per cui ogni worker riceve anche le modifiche eseguite dagli altri e le inoltra ai propri iscritti.
+Ogni worker annuncia agli altri le collezioni seguite dai propri iscritti (`SUBSCRIPTION_TOPIC`):
+l'evento viene costruito e inviato solo se la collezione ha iscritti, e solo ai worker che li hanno.
+Un iscritto riceve le modifiche eseguite negli altri worker dopo che il suo annuncio li ha raggiunti.
+L'evento viene serializzato una volta sola e lo stesso frame SSE viene accodato a tutti gli iscritti
+della collezione. La coda di ogni client è limitata: se il client non la svuota abbastanza in fretta
+gli eventi in attesa vengono scartati e sostituiti da un evento `reset`, dopo il quale il client
+deve rileggere la collezione.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.invalidation import CHANGE_TOPIC, RESYNC_TOPIC, SUBSCRIPTION_TOPIC, InvalidationBus
+
+logger = logging.getLogger(__name__)
+
+# Dimensione massima di un documento incluso nell'evento; oltre, l'evento riporta solo l'id
+MAX_EVENT_DOCUMENT_BYTES = 16 * 1024
+
+# Frame inviato al posto degli eventi scartati per una coda piena
+RESET_FRAME = b'event: reset\ndata: {"type": "reset"}\n\n'
+
+# Collezioni annunciate singolarmente agli altri worker; oltre, il worker le riceve tutte
+MAX_ANNOUNCED_KEYS = 500
+
+CollectionKey = Tuple[str, str]
+
+
+class Subscription:
+    def __init__(self, key: CollectionKey, loop: asyncio.AbstractEventLoop, buffer_size: int):
+        self.key = key
+        self.loop = loop
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def deliver(self, frame: bytes):
+        # Eseguito nel loop dell'iscritto
+        if self.queue.full():
+            self.deliver_reset()
+            return
+        self.queue.put_nowait(frame)
+
+    def deliver_reset(self):
+        # Gli eventi in coda sono superati dal `reset`
+        self.dropped += self.queue.qsize()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(RESET_FRAME)
+
+
+class ChangeFeed:
+    """
+    Iscrizioni ai cambiamenti delle collezioni nel worker corrente.
+    """
+
+    def __init__(self, bus: InvalidationBus, buffer_size: int, max_subscribers: int):
+        self.bus = bus
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._subscriptions: Dict[CollectionKey, Set[Subscription]] = {}
+        # Collezioni seguite dagli altri worker; None se il worker le segue tutte
+        self._remote: Dict[str, Optional[Set[CollectionKey]]] = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        bus.subscribe(CHANGE_TOPIC, self._dispatch)
+        bus.subscribe(SUBSCRIPTION_TOPIC, self._on_announcement)
+        bus.subscribe(RESYNC_TOPIC, self._on_resync)
+
+    def start(self):
+        """
+        Chiede agli altri worker le collezioni che seguono (dopo l'avvio del canale).
+        """
+        self._announce(sync=True)
+
+    def stop(self):
+        """
+        Comunica agli altri worker che il worker corrente non riceve più eventi (prima dell'arresto del canale).
+        """
+        self.bus.publish(SUBSCRIPTION_TOPIC, {"worker": self.bus.worker_id, "keys": [], "sync": False})
+
+    def subscribe(self, db_name: str, collection_name: str) -> Optional[Subscription]:
+        """
+        Registra un iscritto nel loop corrente; None se il worker ha raggiunto `max_subscribers`.
+        """
+        subscription = Subscription((db_name, collection_name), asyncio.get_running_loop(), self.buffer_size)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            new_key = subscription.key not in self._subscriptions
+            self._subscriptions.setdefault(subscription.key, set()).add(subscription)
+            self._count += 1
+        if new_key:
+            self._announce()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.key)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscriptions[subscription.key]
+            self._count -= 1
+            removed_key = not subscribers
+        if removed_key:
+            self._announce()
+
+    def publish(self, change_type: str, db_name: str, collection_name: str, item_id: Optional[str],
+                document: Optional[Dict[str, Any]] = None):
+        """
+        Notifica una modifica ai worker con iscritti alla collezione, compreso quello corrente.
+        """
+        key = (db_name, collection_name)
+        with self._lock:
+            local = key in self._subscriptions
+            workers = [worker for worker, keys in self._remote.items() if keys is None or key in keys]
+        if not local and not workers:
+            return
+        event: Dict[str, Any] = {"type": change_type, "db": db_name, "collection": collection_name, "id": item_id}
+        if document is not None:
+            if len(json.dumps(document, default=str)) <= MAX_EVENT_DOCUMENT_BYTES:
+                event["document"] = document
+            else:
+                event["truncated"] = True
+        if not workers:
+            self._dispatch(event)
+            return
+        gone = self.bus.publish(CHANGE_TOPIC, event, workers)
+        if gone:
+            with self._lock:
+                for worker in gone:
+                    self._remote.pop(worker, None)
+
+    def _announce(self, sync: bool = False):
+        # Stato completo, non variazioni: un annuncio perso o fuori ordine viene corretto dal successivo
+        with self._lock:
+            keys: Optional[List[CollectionKey]] = sorted(self._subscriptions)
+        if len(keys) > MAX_ANNOUNCED_KEYS:
+            keys = None
+        self.bus.publish(SUBSCRIPTION_TOPIC, {"worker": self.bus.worker_id, "keys": keys, "sync": sync})
+
+    def _on_announcement(self, payload: Dict[str, Any]):
+        worker = payload["worker"]
+        if worker == self.bus.worker_id:
+            return
+        keys = payload["keys"]
+        with self._lock:
+            if keys is None:
+                self._remote[worker] = None
+            elif keys:
+                self._remote[worker] = {tuple(key) for key in keys}
+            else:
+                self._remote.pop(worker, None)
+        if payload.get("sync"):
+            # Un worker appena avviato chiede le collezioni seguite dagli altri
+            self._announce()
+
+    def _on_resync(self, payload: Dict[str, Any]):
+        # Eventi e annunci persi: gli iscritti rileggono le collezioni e i worker si riannunciano
+        with self._lock:
+            subscribers = [subscription for subscribers in self._subscriptions.values() for subscription in subscribers]
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver_reset)
+            except RuntimeError:
+                self.unsubscribe(subscription)
+        self._announce(sync=True)
+
+    def _dispatch(self, event: Dict[str, Any]):
+        # Chiamato nel thread che pubblica o in quello del canale tra i worker
+        key = (event["db"], event["collection"])
+        with self._lock:
+            subscribers = list(self._subscriptions.get(key, ()))
+        if not subscribers:
+            return
+        data = json.dumps(event, default=str)
+        frame = f"id: {next(self._sequence)}\nevent: {event['type']}\ndata: {data}\n\n".encode()
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, frame)
+            except RuntimeError:
+                # Loop già chiuso (worker in arresto)
+                self.unsubscribe(subscription)
+
+    def __len__(self) -> int:
+        return self._count
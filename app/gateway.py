@@ -0,0 +1,20 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class GatewaySession(requests.Session):
+    """
+    Sessione HTTP condivisa verso il gateway MongoDB: riusa le connessioni keep-alive
+    (pool di `pool_size` connessioni) e applica un timeout predefinito a ogni chiamata.
+    """
+
+    def __init__(self, pool_size: int, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
@@ -0,0 +1,59 @@
+"""
+Configurazione di Gunicorn per l'esecuzione in produzione con più processi worker.
+
+    gunicorn -c app/gunicorn_conf.py app.main:app
+
+Variabili d'ambiente:
+- BIND: indirizzo di ascolto (default 0.0.0.0:8095)
+- WEB_CONCURRENCY: numero di worker (default: CPU disponibili per il container)
+- GRACEFUL_TIMEOUT: secondi concessi ai worker per completare le richieste in corso
+- MAX_REQUESTS: richieste dopo le quali un worker viene riavviato (0 = mai)
+
+`kill -HUP <pid master>` riavvia i worker in modo graduale: i nuovi worker partono prima
+che i vecchi vengano fermati, e ogni worker termina le richieste in corso.
+"""
+import math
+import multiprocessing
+import os
+
+from app.invalidation import clear_sockets
+from app.settings import get_settings
+
+
+def available_cpus() -> int:
+    """
+    CPU effettivamente utilizzabili: affinità del processo e quota cgroup v2 del container.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+bind = os.environ.get("BIND", "0.0.0.0:8095")
+workers = int(os.environ.get("WEB_CONCURRENCY", available_cpus()))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# L'applicazione viene importata una sola volta nel master e condivisa con i worker tramite fork
+preload_app = True
+
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = 60
+keepalive = 5
+
+# Riavvio periodico dei worker, sfalsato per non riavviarli tutti insieme
+max_requests = int(os.environ.get("MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    # Rimuove i socket di invalidazione rimasti da un'esecuzione precedente
+    clear_sockets(get_settings().invalidation_socket_dir)
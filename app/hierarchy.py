@@ -0,0 +1,284 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from app.permissions import permission_registry
+from app.storage import USERS_COLLECTION, USERS_DATABASE, Storage
+
+logger = logging.getLogger(__name__)
+
+# Campi del documento utente necessari per l'indice
+HIERARCHY_FIELDS = ("username", "email", "full_name", "managed_users", "manager_users", "databases")
+
+Edge = Tuple[str, str]  # (manager, gestito)
+
+# Strutture dell'indice sostituite in blocco al termine di una ricostruzione
+SNAPSHOT_ATTRIBUTES = ("_nodes", "_declared", "_declared_by", "_managed", "_managers", "_grants",
+                       "_database_owners", "_databases_by_user")
+
+
+class HierarchyIndex:
+    """
+    Indice in memoria delle relazioni manager -> utenti gestiti.
+
+    L'arco (A, B) esiste se B compare in `A.managed_users` oppure A compare in `B.manager_users`;
+    i suoi permessi sono l'unione di quelli dichiarati nei due documenti. L'indice viene costruito
+    con una sola lettura di tutti gli utenti e poi aggiornato per singolo utente: le notifiche di
+    invalidazione segnano l'utente come da rileggere e la rilettura avviene alla query successiva.
+    Chi scrive relazioni, permessi concessi o profili pubblica `RELATIONS_TOPIC` con gli utenti
+    modificati (o senza, per modifiche in blocco: l'indice viene scartato). Ogni `ttl` secondi
+    l'indice viene comunque ricostruito da zero in un thread in background, per le scritture fatte
+    senza notifica: fino al termine della ricostruzione le query usano l'indice precedente. Solo la
+    prima costruzione avviene nella query che la richiede.
+
+    L'indice tiene anche la corrispondenza tra nome del database e proprietario e i permessi che ogni
+    utente concede ai propri manager, usati per l'accesso delegato ai database degli utenti gestiti.
+    I permessi delegati sono solo quelli dichiarati dal proprietario nei suoi `manager_users`: una
+    relazione dichiarata dal solo manager compare nella gerarchia ma non concede accesso.
+    """
+
+    def __init__(self, fetch_users: Callable[[Optional[List[str]]], List[Dict[str, Any]]], ttl: float):
+        self._fetch_users = fetch_users
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._loaded_at: Optional[float] = None
+        # Incrementato da `invalidate`: una ricostruzione iniziata prima non rende l'indice valido
+        self._generation = 0
+        self._dirty: Set[str] = set()
+        self._rebuilding = False
+        self._nodes: Dict[str, Dict[str, Any]] = {}
+        # Permessi dichiarati per ogni arco, per documento di origine
+        self._declared: Dict[Edge, Dict[str, FrozenSet[str]]] = {}
+        self._declared_by: Dict[str, Set[Edge]] = {}
+        # Liste di adiacenza con i permessi effettivi dell'arco
+        self._managed: Dict[str, Dict[str, FrozenSet[str]]] = {}
+        self._managers: Dict[str, Dict[str, FrozenSet[str]]] = {}
+        # Maschera dei permessi concessi da ogni utente ai manager dei suoi `manager_users`
+        self._grants: Dict[str, Dict[str, int]] = {}
+        # Proprietario di ogni database
+        self._database_owners: Dict[str, str] = {}
+        self._databases_by_user: Dict[str, Set[str]] = {}
+
+    # ----------------------------------------------------------------------------------
+    # Aggiornamento
+    # ----------------------------------------------------------------------------------
+    def mark_dirty(self, username: str):
+        with self._lock:
+            self._dirty.add(username)
+
+    def invalidate(self):
+        """
+        Scarta l'indice: la query successiva lo ricostruisce prima di rispondere.
+        """
+        with self._lock:
+            self._loaded_at = None
+            self._generation += 1
+
+    def relations_changed(self, payload: Dict[str, Any]):
+        """
+        Gestore di `RELATIONS_TOPIC`: gli utenti indicati vengono riletti alla query successiva;
+        senza `usernames` (modifiche in blocco) l'indice viene ricostruito.
+        """
+        usernames = payload.get("usernames")
+        if usernames is None:
+            self.invalidate()
+            return
+        with self._lock:
+            self._dirty.update(usernames)
+
+    def refresh(self):
+        """
+        Rilegge gli utenti modificati e, se l'indice è scaduto, ne avvia la ricostruzione in background.
+        """
+        with self._lock:
+            loaded = self._loaded_at is not None
+            expired = not loaded or time.monotonic() - self._loaded_at > self.ttl
+            dirty = list(self._dirty)
+        if not loaded:
+            # Nessun indice da usare nel frattempo: la prima costruzione avviene qui
+            self.rebuild()
+            return
+        if expired:
+            self._start_rebuild()
+        if dirty:
+            documents = self._fetch_users(dirty)
+            with self._lock:
+                found = set()
+                for document in documents:
+                    self._upsert(document)
+                    found.add(document["username"])
+                for username in set(dirty) - found:
+                    self._remove(username)
+                self._dirty.difference_update(dirty)
+
+    def rebuild(self):
+        """
+        Costruisce un nuovo indice con una lettura di tutti gli utenti e lo sostituisce a quello corrente.
+        """
+        with self._lock:
+            dirty = set(self._dirty)
+            generation = self._generation
+        documents = self._fetch_users(None)
+        snapshot = HierarchyIndex(self._fetch_users, self.ttl)
+        for document in documents:
+            snapshot._upsert(document)
+        with self._lock:
+            for name in SNAPSHOT_ATTRIBUTES:
+                setattr(self, name, getattr(snapshot, name))
+            # Gli utenti segnati durante la lettura restano da rileggere
+            self._dirty.difference_update(dirty)
+            if self._generation == generation:
+                self._loaded_at = time.monotonic()
+
+    def _start_rebuild(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild_in_background, name="hierarchy-rebuild", daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.rebuild()
+        except Exception as e:
+            # L'indice precedente resta in uso; la ricostruzione viene ritentata alla query successiva
+            logger.warning("Ricostruzione dell'indice delle relazioni fallita: %s", e)
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _upsert(self, document: Dict[str, Any]):
+        username = document["username"]
+        self._nodes[username] = {
+            "username": username,
+            "email": document.get("email"),
+            "full_name": document.get("full_name") or "",
+        }
+        declared: Dict[Edge, FrozenSet[str]] = {}
+        for relation in document.get("managed_users") or []:
+            declared[(username, relation["username"])] = _permission_codes(relation)
+        grants: Dict[str, int] = {}
+        for relation in document.get("manager_users") or []:
+            codes = _permission_codes(relation)
+            declared[(relation["username"], username)] = codes
+            grants[relation["username"]] = grants.get(relation["username"], 0) | permission_registry.mask(codes)
+        self._replace_declared(username, declared)
+        if grants:
+            self._grants[username] = grants
+        else:
+            self._grants.pop(username, None)
+        self._replace_databases(username, {database["db_name"] for database in document.get("databases") or []})
+
+    def _remove(self, username: str):
+        self._nodes.pop(username, None)
+        self._grants.pop(username, None)
+        self._replace_declared(username, {})
+        self._replace_databases(username, set())
+
+    def _replace_databases(self, username: str, databases: Set[str]):
+        for db_name in self._databases_by_user.pop(username, set()) - databases:
+            if self._database_owners.get(db_name) == username:
+                del self._database_owners[db_name]
+        for db_name in databases:
+            self._database_owners[db_name] = username
+        if databases:
+            self._databases_by_user[username] = databases
+
+    def _replace_declared(self, source: str, declared: Dict[Edge, FrozenSet[str]]):
+        previous = self._declared_by.pop(source, set())
+        for edge in previous | set(declared):
+            by_source = self._declared.setdefault(edge, {})
+            by_source.pop(source, None)
+            if edge in declared:
+                by_source[source] = declared[edge]
+            self._update_edge(edge)
+        if declared:
+            self._declared_by[source] = set(declared)
+
+    def _update_edge(self, edge: Edge):
+        manager, managed = edge
+        by_source = self._declared.get(edge)
+        if by_source:
+            permissions = frozenset().union(*by_source.values())
+            self._managed.setdefault(manager, {})[managed] = permissions
+            self._managers.setdefault(managed, {})[manager] = permissions
+        else:
+            self._declared.pop(edge, None)
+            self._managed.get(manager, {}).pop(managed, None)
+            self._managers.get(managed, {}).pop(manager, None)
+
+    # ----------------------------------------------------------------------------------
+    # Interrogazioni
+    # ----------------------------------------------------------------------------------
+    def database_owner(self, db_name: str) -> Optional[str]:
+        self.refresh()
+        with self._lock:
+            return self._database_owners.get(db_name)
+
+    def delegated_permissions(self, db_name: str, username: str) -> int:
+        """
+        Maschera dei permessi (`app.permissions`) che il proprietario di `db_name` concede a
+        `username` tramite i propri `manager_users`; 0 se il database non esiste o nessun permesso.
+        """
+        self.refresh()
+        with self._lock:
+            owner = self._database_owners.get(db_name)
+            if owner is None:
+                return 0
+            return self._grants.get(owner, {}).get(username, 0)
+
+    def managed_users(self, username: str, max_depth: int, permissions: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """
+        Utenti gestiti direttamente o indirettamente, fino a `max_depth` livelli.
+        """
+        return self._walk(username, "_managed", max_depth, frozenset(permissions))
+
+    def manager_users(self, username: str, max_depth: int, permissions: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """
+        Manager diretti e indiretti, fino a `max_depth` livelli.
+        """
+        return self._walk(username, "_managers", max_depth, frozenset(permissions))
+
+    def _walk(self, root: str, direction: str, max_depth: int,
+              permissions: FrozenSet[str]) -> List[Dict[str, Any]]:
+        # Visita in ampiezza: ogni utente compare una volta, alla profondità minima.
+        # Con `permissions` si attraversano solo gli archi che li concedono tutti.
+        # `direction` è il nome della lista di adiacenza, letta dopo l'eventuale sostituzione dell'indice.
+        self.refresh()
+        with self._lock:
+            adjacency: Dict[str, Dict[str, FrozenSet[str]]] = getattr(self, direction)
+            results = []
+            visited = {root}
+            queue = deque([(root, 0)])
+            while queue:
+                current, depth = queue.popleft()
+                if depth >= max_depth:
+                    continue
+                for neighbour, edge_permissions in sorted(adjacency.get(current, {}).items()):
+                    if neighbour in visited or not permissions <= edge_permissions:
+                        continue
+                    visited.add(neighbour)
+                    node = self._nodes.get(neighbour, {"username": neighbour, "email": None, "full_name": ""})
+                    results.append({
+                        **node,
+                        "depth": depth + 1,
+                        "via": current,
+                        "permissions": sorted(edge_permissions),
+                    })
+                    queue.append((neighbour, depth + 1))
+            return results
+
+
+def _permission_codes(relation: Dict[str, Any]) -> FrozenSet[str]:
+    return frozenset(permission["code"] for permission in relation.get("permissions") or [])
+
+
+def fetch_users(storage: Storage, usernames: Optional[List[str]]) -> List[Dict[str, Any]]:
+    """
+    Legge dall'archivio i documenti degli utenti indicati (tutti se `usernames` è None),
+    limitati ai campi usati dall'indice.
+    """
+    filter_data = {} if usernames is None else {"username": {"$in": usernames}}
+    return storage.find(USERS_DATABASE, USERS_COLLECTION, filter_data, HIERARCHY_FIELDS)
@@ -0,0 +1,217 @@
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Argomenti delle notifiche di invalidazione
+USER_TOPIC = "user"            # profilo, password o sessioni di un utente modificati (payload: username)
+DATABASE_TOPIC = "database"    # database creato o eliminato (payload: username, db_name)
+CHANGE_TOPIC = "change"        # documento inserito, aggiornato o eliminato (payload: evento del change feed)
+JOB_TOPIC = "job"              # job accodato o cambiato di stato (payload: job)
+SUBSCRIPTION_TOPIC = "subscription"  # collezioni seguite dal change feed di un worker (payload: worker, keys, sync)
+RESYNC_TOPIC = "resync"        # notifiche perse: lo stato derivato dalle notifiche va riletto (payload: worker)
+RELATIONS_TOPIC = "relations"  # relazioni o permessi concessi modificati (payload: usernames, None = tutti)
+
+# Dimensione massima di un messaggio (datagramma Unix)
+MAX_MESSAGE_SIZE = 64 * 1024
+# Messaggi in attesa per un worker che non svuota il proprio socket; oltre, vengono sostituiti da `RESYNC_TOPIC`
+MAX_PENDING_MESSAGES = 1000
+# Intervallo tra i tentativi di invio ai worker con messaggi in attesa
+RETRY_INTERVAL = 0.01
+
+Handler = Callable[[Dict[str, Any]], None]
+
+
+class InvalidationBus:
+    """
+    Canale publish/subscribe tra i processi worker dello stesso host.
+
+    Ogni worker apre un socket Unix a datagrammi in `socket_dir` (un file per PID); `publish`
+    esegue subito i gestori locali e invia il messaggio a tutti gli altri socket della directory,
+    o solo a quelli dei worker indicati. I socket dei worker terminati vengono rimossi al primo
+    invio fallito. Finché `start` non viene chiamato (sviluppo, script, processo singolo) le
+    notifiche restano locali.
+
+    L'invio non blocca chi pubblica: se la coda del socket di un worker è piena il messaggio, e i
+    successivi per lo stesso worker, restano in attesa in memoria e un thread li reinvia in ordine.
+    Oltre `max_pending` messaggi in attesa quelli accodati vengono sostituiti da un solo messaggio
+    `RESYNC_TOPIC`, con cui il worker che li ha persi scarta lo stato derivato dalle notifiche.
+    """
+
+    def __init__(self, socket_dir: str, max_pending: int = MAX_PENDING_MESSAGES):
+        self.socket_dir = socket_dir
+        self.max_pending = max_pending
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._sock: Optional[socket.socket] = None
+        self._send_sock: Optional[socket.socket] = None
+        self._path: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._sender: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        # Messaggi in attesa per socket di destinazione, nell'ordine di pubblicazione
+        self._pending: Dict[str, Deque[bytes]] = {}
+        self._pending_lock = threading.Lock()
+        self._retry = threading.Event()
+
+    def subscribe(self, topic: str, handler: Handler):
+        self._handlers.setdefault(topic, []).append(handler)
+
+    @property
+    def worker_id(self) -> str:
+        # Il PID del processo, che dà il nome al suo socket
+        return str(os.getpid())
+
+    def publish(self, topic: str, payload: Dict[str, Any], workers: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Esegue i gestori locali e invia la notifica agli altri worker, o solo a `workers` se indicati.
+        Restituisce i worker risultati terminati durante l'invio.
+        """
+        self._dispatch(topic, payload)
+        if self._sock is None:
+            return []
+        message = json.dumps({"topic": topic, "payload": payload}).encode("utf-8")
+        if len(message) > MAX_MESSAGE_SIZE:
+            logger.warning("Notifica di invalidazione '%s' troppo grande (%d byte): non inviata", topic, len(message))
+            return []
+        if workers is None:
+            paths = glob.glob(os.path.join(self.socket_dir, "*.sock"))
+        else:
+            paths = [os.path.join(self.socket_dir, f"{worker}.sock") for worker in workers]
+        gone = []
+        with self._pending_lock:
+            if self._send_sock is None:
+                return gone
+            for path in paths:
+                if path == self._path:
+                    continue
+                queued = self._pending.get(path)
+                if queued is not None:
+                    # Messaggi precedenti ancora in attesa: l'ordine va mantenuto
+                    self._enqueue(path, queued, message)
+                    continue
+                try:
+                    self._send_sock.sendto(message, path)
+                except BlockingIOError:
+                    # Coda del socket piena: il worker è lento, il messaggio viene reinviato più tardi
+                    self._enqueue(path, self._pending.setdefault(path, deque()), message)
+                    self._retry.set()
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Worker terminato senza rimuovere il proprio socket
+                    _unlink(path)
+                    gone.append(os.path.basename(path)[:-len(".sock")])
+                except OSError as e:
+                    logger.warning("Invio della notifica di invalidazione a %s fallito: %s", path, e)
+        return gone
+
+    def _enqueue(self, path: str, queued: Deque[bytes], message: bytes):
+        if len(queued) >= self.max_pending:
+            logger.warning("Worker %s non riceve le notifiche di invalidazione: %d messaggi sostituiti da '%s'",
+                           path, len(queued), RESYNC_TOPIC)
+            queued.clear()
+            queued.append(json.dumps({"topic": RESYNC_TOPIC, "payload": {"worker": self.worker_id}}).encode("utf-8"))
+        queued.append(message)
+
+    def start(self):
+        if self._sock is not None:
+            return
+        os.makedirs(self.socket_dir, exist_ok=True)
+        self._path = os.path.join(self.socket_dir, f"{self.worker_id}.sock")
+        _unlink(self._path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self._path)
+        self._sock.settimeout(0.5)
+        # Socket distinto per l'invio, non bloccante: un worker lento non ferma chi pubblica
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_sock.setblocking(False)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen, name="invalidation-bus", daemon=True)
+        self._thread.start()
+        self._sender = threading.Thread(target=self._send_pending, name="invalidation-bus-sender", daemon=True)
+        self._sender.start()
+
+    def stop(self):
+        if self._sock is None:
+            return
+        self._stop.set()
+        self._retry.set()
+        self._thread.join()
+        self._sender.join()
+        with self._pending_lock:
+            self._sock.close()
+            self._send_sock.close()
+            _unlink(self._path)
+            self._sock = None
+            self._send_sock = None
+            self._path = None
+            self._pending.clear()
+
+    def _send_pending(self):
+        while True:
+            self._retry.wait()
+            stopping = self._stop.is_set()
+            with self._pending_lock:
+                for path in list(self._pending):
+                    queued = self._pending[path]
+                    try:
+                        while queued:
+                            self._send_sock.sendto(queued[0], path)
+                            queued.popleft()
+                    except BlockingIOError:
+                        continue
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        _unlink(path)
+                        queued.clear()
+                    except OSError as e:
+                        logger.warning("Invio della notifica di invalidazione a %s fallito: %s", path, e)
+                        queued.popleft()
+                        continue
+                    del self._pending[path]
+                if not self._pending:
+                    self._retry.clear()
+            # All'arresto resta un solo tentativo per i messaggi in attesa
+            if stopping:
+                return
+            if self._pending:
+                self._stop.wait(RETRY_INTERVAL)
+
+    def _listen(self):
+        while not self._stop.is_set():
+            try:
+                data = self._sock.recv(MAX_MESSAGE_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                message = json.loads(data)
+                self._dispatch(message["topic"], message["payload"])
+            except (ValueError, KeyError) as e:
+                logger.warning("Notifica di invalidazione non valida: %s", e)
+
+    def _dispatch(self, topic: str, payload: Dict[str, Any]):
+        for handler in self._handlers.get(topic, []):
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("Errore nel gestore di invalidazione per '%s'", topic)
+
+
+def clear_sockets(socket_dir: str):
+    """
+    Rimuove i socket lasciati da un'esecuzione precedente (da chiamare nel processo master).
+    """
+    for path in glob.glob(os.path.join(socket_dir, "*.sock")):
+        _unlink(path)
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,418 @@
+"""
+Coda di job in background per le operazioni lente verso il gateway (creazione ed eliminazione dei
+database), eseguite fuori dalla richiesta HTTP che le ha avviate.
+
+I job sono salvati in un file SQLite in modalità WAL condiviso dai worker dello stesso host: ogni
+worker esegue `workers` thread che prendono in carico i job in coda con una transazione esclusiva,
+per cui un job viene eseguito da un solo worker e per ogni utente non girano più di
+`per_user_concurrency` job alla volta. Un job in esecuzione mantiene un lease di `lease_seconds`:
+se il worker termina durante l'esecuzione, allo scadere del lease il job torna disponibile.
+
+Ogni gestore registra con `progress` i passi completati, che vengono salvati nel job: un nuovo
+tentativo dopo un errore riparte dal passo successivo all'ultimo completato invece di ripetere le
+chiamate già riuscite. I cambi di stato sono pubblicati sul canale tra i worker (`JOB_TOPIC`), per
+risvegliare i worker in attesa e aggiornare i client che seguono il job.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel, Field
+
+from app.invalidation import JOB_TOPIC, RESYNC_TOPIC, InvalidationBus
+from app.settings import JobSettings
+
+logger = logging.getLogger(__name__)
+
+# Stati di un job
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED_STATES = frozenset({SUCCEEDED, FAILED})
+
+
+class Job(BaseModel):
+    id: str = Field(..., title="ID", description="Identificativo del job.")
+    username: str = Field(..., title="Username", description="Utente che ha avviato il job.")
+    kind: str = Field(..., title="Tipo", description="Operazione eseguita, es. create_database.")
+    params: Dict[str, Any] = Field(..., title="Parametri", description="Parametri dell'operazione.")
+    status: str = Field(..., title="Stato", description="queued, running, succeeded o failed.")
+    step: Optional[str] = Field(None, title="Passo", description="Ultimo passo completato dell'operazione.")
+    detail: Optional[str] = Field(None, title="Dettaglio", description="Motivo dell'ultimo errore.")
+    result: Optional[Dict[str, Any]] = Field(None, title="Risultato", description="Risultato dell'operazione completata.")
+    attempts: int = Field(0, title="Tentativi", description="Esecuzioni avviate finora.")
+    created_at: str = Field(..., title="Creazione", description="Data e ora di creazione in formato ISO 8601 (UTC).")
+    updated_at: str = Field(..., title="Aggiornamento", description="Data e ora dell'ultimo cambio di stato (UTC).")
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+
+class JobError(Exception):
+    """
+    Il job non può essere accodato; il messaggio è destinato al client.
+    """
+
+
+class IdempotencyConflict(JobError):
+    """
+    La chiave di idempotenza è già stata usata per un'operazione diversa.
+    """
+
+
+class TooManyJobs(JobError):
+    """
+    L'utente ha già `max_pending_per_user` job non terminati.
+    """
+
+
+class JobFailed(Exception):
+    """
+    Sollevata da un gestore per un errore definitivo: il job termina senza altri tentativi.
+    """
+
+
+Progress = Callable[[str], None]
+Handler = Callable[[Job, Progress], Optional[Dict[str, Any]]]
+
+_COLUMNS = "id, username, kind, params, status, step, detail, result, attempts, created_ts, updated_ts"
+
+
+def _iso(timestamp: float) -> str:
+    return datetime.utcfromtimestamp(timestamp).isoformat()
+
+
+def _job(row: Tuple) -> Job:
+    job_id, username, kind, params, status, step, detail, result, attempts, created_ts, updated_ts = row
+    return Job(id=job_id, username=username, kind=kind, params=json.loads(params), status=status, step=step,
+               detail=detail, result=json.loads(result) if result else None, attempts=attempts,
+               created_at=_iso(created_ts), updated_at=_iso(updated_ts))
+
+
+class JobStore:
+    """
+    Job in un file SQLite in modalità WAL, con una connessione per thread come `SQLiteTokenStore`.
+    Le operazioni che leggono e poi scrivono usano `BEGIN IMMEDIATE`, che serializza le scritture
+    anche tra processi diversi.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " username TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " params TEXT NOT NULL,"
+                " idempotency_key TEXT,"
+                " status TEXT NOT NULL,"
+                " step TEXT,"
+                " detail TEXT,"
+                " result TEXT,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " created_ts REAL NOT NULL,"
+                " updated_ts REAL NOT NULL,"
+                " run_after_ts REAL NOT NULL,"
+                " lease_ts REAL"
+                ")"
+            )
+            connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_idempotency"
+                               " ON jobs (username, idempotency_key) WHERE idempotency_key IS NOT NULL")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, run_after_ts)")
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def submit(self, username: str, kind: str, params: Dict[str, Any], idempotency_key: Optional[str],
+               max_pending: int) -> Tuple[Job, bool]:
+        """
+        Accoda un job. Con una chiave di idempotenza già usata dall'utente per la stessa operazione
+        restituisce il job esistente; il secondo valore indica se il job è stato creato ora.
+        """
+        encoded = json.dumps(params, sort_keys=True)
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if idempotency_key is not None:
+                row = connection.execute(f"SELECT {_COLUMNS} FROM jobs WHERE username = ? AND idempotency_key = ?",
+                                         (username, idempotency_key)).fetchone()
+                if row is not None:
+                    job = _job(row)
+                    if job.kind != kind or json.dumps(job.params, sort_keys=True) != encoded:
+                        raise IdempotencyConflict("La chiave di idempotenza è già stata usata per un'altra operazione")
+                    connection.execute("COMMIT")
+                    return job, False
+            pending, = connection.execute("SELECT COUNT(*) FROM jobs WHERE username = ? AND status IN (?, ?)",
+                                          (username, QUEUED, RUNNING)).fetchone()
+            if pending >= max_pending:
+                raise TooManyJobs(f"Troppe operazioni in corso (massimo {max_pending}), riprova più tardi")
+            now = time.time()
+            job_id = uuid.uuid4().hex
+            connection.execute(
+                "INSERT INTO jobs (id, username, kind, params, idempotency_key, status, created_ts, updated_ts,"
+                " run_after_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, username, kind, encoded, idempotency_key, QUEUED, now, now, now),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return self.get(job_id), True
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._connection().execute(f"SELECT {_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row is not None else None
+
+    def claim(self, per_user_limit: int, lease_seconds: float, max_attempts: int) -> Optional[Job]:
+        """
+        Prende in carico il job disponibile più vecchio il cui utente non ha già `per_user_limit`
+        job in esecuzione. Sono disponibili i job in coda e quelli con il lease scaduto.
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Job interrotti (lease scaduto) che hanno esaurito i tentativi
+            connection.execute("UPDATE jobs SET status = ?, detail = ?, lease_ts = NULL, updated_ts = ?"
+                               " WHERE status = ? AND lease_ts < ? AND attempts >= ?",
+                               (FAILED, "Esecuzione interrotta", now, RUNNING, now, max_attempts))
+            row = connection.execute(
+                "SELECT id FROM jobs j WHERE ((status = ? AND run_after_ts <= ?) OR (status = ? AND lease_ts < ?))"
+                " AND (SELECT COUNT(*) FROM jobs r WHERE r.username = j.username AND r.status = ?"
+                " AND r.lease_ts >= ?) < ? ORDER BY created_ts LIMIT 1",
+                (QUEUED, now, RUNNING, now, RUNNING, now, per_user_limit),
+            ).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            connection.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, lease_ts = ?, updated_ts = ?"
+                               " WHERE id = ?", (RUNNING, now + lease_seconds, now, row[0]))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return self.get(row[0])
+
+    def _update(self, job_id: str, assignments: str, values: Tuple) -> Optional[Job]:
+        self._connection().execute(f"UPDATE jobs SET {assignments}, updated_ts = ? WHERE id = ?",
+                                   values + (time.time(), job_id))
+        return self.get(job_id)
+
+    def set_step(self, job_id: str, step: str, lease_seconds: float) -> Optional[Job]:
+        # Ogni passo completato rinnova anche il lease
+        return self._update(job_id, "step = ?, lease_ts = ?", (step, time.time() + lease_seconds))
+
+    def retry(self, job_id: str, detail: str, delay: float) -> Optional[Job]:
+        return self._update(job_id, "status = ?, detail = ?, lease_ts = NULL, run_after_ts = ?",
+                            (QUEUED, detail, time.time() + delay))
+
+    def finish(self, job_id: str, status: str, detail: Optional[str] = None,
+               result: Optional[Dict[str, Any]] = None) -> Optional[Job]:
+        return self._update(job_id, "status = ?, detail = ?, result = ?, lease_ts = NULL",
+                            (status, detail, json.dumps(result) if result is not None else None))
+
+    def purge(self, retention_seconds: float) -> int:
+        return self._connection().execute("DELETE FROM jobs WHERE status IN (?, ?) AND updated_ts < ?",
+                                          (SUCCEEDED, FAILED, time.time() - retention_seconds)).rowcount
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+class JobQueue:
+    """
+    Esecuzione dei job nel worker corrente e notifica dei loro cambi di stato.
+    Finché `start` non viene chiamato i job restano in coda (o vengono eseguiti da altri worker).
+    """
+
+    def __init__(self, store: JobStore, bus: InvalidationBus, limits: JobSettings):
+        self.store = store
+        self.bus = bus
+        self.limits = limits
+        self._handlers: Dict[str, Handler] = {}
+        self._threads: List[threading.Thread] = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._watchers: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, "asyncio.Queue[Dict[str, Any]]"]]] = {}
+        self._watchers_lock = threading.Lock()
+        self._purged_at = 0.0
+        bus.subscribe(JOB_TOPIC, self._dispatch)
+        bus.subscribe(RESYNC_TOPIC, self._on_resync)
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    def submit(self, username: str, kind: str, params: Dict[str, Any],
+               idempotency_key: Optional[str] = None) -> Tuple[Job, bool]:
+        if kind not in self._handlers:
+            raise ValueError(f"Tipo di job sconosciuto: {kind}")
+        job, created = self.store.submit(username, kind, params, idempotency_key, self.limits.max_pending_per_user)
+        if created:
+            self._publish(job)
+        return job, created
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.store.get(job_id)
+
+    # ------------------------------------------------------------------------------
+    # Esecuzione
+    # ------------------------------------------------------------------------------
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for index in range(self.limits.workers):
+            thread = threading.Thread(target=self._run, name=f"jobs-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Attende la fine dei job in esecuzione nel worker; quelli in coda restano nel file.
+        """
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.store.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                job = self.store.claim(self.limits.per_user_concurrency, self.limits.lease_seconds,
+                                       self.limits.max_attempts)
+                self._purge()
+            except sqlite3.Error:
+                logger.exception("Lettura della coda dei job fallita")
+                job = None
+            if job is None:
+                # Risvegliato da un job accodato (anche da un altro worker) o dal controllo periodico,
+                # che riprende i job in attesa di un nuovo tentativo e quelli con il lease scaduto
+                self._wake.wait(self.limits.poll_seconds)
+                continue
+            try:
+                self._execute(job)
+            except sqlite3.Error:
+                # Stato del job non registrato (per esempio "database is locked"): il thread resta attivo
+                # e il job viene ripreso alla scadenza del lease
+                logger.exception("Aggiornamento del job %s fallito", job.id)
+                self._wake.wait(self.limits.poll_seconds)
+
+    def _execute(self, job: Job):
+        self._publish(job)
+        handler = self._handlers.get(job.kind)
+
+        def progress(step: str):
+            updated = self.store.set_step(job.id, step, self.limits.lease_seconds)
+            job.step = step
+            if updated is not None:
+                self._publish(updated)
+
+        try:
+            if handler is None:
+                raise JobFailed(f"Tipo di job sconosciuto: {job.kind}")
+            result = handler(job, progress)
+        except JobFailed as e:
+            self._publish(self.store.finish(job.id, FAILED, str(e)))
+        except Exception as e:
+            # `HTTPException` dei gestori condivisi con le rotte: il messaggio è in `detail`
+            detail = str(getattr(e, "detail", None) or e)
+            if job.attempts >= self.limits.max_attempts:
+                logger.warning("Job %s (%s) fallito dopo %d tentativi: %s", job.id, job.kind, job.attempts, detail)
+                self._publish(self.store.finish(job.id, FAILED, detail))
+            else:
+                delay = self.limits.retry_delay_seconds * 2 ** (job.attempts - 1)
+                self._publish(self.store.retry(job.id, detail, delay))
+        else:
+            self._publish(self.store.finish(job.id, SUCCEEDED, result=result))
+
+    def _purge(self):
+        now = time.monotonic()
+        if now - self._purged_at < 3600:
+            return
+        self._purged_at = now
+        deleted = self.store.purge(self.limits.retention_days * 86400)
+        if deleted:
+            logger.info("Eliminati %d job terminati", deleted)
+
+    # ------------------------------------------------------------------------------
+    # Notifiche
+    # ------------------------------------------------------------------------------
+    def _publish(self, job: Optional[Job]):
+        if job is not None:
+            self.bus.publish(JOB_TOPIC, job.model_dump())
+
+    def watch(self, job_id: str) -> "asyncio.Queue[Dict[str, Any]]":
+        """
+        Coda degli stati del job pubblicati da qualsiasi worker, nel loop corrente.
+        """
+        watcher = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._watchers_lock:
+            self._watchers.setdefault(job_id, set()).add(watcher)
+        return watcher[1]
+
+    def unwatch(self, job_id: str, queue: "asyncio.Queue[Dict[str, Any]]"):
+        with self._watchers_lock:
+            watchers = self._watchers.get(job_id, set())
+            watchers.difference_update({watcher for watcher in watchers if watcher[1] is queue})
+            if not watchers:
+                self._watchers.pop(job_id, None)
+
+    def _on_resync(self, payload: Dict[str, Any]):
+        # Notifiche perse: lo stato dei job seguiti viene riletto dal file
+        self._wake.set()
+        with self._watchers_lock:
+            job_ids = list(self._watchers)
+        for job_id in job_ids:
+            job = self.store.get(job_id)
+            if job is not None:
+                self._dispatch(job.model_dump())
+
+    def _dispatch(self, payload: Dict[str, Any]):
+        # Chiamato nel thread che pubblica o in quello del canale tra i worker
+        self._wake.set()
+        with self._watchers_lock:
+            watchers = list(self._watchers.get(payload["id"], ()))
+        for loop, queue in watchers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, payload)
+            except RuntimeError:
+                # Loop già chiuso (worker in arresto)
+                self.unwatch(payload["id"], queue)
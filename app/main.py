@@ -1,50 +1,42 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
+from fastapi import APIRouter, FastAPI, Header, HTTPException, status, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, EmailStr, Field
 from typing import List, Optional, Union, Any, Dict
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-import requests
 from datetime import datetime, timedelta
+import logging
 import os
+import time
+import uuid
 from fastapi.middleware.cors import CORSMiddleware
-from app import mongodb_route
+from app import mongodb_route, profiling
+from app.invalidation import RELATIONS_TOPIC, USER_TOPIC
+from app.profiling import span
+from app.resources import Resources, get_resources
+from app.settings import Settings, get_settings
+from app.storage import USERS_COLLECTION, USERS_DATABASE, StorageError
+from app.user_store import UserStoreError, UserUpdate, update_user
 #import mongodb_route
 #from utils import UserInDB, MONGO_SERVICE_URL, get_password_hash, Token, verify_password, \
-from app.utils import UserInDB, MONGO_SERVICE_URL, get_password_hash, Token, verify_password, \
-    ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, create_access_token, create_refresh_token, \
-    store_token_in_db, UserDeleteRequest, get_current_user, SECRET_KEY, ALGORITHM, get_token_from_db, oauth2_scheme, \
-    revoke_token_in_db, User, PasswordChangeRequest, DatabaseCreationRequest
-
-# Configurazione FastAPI
-app = FastAPI(
-    title="User Management Service",
-    description="""
-## Servizio per la gestione degli utenti
-Include funzionalità di autenticazione, autorizzazione e gestione delle relazioni tra utenti.
-### Funzionalità:
-* Registrazione utente
-* Autenticazione tramite OAuth2
-* Gestione dei token di accesso e di refresh
-* Visualizzazione e gestione degli utenti gestiti
-* Eliminazione account
-""",
-    version="1.0.0",
-    root_path="/user-backend"
-)
-
-
-# Configurazione CORS per permettere tutte le origini
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Permetti tutte le origini
-    allow_credentials=True,
-    allow_methods=["*"],  # Permetti tutti i metodi (GET, POST, OPTIONS, ecc.)
-    allow_headers=["*"],  # Permetti tutti gli headers
-)
-
-@app.post("/register/", summary="Register a new user", response_description="User registered successfully")
-def register_user(user: UserInDB):
+from app.utils import UserInDB, get_password_hash, Token, verify_password, \
+    create_access_token, create_refresh_token, \
+    store_token_in_db, UserDeleteRequest, get_current_user, get_token_claims, get_token_from_db, oauth2_scheme, \
+    revoke_token_in_db, User, PasswordChangeRequest, DatabaseCreationRequest, pwd_context, \
+    Principal, PRINCIPAL_FIELDS, find_user_document, get_current_principal, get_principal, \
+    bump_session_generation, SESSION_GENERATION_CLAIM, SESSION_ID_CLAIM, revoke_session_in_db
+
+logger = logging.getLogger(__name__)
+
+# Rotte per la gestione degli utenti
+router = APIRouter()
+
+@router.post("/register/", summary="Register a new user", response_description="User registered successfully")
+def register_user(user: UserInDB, resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per registrare un nuovo utente
 
@@ -61,39 +53,45 @@ def register_user(user: UserInDB):
     # Ensure uniqueness of username and email
     username_filter = {"username": user.username}
     email_filter = {"email": user.email}
-    username_response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/users_collection/", json=username_filter)
-    email_response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/users_collection/", json=email_filter)
+    try:
+        username_taken = resources.storage.find(USERS_DATABASE, USERS_COLLECTION, username_filter, ("_id",))
+        email_taken = resources.storage.find(USERS_DATABASE, USERS_COLLECTION, email_filter, ("_id",))
+    except StorageError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error registering user")
 
-    if username_response.status_code == 200 and username_response.json():
+    if username_taken:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
 
-    if email_response.status_code == 200 and email_response.json():
+    if email_taken:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
 
     hashed_password = get_password_hash(user.hashed_password)
 
-    # Sovrascrivi i valori di `manager_users`, `managed_users`, e `databases`
+    # Sovrascrivi i valori di `manager_users`, `managed_users`, `databases`, `session_generation` e `version`
     user_in_db = user.dict()
     user_in_db["hashed_password"] = hashed_password
     user_in_db["managed_users"] = []
     user_in_db["manager_users"] = []
     user_in_db["databases"] = []
+    user_in_db["session_generation"] = 0
+    user_in_db["version"] = 0
 
-    print("#"*120)
-    print(MONGO_SERVICE_URL)
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/users_collection/add_item", json=user_in_db)
-    print("#" * 120)
-    if response.status_code != 200:
-        print(response.__dict__)
-        print("#" * 120)
+    try:
+        resources.storage.insert(USERS_DATABASE, USERS_COLLECTION, user_in_db)
+    except StorageError as e:
+        logger.error("Registrazione dell'utente %s fallita: %s", user.username, e)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Error registering user")
 
+    resources.invalidation_bus.publish(USER_TOPIC, {"username": user.username})
+    # Il nuovo utente può già comparire nelle relazioni dichiarate da altri
+    resources.invalidation_bus.publish(RELATIONS_TOPIC, {"usernames": [user.username]})
 
     return {"message": "User registered successfully"}
 
 
-@app.post("/login/", response_model=Token, summary="Autentica un utente")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+@router.post("/login/", response_model=Token, summary="Autentica un utente")
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
+                           resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per autenticare un utente e ottenere i token di accesso e refresh
 
@@ -106,21 +104,20 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     **Eccezioni:**
     - `401 Unauthorized`: Se le credenziali fornite sono errate.
     """
-    # Creating the filter data to find the user by username
-    filter_data = {"username": form_data.username}
-
-    # Sending a POST request with the filter to find the user
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/users_collection/", json=filter_data)
+    # Lettura proiettata: per il login servono solo i dati di autenticazione
+    with span("user_lookup"):
+        user = find_user_document(resources, {"username": form_data.username}, PRINCIPAL_FIELDS)
 
-    if response.status_code != 200 or not response.json():
+    if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username or password")
 
-    user = response.json()[-1]  # Assuming only one user will match the username
-
-    user_in_db = UserInDB(**user)
+    with span("user_validation"):
+        user_in_db = Principal.from_document(user)
 
     # Verifying the password
-    if not verify_password(form_data.password, user_in_db.hashed_password):
+    with span("password_verify"):
+        password_ok = verify_password(form_data.password, user_in_db.hashed_password)
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -128,19 +125,31 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
         )
 
     # Creating the access token and refresh token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    refresh_token_expires = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
-    access_token = create_access_token(data={"sub": user_in_db.username}, expires_delta=access_token_expires)
-    refresh_token = create_refresh_token(data={"sub": user_in_db.username}, expires_delta=refresh_token_expires)
+    access_token_expires = timedelta(minutes=resources.settings.access_token_expire_minutes)
+    refresh_token_expires = timedelta(days=resources.settings.refresh_token_expire_days)
+    with span("token_sign"):
+        # Token di accesso e di refresh della stessa sessione: il logout li revoca insieme
+        session_id = uuid.uuid4().hex
+        token_claims = {"sub": user_in_db.username, SESSION_GENERATION_CLAIM: user_in_db.session_generation,
+                        SESSION_ID_CLAIM: session_id}
+        access_token = create_access_token(resources, data=token_claims, expires_delta=access_token_expires)
+        refresh_token = create_refresh_token(resources, data=token_claims, expires_delta=refresh_token_expires)
 
     # Store the tokens in the database
-    store_token_in_db(user_in_db.username, access_token, "access_token", datetime.utcnow() + access_token_expires)
-    store_token_in_db(user_in_db.username, refresh_token, "refresh_token", datetime.utcnow() + refresh_token_expires)
+    with span("token_store"):
+        store_token_in_db(resources, user_in_db.username, access_token, "access_token",
+                          datetime.utcnow() + access_token_expires, session_id)
+        store_token_in_db(resources, user_in_db.username, refresh_token, "refresh_token",
+                          datetime.utcnow() + refresh_token_expires, session_id)
+
+    # Le richieste successive al login trovano l'utente già in cache
+    resources.principal_cache.set(user_in_db.username, user_in_db)
 
     return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
 
-@app.delete("/users_collection/me/delete", summary="Elimina l'utente", response_description="Utente eliminato con successo")
-def delete_user(delete_request: UserDeleteRequest, current_user: UserInDB = Depends(get_current_user)):
+@router.delete("/users_collection/me/delete", summary="Elimina l'utente", response_description="Utente eliminato con successo")
+def delete_user(delete_request: UserDeleteRequest, current_user: Principal = Depends(get_current_principal),
+                resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per eliminare un utente
 
@@ -164,15 +173,22 @@ def delete_user(delete_request: UserDeleteRequest, current_user: UserInDB = Depe
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Password non corretta")
 
     # Rimuovi l'utente dal database
-    response = requests.delete(f"{MONGO_SERVICE_URL}/database/delete_item/users_collection/{current_user.id}")
-    if response.status_code != 200:
+    try:
+        deleted = resources.storage.delete(USERS_DATABASE, USERS_COLLECTION, current_user.id)
+    except StorageError:
+        deleted = False
+    if not deleted:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Errore durante l'eliminazione dell'utente")
 
+    resources.invalidation_bus.publish(USER_TOPIC, {"username": current_user.username})
+    # Le relazioni dichiarate dall'utente eliminato escono dall'indice
+    resources.invalidation_bus.publish(RELATIONS_TOPIC, {"usernames": [current_user.username]})
+
     return {"message": "Utente eliminato con successo"}
 
 
-@app.post("/refresh_token/", summary="Rinnova il token di accesso", response_description="Token di accesso rinnovato con successo")
-def refresh_access_token(refresh_token: str):
+@router.post("/refresh_token/", summary="Rinnova il token di accesso", response_description="Token di accesso rinnovato con successo")
+def refresh_access_token(refresh_token: str, resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per rinnovare il token di accesso utilizzando il token di refresh
 
@@ -191,32 +207,53 @@ def refresh_access_token(refresh_token: str):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = resources.key_ring.decode(refresh_token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
 
-        stored_refresh_token = get_token_from_db(refresh_token)
-        if not stored_refresh_token or datetime.fromisoformat(stored_refresh_token.expires_at) < datetime.utcnow():
+        # Il token deve essere un token di refresh ancora registrato: il logout revoca quello della sessione
+        stored_refresh_token = get_token_from_db(resources, refresh_token)
+        if not stored_refresh_token or stored_refresh_token.token_type != "refresh_token" \
+                or datetime.fromisoformat(stored_refresh_token.expires_at) < datetime.utcnow():
             raise credentials_exception
 
     except JWTError:
         raise credentials_exception
 
-    # Create new access token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(data={"sub": username}, expires_delta=access_token_expires)
+    # Il token di refresh deve appartenere alla generazione di sessioni corrente
+    principal = get_principal(resources, username)
+    generation = payload.get(SESSION_GENERATION_CLAIM, 0)
+    if principal is None or generation != principal.session_generation:
+        raise credentials_exception
+
+    # Create new access token, nella stessa sessione del token di refresh
+    session_id = payload.get(SESSION_ID_CLAIM)
+    access_token_expires = timedelta(minutes=resources.settings.access_token_expire_minutes)
+    claims = {"sub": username, SESSION_GENERATION_CLAIM: generation}
+    if session_id is not None:
+        claims[SESSION_ID_CLAIM] = session_id
+    access_token = create_access_token(resources, data=claims, expires_delta=access_token_expires)
 
     # Store the new access token in the database
-    store_token_in_db(username, access_token, "access_token", datetime.utcnow() + access_token_expires)
+    store_token_in_db(resources, username, access_token, "access_token", datetime.utcnow() + access_token_expires,
+                      session_id)
 
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-@app.post("/logout/", summary="Logout utente", response_description="Logout eseguito con successo")
-def logout_user(current_user: UserInDB = Depends(get_current_user)):
+@router.post("/logout/", summary="Logout utente", response_description="Logout eseguito con successo")
+def logout_user(access_token: str = Depends(oauth2_scheme), current_user: Principal = Depends(get_current_principal),
+                claims: Dict[str, Any] = Depends(get_token_claims), resources: Resources = Depends(get_resources)):
     """
-    ### Endpoint per eseguire il logout di un utente
+    ### Endpoint per eseguire il logout di un utente dalla sessione corrente
+
+    Revoca il token di accesso usato per la richiesta e tutti gli altri token della stessa sessione
+    di login, compreso il token di refresh: la sessione non può più essere rinnovata.
+
+    I token revocati vengono cercati nell'archivio dei token a ogni richiesta, senza cache: la revoca
+    vale subito per tutti gli host che condividono l'archivio (con `sqlite` i token sono noti solo
+    all'host che li ha emessi).
 
     **Ritorna:**
     - Messaggio di conferma del logout.
@@ -224,20 +261,60 @@ def logout_user(current_user: UserInDB = Depends(get_current_user)):
     **Eccezioni:**
     - `500 Internal Server Error`: Se si verifica un errore durante il logout.
     """
-    # Revoke access and refresh tokens
-    access_token = Depends(oauth2_scheme)  # Problema qui
-    stored_access_token = get_token_from_db(access_token)
-    if stored_access_token:
-        revoke_token_in_db(stored_access_token.token)
-
-    stored_refresh_token = get_token_from_db(current_user.username)
-    if stored_refresh_token:
-        revoke_token_in_db(stored_refresh_token.token)
+    # Claim già verificati da `get_token_claims`, condivisi con `get_current_principal`
+    session_id = claims.get(SESSION_ID_CLAIM)
+    if session_id is not None:
+        revoke_session_in_db(resources, current_user.username, session_id)
+    revoke_token_in_db(resources, access_token)
 
     return {"message": "Logout eseguito con successo"}
 
 
-@app.get("/users_collection/me/", summary="Recupera il profilo utente", response_description="Profilo utente recuperato con successo")
+@router.post("/logout_all/", summary="Logout da tutte le sessioni", response_description="Logout eseguito su tutte le sessioni")
+def logout_user_everywhere(current_user: Principal = Depends(get_current_principal),
+                           resources: Resources = Depends(get_resources)):
+    """
+    ### Endpoint per invalidare tutti i token di accesso e di refresh dell'utente
+
+    I token vengono invalidati incrementando la generazione delle sessioni dell'utente, letta dal
+    `Principal` in cache. I worker dello stesso host scartano la cache subito, tramite il canale di
+    invalidazione; gli altri host continuano ad accettare i token già emessi finché la loro cache
+    scade, cioè per al massimo `principal_cache_ttl_seconds` (30 secondi per default).
+
+    **Ritorna:**
+    - Messaggio di conferma del logout.
+
+    **Eccezioni:**
+    - `500 Internal Server Error`: Se si verifica un errore durante l'invalidazione delle sessioni.
+    """
+    bump_session_generation(resources, current_user)
+
+    return {"message": "Logout eseguito su tutte le sessioni"}
+
+
+@router.get("/.well-known/jwks.json", summary="Chiavi pubbliche di firma dei token", response_description="Documento JWKS")
+def jwks(request: Request, resources: Resources = Depends(get_resources)):
+    """
+    ### Endpoint con le chiavi pubbliche per verificare i token (RFC 7517)
+
+    Gli altri servizi possono verificare firma e scadenza dei token localmente, scegliendo la chiave
+    in base all'header `kid` del token. Con HS256 l'elenco è vuoto: il segreto non viene mai esposto.
+
+    **Ritorna:**
+    - Documento JWKS con le chiavi attive e quelle conservate per la verifica, con `ETag` e `Cache-Control`.
+    - `304 Not Modified` se il client invia l'ETag corrente in `If-None-Match`.
+    """
+    body, etag = resources.key_ring.jwks()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={resources.settings.jwks_max_age_seconds}",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/users_collection/me/", summary="Recupera il profilo utente", response_description="Profilo utente recuperato con successo")
 def read_users_me(current_user: User = Depends(get_current_user)):
     """
     ### Endpoint per recuperare il profilo dell'utente corrente
@@ -248,37 +325,86 @@ def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
 
-@app.get("/users_collection/me/managed_users/", summary="Recupera gli utenti gestiti dall'utente corrente", response_description="Utenti gestiti recuperati con successo")
-def get_managed_users(current_user: UserInDB = Depends(get_current_user)):
+@router.get("/users_collection/me/managed_users/", summary="Recupera gli utenti gestiti dall'utente corrente", response_description="Utenti gestiti recuperati con successo")
+def get_managed_users(current_user: Principal = Depends(get_current_principal),
+                      resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per recuperare la lista degli utenti gestiti dall'utente corrente
 
     **Ritorna:**
     - Lista di oggetti JSON che rappresentano gli utenti gestiti, includendo solo le informazioni di `username`, `email`, e `full_name`.
     """
-    filter_data = {"username": {"$in": [u["username"] for u in current_user.managed_users]}}
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/users_collection/", json=filter_data)
-
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail="Errore nel recupero degli utenti gestiti")
+    try:
+        managed_users = resources.hierarchy_index.managed_users(current_user.username, max_depth=1)
+    except StorageError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Errore nel recupero degli utenti gestiti: {str(e)}")
 
     managed_users_info = [
         {
             "username": user["username"],
             "email": user["email"],
-            "full_name": user.get("full_name", "")
+            "full_name": user["full_name"]
         }
-        for user in response.json()
+        for user in managed_users
     ]
 
     return managed_users_info
 
 
-@app.put("/users_collection/me/", summary="Aggiorna il profilo utente", response_description="Profilo utente aggiornato con successo")
-def update_user_me(user_update: User, current_user: UserInDB = Depends(get_current_user)):
+@router.get("/users_collection/me/managed_users/all/", summary="Recupera tutti gli utenti gestiti, anche indirettamente",
+            response_description="Utenti gestiti recuperati con successo")
+def get_all_managed_users(max_depth: int = Query(10, ge=1, le=100), permission: List[str] = Query([]),
+                          current_user: Principal = Depends(get_current_principal),
+                          resources: Resources = Depends(get_resources)):
+    """
+    ### Endpoint per recuperare gli utenti gestiti direttamente o tramite altri manager
+
+    **Parametri:**
+    - **max_depth**: Numero massimo di livelli della gerarchia da attraversare.
+    - **permission**: Codici di permesso (anche ripetuti) che ogni relazione attraversata deve concedere.
+
+    **Ritorna:**
+    - Lista di utenti con `username`, `email`, `full_name`, la profondità `depth`, il manager `via` da cui
+      sono raggiunti e i `permissions` della relazione.
+    """
+    try:
+        return resources.hierarchy_index.managed_users(current_user.username, max_depth, permission)
+    except StorageError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Errore nel recupero degli utenti gestiti: {str(e)}")
+
+
+@router.get("/users_collection/me/manager_users/all/", summary="Recupera tutti i manager, anche indiretti",
+            response_description="Manager recuperati con successo")
+def get_all_manager_users(max_depth: int = Query(10, ge=1, le=100), permission: List[str] = Query([]),
+                          current_user: Principal = Depends(get_current_principal),
+                          resources: Resources = Depends(get_resources)):
+    """
+    ### Endpoint per recuperare i manager dell'utente corrente e, risalendo la gerarchia, i loro manager
+
+    **Parametri:**
+    - **max_depth**: Numero massimo di livelli della gerarchia da attraversare.
+    - **permission**: Codici di permesso (anche ripetuti) che ogni relazione attraversata deve concedere.
+
+    **Ritorna:**
+    - Lista di manager con `username`, `email`, `full_name`, la profondità `depth`, l'utente `via` da cui
+      sono raggiunti e i `permissions` della relazione.
+    """
+    try:
+        return resources.hierarchy_index.manager_users(current_user.username, max_depth, permission)
+    except StorageError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Errore nel recupero dei manager: {str(e)}")
+
+
+@router.put("/users_collection/me/", summary="Aggiorna il profilo utente", response_description="Profilo utente aggiornato con successo")
+def update_user_me(user_update: User, current_user: Principal = Depends(get_current_principal),
+                   if_match: Optional[str] = Header(None), resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per aggiornare il profilo dell'utente corrente
 
+    Vengono scritti solo i campi indicati, con un `$set`: aggiornamenti concorrenti di campi diversi
+    non si sovrascrivono. Con l'header `If-Match` uguale alla `version` letta dal profilo,
+    l'aggiornamento viene applicato solo se il profilo non è stato modificato nel frattempo.
+
     **Parametri:**
     - **user_update**: Oggetto JSON con i campi aggiornati dell'utente.
 
@@ -287,29 +413,53 @@ def update_user_me(user_update: User, current_user: UserInDB = Depends(get_curre
 
     **Eccezioni:**
     - `400 Bad Request`: Se si verifica un errore durante l'aggiornamento.
+    - `412 Precondition Failed`: Se il profilo è stato modificato dopo la versione indicata in `If-Match`.
     """
     # Evita che l'utente modifichi `username`, `password`, `managed_users`, `manager_users`, e `databases`
     immutable_fields = {"username", "hashed_password", "managed_users", "manager_users", "databases"}
-    updated_user = {k: v for k, v in user_update.dict().items() if v is not None and k not in immutable_fields}
+    # Solo i campi presenti nella richiesta: quelli omessi non vengono riscritti con i valori predefiniti
+    updated_user = {k: v for k, v in user_update.model_dump(exclude_unset=True).items()
+                    if v is not None and k not in immutable_fields}
 
-    # Send the updated data to the MongoDB API
-    response = requests.put(f"{MONGO_SERVICE_URL}/database/update_item/users_collection/{current_user.id}/",
-                            json=updated_user)
+    expected_version = None
+    if if_match is not None:
+        try:
+            expected_version = int(if_match.strip('W/"'))
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="If-Match non valido")
 
-    # Check for errors in the response
-    if response.status_code != 200:
+    update = UserUpdate()
+    for field, value in updated_user.items():
+        update.set(field, value)
+
+    try:
+        updated = update_user(resources.storage, current_user.id, update, expected_version=expected_version)
+    except UserStoreError:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Errore nell'aggiornamento del profilo")
+    if not updated:
+        if expected_version is not None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                                detail="Il profilo è stato modificato da un'altra richiesta")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Errore nell'aggiornamento del profilo")
+
+    resources.invalidation_bus.publish(USER_TOPIC, {"username": current_user.username})
+    # Nome ed email compaiono nelle relazioni degli altri utenti
+    resources.invalidation_bus.publish(RELATIONS_TOPIC, {"usernames": [current_user.username]})
 
     return {"message": "Profile updated successfully"}
 
 
-@app.put("/users_collection/me/change_password/", summary="Cambia la password dell'utente",
+@router.put("/users_collection/me/change_password/", summary="Cambia la password dell'utente",
          response_description="Password cambiata con successo")
 def change_user_password(password_change_request: PasswordChangeRequest,
-                         current_user: UserInDB = Depends(get_current_user)):
+                         current_user: Principal = Depends(get_current_principal),
+                         resources: Resources = Depends(get_resources)):
     """
     ### Endpoint per cambiare la password dell'utente
 
+    Tutti i token dell'utente vengono invalidati, come con `/logout_all/`: sugli altri host restano
+    accettati per al massimo `principal_cache_ttl_seconds`.
+
     **Parametri:**
     - **password_change_request**: Dati necessari per cambiare la password (username, vecchia password e nuova password).
 
@@ -332,37 +482,93 @@ def change_user_password(password_change_request: PasswordChangeRequest,
     # Hash della nuova password
     new_hashed_password = get_password_hash(password_change_request.new_password)
 
-    # Aggiorna la password nel database
-    response = requests.put(
-        f"{MONGO_SERVICE_URL}/database/update_item/users_collection/{current_user.id}/",
-        json={"hashed_password": new_hashed_password}
-    )
+    # Aggiorna la password e invalida tutti i token dell'utente con un'unica scrittura
+    bump_session_generation(resources, current_user, {"hashed_password": new_hashed_password})
 
-    if response.status_code != 200:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail="Errore durante il cambio della password")
+    return {"message": "Password cambiata con successo e tutti i token sono stati invalidati"}
 
-    # Invalida tutti i token dell'utente corrente
-    try:
-        # Recupera tutti i token di accesso e refresh dell'utente corrente
-        stored_access_token = get_token_from_db(current_user.username)
-        stored_refresh_token = get_token_from_db(current_user.username)
 
-        if stored_access_token:
-            revoke_token_in_db(stored_access_token.token)
+# Preparazione delle risorse prima della prima richiesta
+def warm_up(app: FastAPI, resources: Resources):
+    """
+    Apre le connessioni verso l'archivio dei dati, carica il backend bcrypt, esegue una firma e una verifica
+    JWT e una validazione di `UserInDB`, e genera lo schema OpenAPI.
+    """
+    resources.storage.warm_up(resources.settings.warmup_connections)
+    pwd_context.handler().get_backend()
+    resources.key_ring.decode(create_access_token(resources, {"sub": "warmup"}))
+    UserInDB(**UserInDB.model_config["json_schema_extra"]["example"])
+    app.openapi()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Eseguito in ogni worker (dopo il fork, anche con preload dell'app): le risorse non sono condivise tra i processi
+    settings: Settings = app.state.settings
+    # Thread di AnyIO per le rotte e le dipendenze sincrone (autenticazione, utenti, job): il limite vale per il loop
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_threads
+    # Apertura di file e chiavi fuori dal loop degli eventi
+    resources = await run_in_threadpool(Resources, settings)
+    mongodb_route.register_jobs(resources)
+    app.state.resources = resources
+    resources.start()
+    if settings.warmup_enabled:
+        start = time.perf_counter()
+        await run_in_threadpool(warm_up, app, resources)
+        logger.info("Riscaldamento completato in %.1f ms", (time.perf_counter() - start) * 1000)
+    yield
+    await resources.async_storage.close()
+    # L'arresto attende i job in esecuzione e i thread del canale: fuori dal loop degli eventi
+    await run_in_threadpool(resources.stop)
+
+
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    """
+    Crea l'applicazione FastAPI con middleware, rotte e ciclo di vita configurati secondo `settings`
+    (default: `get_settings()`). Le risorse (archivio, token, coda dei job...) vengono costruite dal
+    ciclo di vita, non qui: creare l'app non apre file, socket o connessioni.
+    """
+    settings = settings or get_settings()
 
-        if stored_refresh_token:
-            revoke_token_in_db(stored_refresh_token.token)
+    # Configurazione FastAPI
+    app = FastAPI(
+        title="User Management Service",
+        description="""
+## Servizio per la gestione degli utenti
+Include funzionalità di autenticazione, autorizzazione e gestione delle relazioni tra utenti.
+### Funzionalità:
+* Registrazione utente
+* Autenticazione tramite OAuth2
+* Gestione dei token di accesso e di refresh
+* Visualizzazione e gestione degli utenti gestiti
+* Eliminazione account
+""",
+        version="1.0.0",
+        root_path="/user-backend",
+        lifespan=lifespan,
+    )
+    app.state.settings = settings
+
+    # Configurazione CORS per permettere tutte le origini
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Permetti tutte le origini
+        allow_credentials=True,
+        allow_methods=["*"],  # Permetti tutti i metodi (GET, POST, OPTIONS, ecc.)
+        allow_headers=["*"],  # Permetti tutti gli headers
+        expose_headers=["Server-Timing", profiling.PROFILE_FILE_HEADER],
+    )
 
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail="Errore durante l'invalidazione dei token")
+    # Header `Server-Timing` e profilazione opzionale delle richieste
+    profiling.register(app, settings.profiling)
 
-    return {"message": "Password cambiata con successo e tutti i token sono stati invalidati"}
+    app.include_router(router)
+    # Include le rotte del MongoDB
+    app.include_router(mongodb_route.router)
+    return app
 
 
-# Include le rotte del MongoDB
-app.include_router(mongodb_route.router)
+app = create_app()
 
 
 # Codice per eseguire l'applicazione
@@ -0,0 +1,358 @@
+"""
+Archivio dei dati in memoria (`storage_backend: memory`), per prove e benchmark senza MongoDB né
+gateway. Valuta in Python i filtri, gli operatori di aggiornamento e gli stadi di aggregazione
+usati dal backend; i dati restano nel processo e si perdono al riavvio. È anche il motore del
+gateway finto dei benchmark (`benchmarks.fake_gateway`).
+"""
+import copy
+import math
+import re
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.storage import Storage, StorageError, encode_results
+
+
+# Operatori di confronto supportati dal filtro in memoria
+_COMPARISONS = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$in": lambda value, arg: _contains_any(value, arg),
+    "$nin": lambda value, arg: not _contains_any(value, arg),
+    "$exists": lambda value, arg: (value is not None) == bool(arg),
+    "$regex": lambda value, arg: isinstance(value, str) and re.search(arg, value) is not None,
+    "$type": lambda value, arg: _type_name(value) in (arg if isinstance(arg, list) else [arg]),
+    "$not": lambda value, arg: not all(op in _COMPARISONS and _COMPARISONS[op](value, item) for op, item in arg.items()),
+}
+
+
+def _type_name(value: Any) -> str:
+    # Nome del tipo BSON di un valore JSON, come negli argomenti di `$type`
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return "array" if isinstance(value, list) else "object"
+
+
+def _contains_any(value: Any, candidates: List[Any]) -> bool:
+    if isinstance(value, list):
+        return any(item in candidates for item in value)
+    return value in candidates
+
+
+def get_path(document: Dict[str, Any], path: str) -> Any:
+    """
+    Restituisce il valore del campo `path` (notazione puntata) oppure `None` se assente.
+    """
+    value: Any = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return None
+    return value
+
+
+def matches(document: Dict[str, Any], query: Dict[str, Any]) -> bool:
+    """
+    Valuta un filtro in stile MongoDB su un documento: uguaglianza, notazione puntata,
+    `$and`/`$or`/`$nor` e gli operatori di confronto più comuni.
+    """
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, sub_query) for sub_query in condition):
+                return False
+        else:
+            value = get_path(document, key)
+            if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+                for op, arg in condition.items():
+                    if op not in _COMPARISONS or not _COMPARISONS[op](value, arg):
+                        return False
+            elif isinstance(value, list) and not isinstance(condition, list):
+                if condition not in value:
+                    return False
+            elif value != condition:
+                return False
+    return True
+
+
+def apply_update(document: Dict[str, Any], update: Dict[str, Any]):
+    """
+    Applica al documento gli operatori di aggiornamento `$set`, `$unset`, `$inc`, `$push` (anche con
+    `$each`) e `$pull` (elementi uguali al valore o, per un documento, con tutti i suoi campi).
+    """
+    for field, value in update.get("$set", {}).items():
+        document[field] = value
+    for field in update.get("$unset", {}):
+        document.pop(field, None)
+    for field, amount in update.get("$inc", {}).items():
+        document[field] = (document.get(field) or 0) + amount
+    for field, value in update.get("$push", {}).items():
+        items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+        document[field] = list(document.get(field) or []) + list(items)
+    for field, condition in update.get("$pull", {}).items():
+        document[field] = [
+            item for item in document.get(field) or []
+            if not (matches(item, condition) if isinstance(condition, dict) and isinstance(item, dict) else item == condition)
+        ]
+
+
+def evaluate(expression: Any, document: Dict[str, Any]) -> Any:
+    """
+    Valuta un'espressione di aggregazione: riferimenti a campi (`"$campo"`), letterali, oggetti
+    e i pochi operatori aritmetici usati negli scenari.
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_path(document, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            (op, arg), = expression.items()
+            if op in _EXPRESSION_OPERATORS:
+                return _EXPRESSION_OPERATORS[op]([evaluate(item, document) for item in
+                                                  (arg if isinstance(arg, list) else [arg])])
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    return expression
+
+
+_EXPRESSION_OPERATORS = {
+    "$add": lambda args: sum(arg or 0 for arg in args),
+    "$multiply": lambda args: math.prod(arg or 0 for arg in args),
+    "$literal": lambda args: args[0],
+    "$toLower": lambda args: str(args[0] or "").lower(),
+}
+
+# Accumulatori di `$group`: (valore iniziale, funzione di accumulo, funzione finale)
+_ACCUMULATORS = {
+    "$sum": (lambda: 0, lambda acc, value: acc + (value if isinstance(value, (int, float)) else 0), lambda acc: acc),
+    "$avg": (lambda: [0, 0], lambda acc, value: [acc[0] + value, acc[1] + 1] if isinstance(value, (int, float)) else acc,
+             lambda acc: acc[0] / acc[1] if acc[1] else None),
+    "$min": (lambda: None, lambda acc, value: value if value is not None and (acc is None or value < acc) else acc,
+             lambda acc: acc),
+    "$max": (lambda: None, lambda acc, value: value if value is not None and (acc is None or value > acc) else acc,
+             lambda acc: acc),
+    "$push": (list, lambda acc, value: acc + [value], lambda acc: acc),
+    "$addToSet": (list, lambda acc, value: acc if value in acc else acc + [value], lambda acc: acc),
+    "$first": (lambda: _MISSING, lambda acc, value: value if acc is _MISSING else acc, lambda acc: acc),
+    "$last": (lambda: None, lambda acc, value: value, lambda acc: acc),
+    "$count": (lambda: 0, lambda acc, value: acc + 1, lambda acc: acc),
+}
+_MISSING = object()
+
+
+def _sort_key(value: Any):
+    # Ordinamento tra tipi diversi: i valori assenti per primi, poi numeri, poi stringhe
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+def run_pipeline(documents: List[Dict[str, Any]], pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Esegue in memoria gli stadi di aggregazione ammessi dal backend.
+    """
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$group":
+            groups: Dict[str, Dict[str, Any]] = {}
+            for document in documents:
+                key = evaluate(spec["_id"], document)
+                group = groups.setdefault(repr(key), {"_id": key, **{
+                    field: _ACCUMULATORS[next(iter(accumulator))][0]()
+                    for field, accumulator in spec.items() if field != "_id"
+                }})
+                for field, accumulator in spec.items():
+                    if field == "_id":
+                        continue
+                    (op, arg), = accumulator.items()
+                    group[field] = _ACCUMULATORS[op][1](group[field], evaluate(arg, document))
+            documents = []
+            for group in groups.values():
+                for field, accumulator in spec.items():
+                    if field != "_id":
+                        group[field] = _ACCUMULATORS[next(iter(accumulator))][2](group[field])
+                documents.append(group)
+        elif name == "$count":
+            documents = [{spec: len(documents)}] if documents else []
+        elif name == "$sortByCount":
+            documents = run_pipeline(documents, [{"$group": {"_id": spec, "count": {"$sum": 1}}},
+                                                 {"$sort": {"count": -1}}])
+        elif name == "$sort":
+            for field, direction in reversed(list(spec.items())):
+                documents = sorted(documents, key=lambda document: _sort_key(get_path(document, field)),
+                                   reverse=direction < 0)
+        elif name == "$skip":
+            documents = documents[spec:]
+        elif name == "$limit":
+            documents = documents[:spec]
+        elif name == "$project":
+            include = {field for field, value in spec.items() if value not in (0, False)}
+            if include - {"_id"}:
+                documents = [{
+                    **({"_id": document.get("_id")} if spec.get("_id", 1) not in (0, False) else {}),
+                    **{field: (get_path(document, field) if value in (1, True) else evaluate(value, document))
+                       for field, value in spec.items() if field != "_id" and value not in (0, False)},
+                } for document in documents]
+            else:
+                documents = [{key: value for key, value in document.items() if key not in spec}
+                             for document in documents]
+        elif name in ("$addFields", "$set"):
+            documents = [{**document, **{field: evaluate(value, document) for field, value in spec.items()}}
+                         for document in documents]
+        elif name == "$unset":
+            fields = [spec] if isinstance(spec, str) else spec
+            documents = [{key: value for key, value in document.items() if key not in fields} for document in documents]
+        elif name == "$unwind":
+            path = (spec["path"] if isinstance(spec, dict) else spec)[1:]
+            documents = [{**document, path: item} for document in documents
+                         for item in (document.get(path) or [])]
+        elif name == "$replaceRoot":
+            documents = [evaluate(spec["newRoot"], document) for document in documents]
+        else:
+            raise ValueError(f"Stadio non supportato dall'archivio in memoria: {name}")
+    return documents
+
+
+class MemoryStorage(Storage):
+    """
+    Database, collezioni e documenti in dizionari annidati. I documenti restituiti sono copie:
+    modificarli non cambia i dati salvati.
+    """
+
+    def __init__(self):
+        # db_name -> collection_name -> _id -> documento
+        self.databases: Dict[str, Dict[str, Dict[str, Dict[str, Any]]]] = {"database": {}}
+        self.schemas: Dict[str, List[Dict[str, str]]] = {}
+        self._lock = threading.RLock()
+
+    def collection(self, db_name: str, collection_name: str) -> Dict[str, Dict[str, Any]]:
+        """
+        La collezione (creata se assente), senza copie: per preparare o ispezionare i dati.
+        """
+        with self._lock:
+            return self.databases.setdefault(db_name, {}).setdefault(collection_name, {})
+
+    def matching(self, db_name: str, collection_name: str,
+                 filter_data: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        I documenti che corrispondono al filtro, senza copie.
+        """
+        with self._lock:
+            documents = list(self.databases.get(db_name, {}).get(collection_name, {}).values())
+        return [document for document in documents if matches(document, filter_data or {})]
+
+    def create_database(self, db_name: str, credentials: Dict[str, Any]):
+        with self._lock:
+            self.databases.setdefault(db_name, {})
+
+    def delete_database(self, db_name: str) -> bool:
+        with self._lock:
+            return self.databases.pop(db_name, None) is not None
+
+    def create_collection(self, db_name: str, collection_name: str):
+        self.collection(db_name, collection_name)
+
+    def list_collections(self, db_name: str) -> List[str]:
+        with self._lock:
+            return list(self.databases.get(db_name, {}).keys())
+
+    def delete_collection(self, db_name: str, collection_name: str):
+        with self._lock:
+            self.databases.get(db_name, {}).pop(collection_name, None)
+
+    def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        with self._lock:
+            self.schemas[f"{db_name}.{collection_name}"] = list(files)
+
+    def insert(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> str:
+        document = copy.deepcopy(document)
+        item_id = str(document.get("_id") or uuid.uuid4().hex)
+        document["_id"] = item_id
+        with self._lock:
+            self.collection(db_name, collection_name)[item_id] = document
+        return item_id
+
+    def insert_many(self, db_name: str, collection_name: str, documents: Sequence[Dict[str, Any]],
+                    concurrency: int = 1) -> int:
+        for document in documents:
+            self.insert(db_name, collection_name, document)
+        return len(documents)
+
+    def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+             fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        documents = self.matching(db_name, collection_name, filter_data)
+        if fields is not None:
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        return copy.deepcopy(documents)
+
+    def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            document = self.databases.get(db_name, {}).get(collection_name, {}).get(item_id)
+            return copy.deepcopy(document)
+
+    def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        with self._lock:
+            document = self.databases.get(db_name, {}).get(collection_name, {}).get(item_id)
+            if document is None:
+                return False
+            document.update(copy.deepcopy({field: value for field, value in fields.items() if field != "_id"}))
+            return True
+
+    def update_one(self, db_name: str, collection_name: str, filter_data: Dict[str, Any],
+                   update: Dict[str, Any]) -> int:
+        # Ricerca e modifica sotto lo stesso lock: l'aggiornamento è atomico
+        with self._lock:
+            for document in self.matching(db_name, collection_name, filter_data):
+                apply_update(document, copy.deepcopy(update))
+                return 1
+        return 0
+
+    def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        with self._lock:
+            return self.databases.get(db_name, {}).get(collection_name, {}).pop(item_id, None) is not None
+
+    def delete_many(self, db_name: str, collection_name: str, filter_data: Dict[str, Any]) -> int:
+        with self._lock:
+            collection = self.databases.get(db_name, {}).get(collection_name, {})
+            deleted = [item_id for item_id, document in collection.items() if matches(document, filter_data)]
+            for item_id in deleted:
+                del collection[item_id]
+        return len(deleted)
+
+    def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            collections = list(self.databases.get(db_name, {}).values())
+            results = [document for collection in collections for document in collection.values()
+                       if matches(document, filter_data)]
+        return copy.deepcopy(results[skip:skip + size])
+
+    def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                  options: Dict[str, Any], max_bytes: int) -> bytes:
+        try:
+            documents = run_pipeline(self.matching(db_name, collection_name), pipeline)
+        except (ValueError, KeyError, TypeError) as error:
+            raise StorageError(f"aggregate: {error}", 400) from error
+        return encode_results(documents, max_bytes)
@@ -1,14 +1,22 @@
-from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File
-from pydantic import BaseModel
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, Response, status, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
-import requests
+import asyncio
+import itertools
 import json
-from app.utils import UserInDB, get_current_user
-
-config_file = open("config.json")
-config_dict = json.load(config_file)
-# URL del servizio MongoDB
-MONGO_SERVICE_URL = config_dict["mongodb_service_url"]
+import sqlite3
+from functools import partial
+from app.aggregation import PipelineError, aggregate_options, validate_pipeline
+from app.invalidation import DATABASE_TOPIC
+from app.jobs import FINISHED_STATES, IdempotencyConflict, Job, JobFailed, TooManyJobs
+from app.permissions import ADMIN, READ, WRITE, allows
+from app.resources import Resources, get_resources
+from app.storage import ResultTooLarge, StorageError
+from app.transfer import ProgressResponse, export_documents, gzip_chunks, import_documents
+from app.user_store import UserUpdate
+from app.utils import Principal, get_current_principal, load_principal, update_principal
 
 router = APIRouter(
     prefix="/mongo",
@@ -22,71 +30,177 @@ class DatabaseCreationRequest(BaseModel):
     db_name: str
 
 
-# Funzione per verificare se il database appartiene all'utente corrente
-def verify_user_database(db_name: str, current_user: UserInDB):
-    if not any(db["db_name"] == db_name for db in current_user.databases):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Non sei autorizzato ad accedere a questo database."
-        )
+# Modello per le aggregazioni
+class AggregationRequest(BaseModel):
+    pipeline: List[Dict[str, Any]] = Field(..., title="Pipeline",
+                                           description="Stadi di aggregazione MongoDB, tra quelli ammessi.")
 
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "pipeline": [
+                    {"$match": {"status": "paid"}},
+                    {"$group": {"_id": "$customer", "total": {"$sum": "$amount"}}},
+                    {"$sort": {"total": -1}},
+                ]
+            }
+        }
 
-@router.post("/create_user_database/", summary="Crea un nuovo database MongoDB con le proprie credenziali",
-             response_description="Database creato con successo")
-async def create_user_database(request: DatabaseCreationRequest, current_user: UserInDB = Depends(get_current_user)):
+
+# Funzione per verificare se l'utente corrente può accedere al database.
+# Il proprietario ha sempre accesso; se `required` è indicato, anche i manager a cui il proprietario
+# ha concesso quei permessi nei propri `manager_users` (maschera di `app.permissions`).
+def verify_user_database(resources: Resources, db_name: str, current_user: Principal, required: Optional[int] = None):
+    if current_user.database(db_name) is not None:
+        return
+    if required is not None:
+        try:
+            granted = resources.hierarchy_index.delegated_permissions(db_name, current_user.username)
+        except StorageError:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Impossibile verificare i permessi sul database.")
+        if allows(granted, required):
+            return
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Non sei autorizzato ad accedere a questo database."
+    )
+
+
+async def verify_database_access(resources: Resources, db_name: str, current_user: Principal,
+                                 required: Optional[int] = None):
     """
-    ### Crea un nuovo database MongoDB utilizzando le proprie credenziali.
+    `verify_user_database` per le rotte `async def`: il proprietario si verifica in memoria, i permessi
+    delegati possono leggere gli utenti dall'archivio e vengono verificati nel threadpool.
     """
-    username = current_user.username
-    prefixed_db_name = f"{username}-{request.db_name}"
-    host = request
-    port = 27017
+    if current_user.database(db_name) is None:
+        await run_in_threadpool(verify_user_database, resources, db_name, current_user, required)
+
+
+# Operazioni eseguite in background dalla coda dei job
+CREATE_DATABASE_JOB = "create_database"
+DELETE_DATABASE_JOB = "delete_database"
+
 
+def _storage_step(action: str, call, *args):
+    # Gli errori 4xx del gateway sono definitivi; gli altri vengono ritentati dalla coda
     try:
-        # Creazione del database tramite l'API
-        db_credentials = {
-            "db_name": prefixed_db_name,
-            "host": host,
-            "port": port
-        }
-        response = requests.post(f"{MONGO_SERVICE_URL}/create_database/", json=db_credentials)
+        return call(*args)
+    except StorageError as e:
+        if e.status_code is not None and 400 <= e.status_code < 500:
+            raise JobFailed(f"Errore durante {action} del database: {str(e)}")
+        raise
 
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore durante la creazione del database")
 
-        # Verifica se esiste già un database con lo stesso nome e host
-        database_exists = any(db["db_name"] == prefixed_db_name and db["host"] == host for db in current_user.databases)
+def _job_owner(resources: Resources, job: Job) -> Principal:
+    principal = load_principal(resources, job.username)
+    if principal is None:
+        raise JobFailed("Utente non trovato")
+    return principal
 
-        if not database_exists:
-            # Se il database non esiste già nella lista, aggiungilo
-            new_database_info = {
-                "db_name": prefixed_db_name,
-                "host": host,
-                "port": port
-            }
-            current_user.databases.append(new_database_info)
 
-            update_response = requests.put(
-                f"{MONGO_SERVICE_URL}/database/update_item/users_collection/{current_user.id}/",
-                json={"databases": current_user.databases}
-            )
+def provision_database(resources: Resources, job: Job, progress) -> Dict[str, Any]:
+    """
+    Crea il database sul gateway e lo aggiunge alla lista `databases` dell'utente.
+    """
+    db_credentials = job.params
+    if job.step is None:
+        _storage_step("la creazione", resources.storage.create_database, db_credentials["db_name"], db_credentials)
+        progress("database_created")
+
+    # Aggiunge il database alla lista dell'utente con un `$push`, solo se non è già presente
+    # nella versione del documento su cui viene applicato l'aggiornamento
+    def add_database(principal: Principal) -> Optional[UserUpdate]:
+        if any(db["db_name"] == db_credentials["db_name"] and db["host"] == db_credentials["host"]
+               for db in principal.databases):
+            return None
+        return UserUpdate().push("databases", db_credentials)
+
+    update_principal(resources, _job_owner(resources, job), add_database)
+    progress("user_updated")
+    resources.invalidation_bus.publish(DATABASE_TOPIC, {"username": job.username, "db_name": db_credentials["db_name"]})
+    return {"db_name": db_credentials["db_name"]}
+
+
+def teardown_database(resources: Resources, job: Job, progress) -> Dict[str, Any]:
+    """
+    Elimina il database sul gateway e lo rimuove dalla lista `databases` dell'utente.
+    """
+    db_name = job.params["db_name"]
+    if job.step is None:
+        # Database assente: già eliminato da un'esecuzione interrotta prima di registrare il passo
+        _storage_step("l'eliminazione", resources.storage.delete_database, db_name)
+        progress("database_deleted")
+
+    # Rimuovi il database dalla lista `databases` dell'utente basandoti solo su `db_name`, con un
+    # `$pull` applicato alla versione letta: se nel frattempo la lista è cambiata viene riletta
+    def remove_database(principal: Principal) -> Optional[UserUpdate]:
+        if principal.database(db_name) is None:
+            return None
+        return UserUpdate().pull("databases", {"db_name": db_name})
+
+    update_principal(resources, _job_owner(resources, job), remove_database)
+    progress("user_updated")
+    resources.invalidation_bus.publish(DATABASE_TOPIC, {"username": job.username, "db_name": db_name})
+    return {"db_name": db_name}
+
+
+def register_jobs(resources: Resources):
+    """
+    Registra nella coda dei job del worker le operazioni eseguite in background.
+    """
+    resources.job_queue.register(CREATE_DATABASE_JOB, partial(provision_database, resources))
+    resources.job_queue.register(DELETE_DATABASE_JOB, partial(teardown_database, resources))
+
 
-            if update_response.status_code != 200:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                    detail="Errore durante l'aggiornamento delle informazioni dell'utente")
+def submit_job(resources: Resources, request: Request, current_user: Principal, kind: str, params: Dict[str, Any],
+               idempotency_key: Optional[str]) -> JSONResponse:
+    """
+    Accoda il job e risponde subito con `202 Accepted` e l'indirizzo da cui seguirne lo stato.
+    """
+    try:
+        job, _ = resources.job_queue.submit(current_user.username, kind, params, idempotency_key)
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except TooManyJobs as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=str(e))
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=f"Impossibile accodare l'operazione: {str(e)}")
+    location = str(request.url_for("get_job", job_id=job.id))
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.model_dump(), headers={"Location": location})
 
-        return {"message": f"Database '{prefixed_db_name}' creato con successo."}
 
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail=f"Errore durante la creazione del database: {str(e)}")
+@router.post("/create_user_database/", summary="Crea un nuovo database MongoDB con le proprie credenziali",
+             status_code=status.HTTP_202_ACCEPTED, response_model=Job,
+             response_description="Job di creazione del database accodato")
+def create_user_database(request: DatabaseCreationRequest, http_request: Request,
+                         current_user: Principal = Depends(get_current_principal),
+                         resources: Resources = Depends(get_resources),
+                         idempotency_key: Optional[str] = Header(None)):
+    """
+    ### Crea un nuovo database MongoDB utilizzando le proprie credenziali.
 
+    La creazione viene eseguita in background: la risposta `202 Accepted` contiene il job, il cui
+    stato si legge da `GET /jobs/{job_id}` (indicato nell'header `Location`) o si segue con
+    `GET /jobs/{job_id}/events`. Ripetendo la richiesta con lo stesso header `Idempotency-Key`
+    si ottiene lo stesso job invece di crearne uno nuovo.
+
+    **Eccezioni:**
+    - `409 Conflict`: Se la chiave di idempotenza è stata usata per un'altra operazione.
+    - `429 Too Many Requests`: Se l'utente ha troppe operazioni in corso.
+    """
+    db_credentials = {
+        "db_name": f"{current_user.username}-{request.db_name}",
+        "host": resources.settings.mongodb_host,
+        "port": resources.settings.mongodb_port,
+    }
+    return submit_job(resources, http_request, current_user, CREATE_DATABASE_JOB, db_credentials, idempotency_key)
 
 
 @router.get("/list_databases/", summary="Ottieni l'elenco dei database dell'utente",
             response_description="Elenco dei database esistenti")
-async def list_databases(current_user: UserInDB = Depends(get_current_user)):
+async def list_databases(current_user: Principal = Depends(get_current_principal)):
     """
     Recupera l'elenco dei database esistenti associati all'utente.
     """
@@ -95,19 +209,15 @@ async def list_databases(current_user: UserInDB = Depends(get_current_user)):
 
 @router.post("/{db_name}/create_collection/", summary="Crea una nuova collezione",
              response_description="La collezione è stata creata con successo")
-async def create_collection(db_name: str, collection_name: str, current_user: UserInDB = Depends(get_current_user)):
+async def create_collection(db_name: str, collection_name: str, current_user: Principal = Depends(get_current_principal),
+                            resources: Resources = Depends(get_resources)):
     """
     Crea una nuova collezione all'interno di un database esistente.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, ADMIN)
 
     try:
-        response = requests.post(f"{MONGO_SERVICE_URL}/{db_name}/create_collection/",
-                                 params={"collection_name": collection_name})
-        if response.status_code != 200:
-
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore nella creazione della collezione.")
+        await resources.async_storage.create_collection(db_name, collection_name)
         return {"message": f"Collection '{collection_name}' created successfully in database '{db_name}'."}
     except Exception as e:
 
@@ -117,17 +227,15 @@ async def create_collection(db_name: str, collection_name: str, current_user: Us
 
 @router.get("/{db_name}/list_collections/", summary="Elenca le collezioni in un database",
             response_description="Elenco delle collezioni presenti nel database")
-async def list_collections(db_name: str, current_user: UserInDB = Depends(get_current_user)):
+async def list_collections(db_name: str, current_user: Principal = Depends(get_current_principal),
+                           resources: Resources = Depends(get_resources)):
     """
     Recupera l'elenco di tutte le collezioni in un database specifico.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, READ)
 
     try:
-        response = requests.get(f"{MONGO_SERVICE_URL}/{db_name}/list_collections/")
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Errore nel recupero delle collezioni.")
-        return response.json()
+        return await resources.async_storage.list_collections(db_name)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Errore nel recupero delle collezioni: {str(e)}")
@@ -135,17 +243,15 @@ async def list_collections(db_name: str, current_user: UserInDB = Depends(get_cu
 
 @router.delete("/{db_name}/delete_collection/{collection_name}/", summary="Elimina una collezione esistente",
                response_description="La collezione è stata eliminata con successo")
-async def delete_collection(db_name: str, collection_name: str, current_user: UserInDB = Depends(get_current_user)):
+async def delete_collection(db_name: str, collection_name: str, current_user: Principal = Depends(get_current_principal),
+                            resources: Resources = Depends(get_resources)):
     """
     Elimina una collezione esistente in un database specifico.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, ADMIN)
 
     try:
-        response = requests.delete(f"{MONGO_SERVICE_URL}/{db_name}/delete_collection/{collection_name}/")
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore nell'eliminazione della collezione.")
+        await resources.async_storage.delete_collection(db_name, collection_name)
         return {"message": f"Collection '{collection_name}' deleted successfully from database '{db_name}'."}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -154,7 +260,8 @@ async def delete_collection(db_name: str, collection_name: str, current_user: Us
 
 # Funzione per caricare e associare schemi YAML alle collezioni
 @router.post("/{db_name}/{collection_name}/upload_schema/", summary="Carica uno o più schemi YAML per una collezione specifica")
-async def upload_schema(db_name: str, collection_name: str, files: List[UploadFile] = File(...), current_user: UserInDB = Depends(get_current_user)):
+async def upload_schema(db_name: str, collection_name: str, files: List[UploadFile] = File(...), current_user: Principal = Depends(get_current_principal),
+                        resources: Resources = Depends(get_resources)):
     """
     Carica uno o più schemi YAML per una collezione specifica in un database.
 
@@ -163,7 +270,7 @@ async def upload_schema(db_name: str, collection_name: str, files: List[UploadFi
     - **collection_name**: Nome della collezione
     - **files**: Lista di file YAML contenenti gli schemi
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, ADMIN)
 
     try:
         files_data = []
@@ -174,14 +281,7 @@ async def upload_schema(db_name: str, collection_name: str, files: List[UploadFi
                 "content": content.decode("utf-8")
             })
 
-        response = requests.post(
-            f"{MONGO_SERVICE_URL}/upload_schema/{db_name}/{collection_name}/",
-            json={"files": files_data}
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore durante il caricamento degli schemi.")
-
+        await resources.async_storage.upload_schema(db_name, collection_name, files_data)
         return {"message": f"Schemi per la collezione '{collection_name}' nel database '{db_name}' caricati con successo."}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -190,7 +290,8 @@ async def upload_schema(db_name: str, collection_name: str, files: List[UploadFi
 
 # Endpoint per aggiungere un documento in una collezione convalidato tramite schema
 @router.post("/{db_name}/{collection_name}/add_item/", summary="Aggiungi un documento in una collezione convalidato tramite schema")
-async def add_item(db_name: str, collection_name: str, data: Dict[str, Any], current_user: UserInDB = Depends(get_current_user)):
+async def add_item(db_name: str, collection_name: str, data: Dict[str, Any], current_user: Principal = Depends(get_current_principal),
+                   resources: Resources = Depends(get_resources)):
     """
     Aggiungi un nuovo documento in una collezione esistente, convalidato tramite uno schema YAML specifico.
 
@@ -199,17 +300,12 @@ async def add_item(db_name: str, collection_name: str, data: Dict[str, Any], cur
     - **collection_name**: Nome della collezione
     - **data**: Dati del documento da inserire
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, WRITE)
 
     try:
-        response = requests.post(
-            f"{MONGO_SERVICE_URL}/{db_name}/{collection_name}/add_item/",
-            json=data
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore nell'aggiunta del documento.")
-        return response.json()
+        result = await resources.async_storage.add_item(db_name, collection_name, data)
+        resources.change_feed.publish("insert", db_name, collection_name, result.get("id"), data)
+        return result
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Errore nell'aggiunta del documento: {str(e)}")
@@ -218,38 +314,79 @@ async def add_item(db_name: str, collection_name: str, data: Dict[str, Any], cur
 @router.post("/{db_name}/get_items/{collection_name}/", summary="Recupera tutti i documenti di una collezione",
              response_description="Elenco dei documenti nella collezione")
 async def get_items(db_name: str, collection_name: str, filter: Optional[Dict[str, Any]] = None,
-                    current_user: UserInDB = Depends(get_current_user)):
+                    current_user: Principal = Depends(get_current_principal),
+                    resources: Resources = Depends(get_resources)):
     """
     Recupera tutti i documenti di una collezione specifica, con la possibilità di applicare un filtro.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, READ)
     query = filter if filter else {}
 
     try:
-        response = requests.post(f"{MONGO_SERVICE_URL}/{db_name}/get_items/{collection_name}/", json=query)
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Errore nel recupero dei documenti.")
-
-        return response.json()
+        return await resources.async_storage.find(db_name, collection_name, query)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Errore nel recupero dei documenti: {str(e)}")
 
 
+@router.get("/{db_name}/{collection_name}/changes", summary="Ricevi le modifiche di una collezione (Server-Sent Events)",
+            response_description="Flusso `text/event-stream` di eventi insert, update e delete")
+async def collection_changes(db_name: str, collection_name: str, request: Request,
+                             current_user: Principal = Depends(get_current_principal),
+                             resources: Resources = Depends(get_resources)):
+    """
+    Apre un flusso Server-Sent Events con le modifiche ai documenti della collezione eseguite
+    tramite questo servizio, in alternativa alla lettura periodica con `get_items`.
+
+    Ogni evento ha tipo `insert`, `update` o `delete` e come dati un oggetto JSON con `db`,
+    `collection`, `id` e, per inserimenti e aggiornamenti, i campi scritti in `document`
+    (omessi con `truncated: true` se troppo grandi). Un evento `reset` indica che alcuni eventi
+    sono stati scartati perché il client era in ritardo: la collezione va riletta.
+    Ogni `change_feed_heartbeat_seconds` viene inviato un commento di keep-alive.
+
+    **Eccezioni:**
+    - `403 Forbidden`: Se l'utente non ha accesso in lettura al database.
+    - `503 Service Unavailable`: Se il worker ha raggiunto il numero massimo di client.
+    """
+    await verify_database_access(resources, db_name, current_user, READ)
+    change_feed = resources.change_feed
+    subscription = change_feed.subscribe(db_name, collection_name)
+    if subscription is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Troppi client collegati al change feed, riprova più tardi")
+    heartbeat = resources.settings.change_feed_heartbeat_seconds
+
+    async def events():
+        try:
+            # Il primo commento fa partire subito la risposta anche attraverso i proxy
+            yield b": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+        finally:
+            change_feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @router.put("/{db_name}/update_item/{collection_name}/{item_id}/", summary="Aggiorna un documento in una collezione",
             response_description="Il documento è stato aggiornato con successo")
 async def update_item(db_name: str, collection_name: str, item_id: str, item: Dict[str, Any],
-                      current_user: UserInDB = Depends(get_current_user)):
+                      current_user: Principal = Depends(get_current_principal),
+                      resources: Resources = Depends(get_resources)):
     """
     Aggiorna un documento esistente in una collezione.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, WRITE)
 
     try:
-        response = requests.put(f"{MONGO_SERVICE_URL}/{db_name}/update_item/{collection_name}/{item_id}/", json=item)
-        if response.status_code != 200:
+        if not await resources.async_storage.update(db_name, collection_name, item_id, item):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="Errore nell'aggiornamento del documento.")
+        resources.change_feed.publish("update", db_name, collection_name, item_id, item)
         return {"message": "Item updated successfully."}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -259,17 +396,18 @@ async def update_item(db_name: str, collection_name: str, item_id: str, item: Di
 @router.delete("/{db_name}/delete_item/{collection_name}/{item_id}/", summary="Elimina un documento in una collezione",
                response_description="Il documento è stato eliminato con successo")
 async def delete_item(db_name: str, collection_name: str, item_id: str,
-                      current_user: UserInDB = Depends(get_current_user)):
+                      current_user: Principal = Depends(get_current_principal),
+                      resources: Resources = Depends(get_resources)):
     """
     Elimina un documento esistente in una collezione.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, WRITE)
 
     try:
-        response = requests.delete(f"{MONGO_SERVICE_URL}/{db_name}/delete_item/{collection_name}/{item_id}/")
-        if response.status_code != 200:
+        if not await resources.async_storage.delete(db_name, collection_name, item_id):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                                 detail="Errore nell'eliminazione del documento.")
+        resources.change_feed.publish("delete", db_name, collection_name, item_id)
         return {"message": "Item deleted successfully."}
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
@@ -279,59 +417,108 @@ async def delete_item(db_name: str, collection_name: str, item_id: str,
 @router.get("/{db_name}/get_item/{collection_name}/{item_id}/", summary="Recupera un documento specifico",
             response_description="Il documento è stato recuperato con successo")
 async def get_item(db_name: str, collection_name: str, item_id: str,
-                   current_user: UserInDB = Depends(get_current_user)):
+                   current_user: Principal = Depends(get_current_principal),
+                   resources: Resources = Depends(get_resources)):
     """
     Recupera un documento specifico in una collezione.
     """
-    verify_user_database(db_name, current_user)
+    await verify_database_access(resources, db_name, current_user, READ)
 
     try:
-        response = requests.get(f"{MONGO_SERVICE_URL}/{db_name}/get_item/{collection_name}/{item_id}/")
-        if response.status_code != 200:
+        document = await resources.async_storage.get(db_name, collection_name, item_id)
+        if document is None:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Errore nel recupero del documento.")
-        return response.json()
+        return document
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Errore nel recupero del documento: {str(e)}")
 
 
 @router.delete("/delete_database/{db_name}/", summary="Elimina un database esistente",
-               response_description="Il database è stato eliminato con successo")
-async def delete_database(db_name: str, current_user: UserInDB = Depends(get_current_user)):
+               status_code=status.HTTP_202_ACCEPTED, response_model=Job,
+               response_description="Job di eliminazione del database accodato")
+def delete_database(db_name: str, http_request: Request, current_user: Principal = Depends(get_current_principal),
+                    resources: Resources = Depends(get_resources),
+                    idempotency_key: Optional[str] = Header(None)):
     """
     Elimina un database esistente e rimuovilo dalla lista `databases` dell'utente.
 
+    L'eliminazione viene eseguita in background, come la creazione: la risposta `202 Accepted`
+    contiene il job da seguire con `GET /jobs/{job_id}`.
+
     **Parametri:**
     - **db_name**: Nome del database da eliminare
     """
-    verify_user_database(db_name, current_user)
+    verify_user_database(resources, db_name, current_user)
+    return submit_job(resources, http_request, current_user, DELETE_DATABASE_JOB, {"db_name": db_name}, idempotency_key)
 
-    try:
-        # Effettua la richiesta per eliminare il database tramite l'API MongoDB
-        response = requests.delete(f"{MONGO_SERVICE_URL}/delete_database/{db_name}/")
-        if response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore durante l'eliminazione del database")
 
-        # Rimuovi il database dalla lista `databases` dell'utente basandoti solo su `db_name`
-        updated_databases = [db for db in current_user.databases if db["db_name"] != db_name]
+def _user_job(resources: Resources, job_id: str, current_user: Principal) -> Job:
+    job = resources.job_queue.get(job_id)
+    # I job degli altri utenti non vengono rivelati
+    if job is None or job.username != current_user.username:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job non trovato")
+    return job
 
-        # Aggiorna la lista `databases` dell'utente nel database principale
-        update_response = requests.put(
-            f"{MONGO_SERVICE_URL}/database/update_item/users_collection/{current_user.id}/",
-            json={"databases": updated_databases}
-        )
 
-        if update_response.status_code != 200:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
-                                detail="Errore durante l'aggiornamento delle informazioni dell'utente")
+@router.get("/jobs/{job_id}", summary="Stato di un'operazione in background", response_model=Job,
+            response_description="Il job con il suo stato")
+def get_job(job_id: str, current_user: Principal = Depends(get_current_principal),
+            resources: Resources = Depends(get_resources)):
+    """
+    Restituisce lo stato del job: `queued`, `running`, `succeeded` (con `result`) o `failed`
+    (con il motivo in `detail`). `step` indica l'ultimo passo completato.
 
-        return {
-            "message": f"Database '{db_name}' eliminato con successo e rimosso dalla lista dei database dell'utente."}
+    **Eccezioni:**
+    - `404 Not Found`: Se il job non esiste o appartiene a un altro utente.
+    """
+    return _user_job(resources, job_id, current_user)
 
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            detail=f"Errore durante l'eliminazione del database: {str(e)}")
+
+@router.get("/jobs/{job_id}/events", summary="Segui un'operazione in background (Server-Sent Events)",
+            response_description="Flusso `text/event-stream` con gli stati del job")
+async def job_events(job_id: str, request: Request, current_user: Principal = Depends(get_current_principal),
+                     resources: Resources = Depends(get_resources)):
+    """
+    Invia lo stato corrente del job e ogni suo cambiamento come evento SSE, con tipo uguale allo
+    stato e come dati il job in JSON; il flusso termina quando il job è `succeeded` o `failed`.
+
+    **Eccezioni:**
+    - `404 Not Found`: Se il job non esiste o appartiene a un altro utente.
+    """
+    # Iscrizione prima della lettura: nessun cambiamento va perso tra le due
+    job_queue = resources.job_queue
+    queue = job_queue.watch(job_id)
+    try:
+        job = await run_in_threadpool(_user_job, resources, job_id, current_user)
+    except BaseException:
+        job_queue.unwatch(job_id, queue)
+        raise
+    heartbeat = resources.settings.change_feed_heartbeat_seconds
+
+    async def events():
+        try:
+            state = job.model_dump()
+            sent = None
+            while True:
+                if state != sent:
+                    yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n".encode()
+                    sent = state
+                if state["status"] in FINISHED_STATES or await request.is_disconnected():
+                    return
+                try:
+                    state = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    # Rilettura periodica: copre le notifiche perse (per esempio da un altro host)
+                    current = await run_in_threadpool(job_queue.get, job_id)
+                    state = current.model_dump() if current is not None else sent
+                    if state == sent:
+                        yield b": keep-alive\n\n"
+        finally:
+            job_queue.unwatch(job_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @router.post(
@@ -344,27 +531,174 @@ async def search_documents(
     filter: Optional[Dict[str, Any]] = None,
     skip: int = 0,
     size: int = 10,
-    current_user: UserInDB = Depends(get_current_user)
+    count: bool = False,
+    current_user: Principal = Depends(get_current_principal),
+    resources: Resources = Depends(get_resources)
 ):
     """
     Esegue una ricerca nella collezione specificata in base ad un filtro con paginazione.
+
+    Con `count=true` la risposta è `{"items": [...], "total": N}`, dove `total` è il numero di
+    documenti che corrispondono al filtro, indipendentemente da `skip` e `size`; le collezioni
+    vengono contate in parallelo, fino a `aggregation.count_concurrency` alla volta.
     """
-    verify_user_database(db_name, current_user)
-    payload = {
-        "filter": filter if filter is not None else {},
-        "skip": skip,
-        "size": size
-    }
+    await verify_database_access(resources, db_name, current_user, READ)
+    filter_data = filter if filter is not None else {}
     try:
-        response = requests.post(f"{MONGO_SERVICE_URL}/{db_name}/search", json=payload)
-        if response.status_code != 200:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Errore nella ricerca dei documenti."
-            )
-        return response.json()
+        items = await resources.async_storage.search(db_name, filter_data, skip, size)
+        if not count:
+            return items
+        # Totale dei documenti che corrispondono al filtro, contato dal database
+        return {"items": items, "total": await count_documents(resources, db_name, filter_data)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Errore nella ricerca dei documenti: {str(e)}"
         )
+
+
+async def run_aggregation(resources: Resources, db_name: str, collection_name: str,
+                          pipeline: List[Dict[str, Any]]) -> bytes:
+    """
+    Esegue nell'archivio una pipeline già validata e ne restituisce il risultato JSON, fino a
+    `max_result_bytes`.
+    """
+    limits = resources.settings.aggregation
+    try:
+        return await resources.async_storage.aggregate(db_name, collection_name, pipeline, aggregate_options(limits),
+                                                       limits.max_result_bytes)
+    except ResultTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Il risultato supera {limits.max_result_bytes} byte: riduci i campi con $project o usa $limit",
+        )
+    except StorageError as e:
+        # Con uno stato l'archivio ha rifiutato la pipeline; senza, non è raggiungibile
+        if e.status_code is None:
+            raise
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nell'aggregazione: {str(e)}")
+
+
+async def count_documents(resources: Resources, db_name: str, filter_data: Dict[str, Any]) -> int:
+    """
+    Documenti del database che corrispondono al filtro: un `$count` per collezione, eseguiti in
+    parallelo fino a `aggregation.count_concurrency`. I conteggi sono attese su `async_storage`
+    (driver asincrono o thread `storage_threads` del worker): nessun thread creato per la richiesta.
+    """
+    collections = await resources.async_storage.list_collections(db_name)
+    pipeline = [{"$match": filter_data}, {"$count": "total"}]
+    limiter = asyncio.Semaphore(resources.settings.aggregation.count_concurrency)
+
+    async def count(collection_name: str) -> int:
+        async with limiter:
+            result = json.loads(await run_aggregation(resources, db_name, collection_name, pipeline))
+        return result[0]["total"] if result else 0
+
+    return sum(await asyncio.gather(*(count(collection_name) for collection_name in collections)))
+
+
+@router.post("/{db_name}/{collection_name}/aggregate", summary="Esegue un'aggregazione su una collezione",
+             response_description="Risultato dell'aggregazione")
+async def aggregate(db_name: str, collection_name: str, request: AggregationRequest,
+                    current_user: Principal = Depends(get_current_principal),
+                    resources: Resources = Depends(get_resources)):
+    """
+    Esegue sul database una pipeline di aggregazione e restituisce solo il risultato ridotto
+    (conteggi, raggruppamenti, somme), senza trasferire i documenti della collezione.
+
+    **Restrizioni:**
+    - Stadi ammessi: `$match`, `$group`, `$count`, `$sort`, `$limit`, `$skip`, `$project`, `$unwind`,
+      `$addFields`, `$set`, `$unset`, `$sortByCount`, `$bucket`, `$bucketAuto`, `$replaceRoot`.
+    - Operatori JavaScript (`$where`, `$function`, `$accumulator`) non ammessi.
+    - Numero di stadi, documenti restituiti, dimensione della risposta e tempo di esecuzione limitati
+      dalla sezione `aggregation` della configurazione; nessun uso del disco per gli stadi.
+
+    **Eccezioni:**
+    - `400 Bad Request`: Se la pipeline non è ammessa, l'aggregazione fallisce o il risultato è troppo grande.
+    - `403 Forbidden`: Se l'utente non ha accesso in lettura al database.
+    """
+    await verify_database_access(resources, db_name, current_user, READ)
+    try:
+        pipeline = validate_pipeline(request.pipeline, resources.settings.aggregation)
+    except PipelineError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    try:
+        # Il risultato è già JSON: inoltrato senza decodificarlo e serializzarlo di nuovo
+        return Response(content=await run_aggregation(resources, db_name, collection_name, pipeline),
+                        media_type="application/json")
+    except StorageError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Errore nell'aggregazione: {str(e)}")
+
+
+@router.get("/{db_name}/{collection_name}/export", summary="Esporta i documenti di una collezione in NDJSON",
+            response_description="Flusso NDJSON, un documento per riga, eventualmente compresso con gzip")
+def export_collection(db_name: str, collection_name: str, gzip: bool = False,
+                      current_user: Principal = Depends(get_current_principal),
+                      resources: Resources = Depends(get_resources)):
+    """
+    Esporta tutti i documenti della collezione, ordinati per `_id`, come NDJSON (`application/x-ndjson`)
+    o, con `gzip=true`, come NDJSON compresso (`application/gzip`). I documenti vengono letti
+    dall'archivio a pagine di `transfer.export_page_size` e inviati man mano, senza caricare la collezione
+    in memoria.
+
+    **Eccezioni:**
+    - `403 Forbidden`: Se l'utente non ha accesso in lettura al database.
+    - `502 Bad Gateway`: Se la lettura della prima pagina fallisce; un errore successivo interrompe il flusso.
+    """
+    verify_user_database(resources, db_name, current_user, READ)
+    chunks = export_documents(resources.storage, db_name, collection_name, resources.settings.transfer.export_page_size,
+                              aggregate_options(resources.settings.aggregation))
+    try:
+        # La prima pagina viene letta prima di rispondere, così che un errore iniziale abbia il suo codice HTTP
+        first_page = next(chunks, b"")
+    except StorageError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Errore nell'esportazione: {str(e)}")
+    chunks = itertools.chain([first_page], chunks)
+    filename = f"{db_name}.{collection_name}.ndjson"
+    if gzip:
+        return StreamingResponse(gzip_chunks(chunks), media_type="application/gzip",
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}.gz"'})
+    return StreamingResponse(chunks, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@router.post("/{db_name}/{collection_name}/import", summary="Importa documenti NDJSON in una collezione",
+             response_description="Flusso NDJSON con l'avanzamento dell'importazione")
+async def import_collection(db_name: str, collection_name: str, request: Request, resume_from: int = 0,
+                            preserve_ids: bool = False, current_user: Principal = Depends(get_current_principal),
+                            resources: Resources = Depends(get_resources)):
+    """
+    Importa i documenti inviati nel corpo della richiesta come NDJSON, anche compresso con gzip
+    (riconosciuto automaticamente). Il corpo viene letto a blocchi e i documenti inseriti a gruppi
+    di `transfer.import_batch_size`, per cui la dimensione del file non è limitata dalla memoria.
+
+    La risposta è un flusso NDJSON di oggetti:
+    - `{"type": "progress", "committed": n, "inserted": m}` dopo ogni gruppo inserito;
+    - `{"type": "done", "committed": n, "inserted": m}` al termine;
+    - `{"type": "error", "detail": ..., "resume_from": n}` se una riga non è valida o un inserimento
+      fallisce: le righe fino a `resume_from` sono state inserite e l'importazione può essere ripresa
+      inviando di nuovo il file con quel valore di `resume_from`.
+
+    Senza `preserve_ids` il campo `_id` dei documenti viene ignorato e il gateway ne assegna uno nuovo.
+    Al termine gli iscritti al change feed della collezione ricevono un evento `reset`.
+
+    **Eccezioni:**
+    - `400 Bad Request`: Se `resume_from` è negativo.
+    - `403 Forbidden`: Se l'utente non ha accesso in scrittura al database.
+    """
+    await verify_database_access(resources, db_name, current_user, WRITE)
+    if resume_from < 0:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="resume_from non può essere negativo")
+
+    async def progress():
+        try:
+            async for line in import_documents(resources.storage, request.stream(), db_name, collection_name,
+                                               resources.settings.transfer, resume_from, preserve_ids):
+                yield line
+        finally:
+            # I singoli inserimenti non generano eventi: gli iscritti rileggono la collezione
+            resources.change_feed.publish("reset", db_name, collection_name, None)
+
+    return ProgressResponse(progress(), media_type="application/x-ndjson")
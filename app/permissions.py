@@ -0,0 +1,45 @@
+import threading
+from typing import Dict, Iterable
+
+# Codici di permesso usati per l'accesso delegato ai database degli utenti gestiti
+READ_ACCESS = "read_access"
+WRITE_ACCESS = "write_access"
+ADMIN_ACCESS = "admin_access"
+
+
+class PermissionRegistry:
+    """
+    Assegna a ogni codice di permesso un bit, la prima volta che viene incontrato, così che
+    un insieme di permessi sia rappresentato da un intero e il controllo sia un AND bit a bit.
+    """
+
+    def __init__(self):
+        self._bits: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def bit(self, code: str) -> int:
+        bit = self._bits.get(code)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.setdefault(code, 1 << len(self._bits))
+        return bit
+
+    def mask(self, codes: Iterable[str]) -> int:
+        mask = 0
+        for code in codes:
+            mask |= self.bit(code)
+        return mask
+
+
+permission_registry = PermissionRegistry()
+
+READ = permission_registry.bit(READ_ACCESS)
+WRITE = permission_registry.bit(WRITE_ACCESS)
+ADMIN = permission_registry.bit(ADMIN_ACCESS)
+
+
+def allows(granted: int, required: int) -> bool:
+    """
+    Vero se i permessi concessi includono tutti quelli richiesti; `admin_access` li include tutti.
+    """
+    return bool(granted & ADMIN) or granted & required == required
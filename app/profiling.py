@@ -0,0 +1,192 @@
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+from app.settings import ProfilingSettings
+
+# Header con cui il client richiede la profilazione di una singola richiesta, inviando il segreto configurato
+PROFILE_HEADER = "X-Profile"
+# Header di risposta con il nome del file di profilo generato
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+# Frame "foglia" che indicano un thread inattivo (worker in attesa, event loop in select)
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+}
+
+# Intervalli registrati per la richiesta corrente: lista di (nome, durata in ms)
+_request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("_request_spans", default=None)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Misura la durata del blocco e la registra come intervallo `name` della richiesta corrente.
+    Fuori da una richiesta (script, test) non registra nulla.
+    """
+    spans = _request_spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.append((name, (time.perf_counter() - start) * 1000))
+
+
+def format_server_timing(spans: List[Tuple[str, float]], total_ms: float) -> str:
+    """
+    Converte gli intervalli nel formato dell'header `Server-Timing`.
+    Gli intervalli con lo stesso nome vengono sommati mantenendo l'ordine di prima occorrenza.
+    """
+    durations: Dict[str, float] = {}
+    for name, duration in spans:
+        durations[name] = durations.get(name, 0.0) + duration
+    entries = [f"{name};dur={duration:.2f}" for name, duration in durations.items()]
+    entries.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(entries)
+
+
+class StackSampler:
+    """
+    Profilatore statistico: campiona a intervalli regolari gli stack di tutti i thread attivi
+    e li accumula in formato "folded" (una riga per stack, pronta per flamegraph.pl o speedscope).
+
+    Gli endpoint sincroni vengono eseguiti nel threadpool, per cui un profilatore legato al solo
+    thread corrente (cProfile) non vedrebbe il lavoro della richiesta. I thread inattivi vengono
+    scartati; eventuali richieste concorrenti compaiono nello stesso profilo.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = _fold_stack(frame)
+                if stack:
+                    self.samples[stack] += 1
+
+
+def _fold_stack(frame) -> Optional[str]:
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+        return None
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+def write_folded_profile(samples: Counter, output_dir: str, method: str, path: str) -> str:
+    """
+    Scrive i campioni in un file `.folded` nella directory di output e ne restituisce il nome.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    slug = path.strip("/").replace("/", "_") or "root"
+    filename = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{method}-{slug}-{uuid.uuid4().hex[:8]}.folded"
+    with open(os.path.join(output_dir, filename), "w") as profile_file:
+        for stack, count in samples.most_common():
+            profile_file.write(f"{stack} {count}\n")
+    return filename
+
+
+class ServerTimingMiddleware:
+    """
+    Middleware ASGI che aggiunge l'header `Server-Timing` e, se abilitata in configurazione,
+    profila le richieste.
+
+    La profilazione parte quando il client invia nell'header `X-Profile` il segreto configurato
+    (`profiling.secret`; senza segreto l'header viene ignorato) oppure, in modo casuale, per la
+    frazione `sample_rate` delle richieste. L'arresto del profilatore e la scrittura del file
+    avvengono nel threadpool, fuori dall'event loop.
+    """
+
+    def __init__(self, app, profiling: ProfilingSettings):
+        self.app = app
+        self.profiling = profiling
+
+    def _profile_requested(self, headers: Headers) -> bool:
+        secret = self.profiling.secret
+        requested = headers.get(PROFILE_HEADER)
+        if secret and requested is not None and hmac.compare_digest(requested.encode(), secret.encode()):
+            return True
+        return random.random() < self.profiling.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        spans: List[Tuple[str, float]] = []
+        spans_token = _request_spans.set(spans)
+
+        sampler: Optional[StackSampler] = None
+        if self.profiling.enabled and self._profile_requested(Headers(scope=scope)):
+            sampler = StackSampler(self.profiling.interval_ms / 1000)
+            sampler.start()
+
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            nonlocal sampler
+            if message["type"] == "http.response.start":
+                total_ms = (time.perf_counter() - start) * 1000
+                headers = MutableHeaders(scope=message)
+                headers["Server-Timing"] = format_server_timing(spans, total_ms)
+                headers["Timing-Allow-Origin"] = "*"
+                if sampler is not None:
+                    samples = await run_in_threadpool(sampler.stop)
+                    sampler = None
+                    if samples:
+                        headers[PROFILE_FILE_HEADER] = await run_in_threadpool(
+                            write_folded_profile, samples, self.profiling.output_dir, scope["method"], scope["path"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_spans.reset(spans_token)
+            # Richiesta terminata senza risposta (errore, disconnessione)
+            if sampler is not None:
+                await run_in_threadpool(sampler.stop)
+
+
+def register(app: FastAPI, profiling: ProfilingSettings):
+    """
+    Aggiunge all'applicazione il middleware che espone l'header `Server-Timing` e,
+    se abilitata in configurazione, la profilazione delle richieste.
+    """
+    app.add_middleware(ServerTimingMiddleware, profiling=profiling)
@@ -0,0 +1,83 @@
+"""
+Risorse condivise dalle richieste di un worker: archivio dei dati, chiavi di firma, archivio dei token,
+canale tra i worker, cache dei `Principal`, indice delle relazioni, change feed e coda dei job.
+
+Le risorse vengono costruite dal ciclo di vita dell'applicazione in ogni worker (dopo il fork, anche
+con il preload dell'app) a partire dalle impostazioni dell'app, salvate in `app.state.resources` e
+raggiunte dalle rotte con la dipendenza `get_resources`. L'import dei moduli non apre file, socket
+o connessioni.
+"""
+from functools import partial
+
+from fastapi import Request
+
+from app.async_storage import create_async_storage
+from app.cache import TTLCache
+from app.change_feed import ChangeFeed
+from app.gateway import GatewaySession
+from app.hierarchy import HierarchyIndex, fetch_users
+from app.invalidation import DATABASE_TOPIC, RELATIONS_TOPIC, RESYNC_TOPIC, USER_TOPIC, InvalidationBus
+from app.jobs import JobQueue, JobStore
+from app.settings import Settings
+from app.signing import KeyRing
+from app.storage import create_storage
+from app.token_store import create_token_store
+
+
+class Resources:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        # Sessione usata da tutte le chiamate al gateway
+        self.session = GatewaySession(settings.gateway_pool_size, settings.gateway_timeout_seconds)
+        # Archivio dei dati (gateway, MongoDB diretto o memoria, secondo `storage_backend`)
+        self.storage = create_storage(settings, self.session)
+        # Lo stesso archivio per le rotte `async def` sui documenti: driver asincrono o thread dedicati
+        self.async_storage = create_async_storage(settings, self.storage)
+        # Chiavi di firma dei token: `secret_key` per HS256, file PEM con rotazione per RS256/ES256
+        self.key_ring = KeyRing(settings.algorithm, settings.secret_key, settings.jwt_keys_dir,
+                                settings.jwt_active_kid, settings.jwt_keys_reload_seconds)
+        # Archivio dei token emessi (collezione dell'archivio dei dati o file SQLite locale)
+        self.token_store = create_token_store(settings.token_store_backend, self.storage, settings.token_store_path)
+        # Canale per propagare le invalidazioni (logout, cambio password, database eliminati) a tutti i worker
+        self.invalidation_bus = InvalidationBus(settings.invalidation_socket_dir)
+        # Cache dei `Principal` per username, svuotata dalle notifiche di invalidazione
+        self.principal_cache: TTLCache = TTLCache(settings.principal_cache_ttl_seconds, settings.principal_cache_size)
+        self.hierarchy_index = HierarchyIndex(partial(fetch_users, self.storage), settings.hierarchy_index_ttl_seconds)
+        self.change_feed = ChangeFeed(self.invalidation_bus, settings.change_feed_buffer_size,
+                                      settings.change_feed_max_subscribers)
+        self.job_queue = JobQueue(JobStore(settings.jobs.store_path), self.invalidation_bus, settings.jobs)
+
+        bus = self.invalidation_bus
+        for topic in (USER_TOPIC, DATABASE_TOPIC):
+            bus.subscribe(topic, lambda payload: self.principal_cache.pop(payload["username"]))
+        # Proprietari dei database e relazioni dell'indice
+        bus.subscribe(DATABASE_TOPIC, lambda payload: self.hierarchy_index.mark_dirty(payload["username"]))
+        bus.subscribe(RELATIONS_TOPIC, self.hierarchy_index.relations_changed)
+        bus.subscribe(RESYNC_TOPIC, lambda payload: self.principal_cache.clear())
+        bus.subscribe(RESYNC_TOPIC, lambda payload: self.hierarchy_index.invalidate())
+
+    def start(self):
+        """
+        Apre il canale tra i worker e avvia change feed e coda dei job.
+        """
+        self.invalidation_bus.start()
+        self.change_feed.start()
+        self.job_queue.start()
+
+    def stop(self):
+        """
+        Arresta coda, change feed e canale e chiude gli archivi sincroni; `async_storage` viene
+        chiuso dal ciclo di vita, nel loop degli eventi.
+        """
+        self.job_queue.stop()
+        self.change_feed.stop()
+        self.invalidation_bus.stop()
+        self.token_store.close()
+        self.storage.close()
+
+
+def get_resources(request: Request) -> Resources:
+    """
+    Dipendenza con le risorse del worker che serve la richiesta.
+    """
+    return request.app.state.resources
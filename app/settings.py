@@ -0,0 +1,132 @@
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+# File di configurazione predefinito (relativo alla directory di lavoro), sovrascrivibile con CONFIG_FILE
+DEFAULT_CONFIG_FILE = "config.json"
+
+# Variabili d'ambiente con un nome diverso da quello del campo in maiuscolo
+_ENV_ALIASES = {
+    "mongodb_service_url": "MONGO_SERVICE_URL",
+}
+
+
+class ProfilingSettings(BaseModel):
+    enabled: bool = Field(False, description="Abilita la profilazione delle richieste.")
+    sample_rate: float = Field(0.0, ge=0, le=1, description="Frazione di richieste profilate automaticamente.")
+    interval_ms: float = Field(2, gt=0, description="Intervallo di campionamento del profilatore.")
+    output_dir: str = Field("profiles", description="Directory in cui vengono scritti i profili.")
+    secret: Optional[str] = Field(
+        None, description="Segreto da inviare nell'header `X-Profile` per profilare una richiesta (None: header ignorato).")
+
+
+class AggregationSettings(BaseModel):
+    max_stages: int = Field(10, ge=1, description="Numero massimo di stadi di una pipeline di aggregazione.")
+    max_results: int = Field(1000, ge=1, description="Documenti massimi restituiti da un'aggregazione.")
+    max_result_bytes: int = Field(1024 * 1024, ge=1, description="Dimensione massima della risposta di un'aggregazione.")
+    max_time_ms: int = Field(5000, ge=1, description="Tempo massimo di esecuzione di un'aggregazione sul database.")
+    count_concurrency: int = Field(4, ge=1, description="Conteggi per collezione eseguiti in parallelo dalla ricerca con `count`.")
+
+
+class TransferSettings(BaseModel):
+    export_page_size: int = Field(1000, ge=1, description="Documenti letti dal gateway per ogni pagina dell'esportazione.")
+    import_batch_size: int = Field(500, ge=1, description="Documenti inseriti per ogni gruppo dell'importazione.")
+    import_concurrency: int = Field(8, ge=1, description="Inserimenti concorrenti verso il gateway durante l'importazione.")
+    import_max_line_bytes: int = Field(1024 * 1024, ge=1, description="Dimensione massima di una riga del file importato.")
+
+
+class JobSettings(BaseModel):
+    store_path: str = Field("data/jobs.sqlite3", description="File del database SQLite dei job.")
+    workers: int = Field(2, ge=1, description="Thread che eseguono i job in ogni worker.")
+    per_user_concurrency: int = Field(1, ge=1, description="Job eseguiti contemporaneamente per ogni utente.")
+    max_pending_per_user: int = Field(20, ge=1, description="Job non terminati ammessi per ogni utente.")
+    max_attempts: int = Field(3, ge=1, description="Esecuzioni di un job prima di considerarlo fallito.")
+    retry_delay_seconds: float = Field(2, ge=0, description="Attesa prima del secondo tentativo, raddoppiata ai successivi.")
+    lease_seconds: float = Field(300, gt=0, description="Durata di un'esecuzione oltre la quale il job viene ripreso.")
+    poll_seconds: float = Field(1, gt=0, description="Intervallo di controllo della coda in assenza di notifiche.")
+    retention_days: float = Field(7, ge=0, description="Giorni di conservazione dei job terminati.")
+
+
+class Settings(BaseModel):
+    mongodb_service_url: str = Field(..., description="URL del servizio gateway MongoDB.")
+    mongodb_host: str = Field("localhost", description="Host MongoDB registrato per i database creati dagli utenti.")
+    mongodb_port: int = Field(27017, description="Porta MongoDB registrata per i database creati dagli utenti.")
+    gateway_atomic_updates: Optional[bool] = Field(
+        None, description="Il gateway supporta `update_one` con operatori atomici (None: rilevato alla prima scrittura).")
+    storage_backend: Literal["gateway", "mongodb", "memory"] = Field(
+        "gateway", description="Archivio dei dati: gateway HTTP, MongoDB diretto o memoria del processo.")
+    mongodb_uri: str = Field("mongodb://localhost:27017", description="URI di MongoDB per il backend `mongodb`.")
+    mongodb_pool_size: int = Field(32, ge=1, description="Connessioni mantenute verso MongoDB per processo.")
+    mongodb_timeout_seconds: float = Field(30, gt=0, description="Timeout delle operazioni su MongoDB.")
+    storage_threads: int = Field(
+        32, ge=1, description="Chiamate bloccanti al gateway (o alla memoria) eseguite in parallelo dalle rotte sui documenti.")
+    threadpool_threads: int = Field(40, ge=1, description="Thread di AnyIO per le rotte e le dipendenze sincrone.")
+    secret_key: str = Field("your_secret_key", description="Chiave per la firma dei token JWT.")
+    algorithm: str = Field("HS256", description="Algoritmo di firma dei token JWT (HS256, RS256 o ES256).")
+    jwt_keys_dir: str = Field("keys", description="Directory delle chiavi private `<kid>.pem` per RS256/ES256.")
+    jwt_active_kid: Optional[str] = Field(None, description="Chiave di firma attiva (default: la più recente).")
+    jwt_keys_reload_seconds: float = Field(30, ge=0, description="Intervallo di controllo della directory delle chiavi.")
+    jwks_max_age_seconds: int = Field(300, ge=0, description="Durata in cache del documento JWKS per i client.")
+    access_token_expire_minutes: int = Field(30, description="Durata dei token di accesso.")
+    refresh_token_expire_days: int = Field(7, description="Durata dei token di refresh.")
+    token_store_backend: Literal["gateway", "sqlite"] = Field("gateway", description="Archivio dei token emessi.")
+    token_store_path: str = Field("data/tokens.sqlite3", description="File del database SQLite dei token.")
+    invalidation_socket_dir: str = Field("/tmp/standard_backend-invalidation",
+                                         description="Directory dei socket del canale di invalidazione.")
+    gateway_pool_size: int = Field(32, ge=1, description="Connessioni HTTP mantenute verso il gateway.")
+    gateway_timeout_seconds: float = Field(30, gt=0, description="Timeout delle chiamate al gateway.")
+    principal_cache_ttl_seconds: float = Field(30, ge=0, description="Durata in cache dei dati di autenticazione (0 = disabilitata).")
+    principal_cache_size: int = Field(10000, ge=1, description="Numero massimo di utenti in cache.")
+    hierarchy_index_ttl_seconds: float = Field(
+        30, ge=0, description="Intervallo di ricostruzione completa dell'indice delle relazioni, per le modifiche senza notifica.")
+    change_feed_buffer_size: int = Field(100, ge=1, description="Eventi in coda per ogni client del change feed.")
+    change_feed_max_subscribers: int = Field(1000, ge=1, description="Client del change feed per worker.")
+    change_feed_heartbeat_seconds: float = Field(15, gt=0, description="Intervallo dei messaggi keep-alive del change feed.")
+    warmup_enabled: bool = Field(True, description="Prepara connessioni e modelli prima di accettare richieste.")
+    warmup_connections: int = Field(4, ge=0, description="Connessioni al gateway aperte all'avvio.")
+    profiling: ProfilingSettings = Field(default_factory=ProfilingSettings)
+    aggregation: AggregationSettings = Field(default_factory=AggregationSettings)
+    transfer: TransferSettings = Field(default_factory=TransferSettings)
+    jobs: JobSettings = Field(default_factory=JobSettings)
+
+
+def _env_overrides(model: type, prefix: str = "") -> Dict[str, Any]:
+    """
+    Valori presi dall'ambiente: il nome della variabile è quello del campo in maiuscolo,
+    preceduto dal nome del gruppo per le impostazioni annidate (es. PROFILING_ENABLED).
+    """
+    overrides: Dict[str, Any] = {}
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            nested = _env_overrides(annotation, f"{prefix}{name.upper()}_")
+            if nested:
+                overrides[name] = nested
+            continue
+        env_name = f"{prefix}{name.upper()}" if prefix else _ENV_ALIASES.get(name, name.upper())
+        if env_name in os.environ:
+            overrides[name] = os.environ[env_name]
+    return overrides
+
+
+def load_settings(config_file: Optional[str] = None) -> Settings:
+    """
+    Legge la configurazione dal file JSON e applica le variabili d'ambiente.
+    """
+    config_file = config_file or os.environ.get("CONFIG_FILE", DEFAULT_CONFIG_FILE)
+    with open(config_file) as file:
+        values = json.load(file)
+    for name, value in _env_overrides(Settings).items():
+        if isinstance(value, dict):
+            values[name] = {**values.get(name, {}), **value}
+        else:
+            values[name] = value
+    return Settings(**values)
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    return load_settings()
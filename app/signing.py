@@ -0,0 +1,252 @@
+"""
+Firma e verifica dei token JWT con un insieme di chiavi identificate da `kid`.
+
+Con un algoritmo simmetrico (HS256) si usa `secret_key` come in passato. Con RS256 o ES256 le chiavi
+private sono file PEM `<kid>.pem` nella directory `jwt_keys_dir`: i token vengono firmati con la chiave
+attiva e verificati con la chiave indicata dall'header `kid`, per cui durante una rotazione restano validi
+anche i token firmati con le chiavi precedenti. Le chiavi pubbliche sono esposte in formato JWKS, così
+che gli altri servizi possano verificare i token senza conoscere alcun segreto.
+
+Generazione di una nuova chiave (diventa attiva alla successiva rilettura della directory):
+    python -m app.signing generate --algorithm RS256 --dir keys
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import JWTError, jwk, jwt
+
+logger = logging.getLogger(__name__)
+
+SYMMETRIC_ALGORITHMS = ("HS256", "HS384", "HS512")
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256")
+
+# Estensione dei file delle chiavi nella directory `jwt_keys_dir`
+KEY_FILE_SUFFIX = ".pem"
+
+
+class SigningKey:
+    """
+    Chiave del key ring: la chiave privata è assente per le chiavi conservate solo per la verifica.
+    """
+
+    def __init__(self, kid: Optional[str], algorithm: str, verify_key: Any, signing_key: Any = None,
+                 public_jwk: Optional[Dict[str, str]] = None, created_at: float = 0.0):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.verify_key = verify_key
+        self.signing_key = signing_key
+        self.public_jwk = public_jwk
+        self.created_at = created_at
+
+
+def _key_algorithm(key: Any) -> str:
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return "RS256"
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and key.curve.name == "secp256r1":
+        return "ES256"
+    raise ValueError(f"Tipo di chiave non supportato: {type(key).__name__}")
+
+
+def load_key_file(path: str) -> SigningKey:
+    """
+    Legge una chiave PEM privata (usabile per firmare) o pubblica (solo verifica).
+    Il `kid` è il nome del file senza estensione.
+    """
+    kid = os.path.basename(path)[:-len(KEY_FILE_SUFFIX)]
+    with open(path, "rb") as key_file:
+        data = key_file.read()
+    if b"PRIVATE KEY" in data:
+        private_key = serialization.load_pem_private_key(data, password=None)
+        public_key = private_key.public_key()
+    else:
+        private_key = None
+        public_key = serialization.load_pem_public_key(data)
+    algorithm = _key_algorithm(public_key)
+    public_pem = public_key.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    verify_key = jwk.construct(public_pem, algorithm)
+    signing_key = jwk.construct(data, algorithm) if private_key is not None else None
+    public_jwk = {**verify_key.to_dict(), "kid": kid, "use": "sig", "alg": algorithm}
+    return SigningKey(kid, algorithm, verify_key, signing_key, public_jwk, os.stat(path).st_mtime)
+
+
+class KeyRing:
+    """
+    Chiavi di firma e verifica dei token.
+
+    La directory delle chiavi viene ricontrollata al più ogni `reload_interval` secondi: aggiungere un
+    file ruota la chiave di firma in tutti i worker senza riavvio, rimuoverlo ritira la chiave e invalida
+    i token ancora firmati con essa. La chiave attiva è `active_kid` se indicata, altrimenti la chiave
+    privata più recente con l'algoritmo configurato.
+    """
+
+    def __init__(self, algorithm: str, secret_key: str, keys_dir: str, active_kid: Optional[str] = None,
+                 reload_interval: float = 30):
+        if algorithm not in SYMMETRIC_ALGORITHMS + ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"Algoritmo JWT non supportato: {algorithm}")
+        self.algorithm = algorithm
+        self.keys_dir = keys_dir
+        self.active_kid = active_kid
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._fingerprint: Optional[Tuple] = None
+        self._keys: Dict[Optional[str], SigningKey] = {}
+        self._active: Optional[SigningKey] = None
+        self._jwks: Tuple[bytes, str] = (b"", "")
+        if self.symmetric:
+            key = SigningKey(None, algorithm, jwk.construct(secret_key, algorithm))
+            key.signing_key = key.verify_key
+            self._install({None: key}, key)
+        else:
+            self._reload(force=True)
+
+    @property
+    def symmetric(self) -> bool:
+        return self.algorithm in SYMMETRIC_ALGORITHMS
+
+    # ----------------------------------------------------------------------------------
+    # Caricamento delle chiavi
+    # ----------------------------------------------------------------------------------
+    def _scan(self) -> Tuple:
+        entries = []
+        with os.scandir(self.keys_dir) as directory:
+            for entry in directory:
+                if entry.name.endswith(KEY_FILE_SUFFIX) and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(sorted(entries))
+
+    def _reload(self, force: bool = False):
+        if self.symmetric:
+            return
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                fingerprint = self._scan()
+            except FileNotFoundError:
+                if force:
+                    raise RuntimeError(f"Directory delle chiavi JWT non trovata: {self.keys_dir}")
+                logger.error("Directory delle chiavi JWT non trovata: %s, uso le chiavi già caricate", self.keys_dir)
+                return
+            if fingerprint == self._fingerprint:
+                return
+            keys = {}
+            for name, _, _ in fingerprint:
+                try:
+                    key = load_key_file(os.path.join(self.keys_dir, name))
+                except (OSError, ValueError) as error:
+                    logger.error("Chiave JWT %s ignorata: %s", name, error)
+                    continue
+                keys[key.kid] = key
+            active = self._select_active(keys)
+            if active is None:
+                if force:
+                    raise RuntimeError(f"Nessuna chiave privata {self.algorithm} in {self.keys_dir}")
+                logger.error("Nessuna chiave privata %s in %s, uso le chiavi già caricate", self.algorithm, self.keys_dir)
+                return
+            self._fingerprint = fingerprint
+            self._install(keys, active)
+            logger.info("Chiavi JWT caricate: %s (attiva: %s)", ", ".join(sorted(keys)), active.kid)
+
+    def _select_active(self, keys: Dict[Optional[str], SigningKey]) -> Optional[SigningKey]:
+        if self.active_kid is not None:
+            key = keys.get(self.active_kid)
+            return key if key is not None and key.signing_key is not None else None
+        candidates = [key for key in keys.values() if key.signing_key is not None and key.algorithm == self.algorithm]
+        return max(candidates, key=lambda key: (key.created_at, key.kid), default=None)
+
+    def _install(self, keys: Dict[Optional[str], SigningKey], active: SigningKey):
+        document = {"keys": [keys[kid].public_jwk for kid in sorted(k for k in keys if k is not None)]}
+        body = json.dumps(document, separators=(",", ":")).encode()
+        # Sostituzione in blocco: i lettori vedono sempre un insieme coerente di chiavi
+        self._keys, self._active = keys, active
+        self._jwks = (body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"')
+
+    # ----------------------------------------------------------------------------------
+    # Firma e verifica
+    # ----------------------------------------------------------------------------------
+    def encode(self, claims: Dict[str, Any]) -> str:
+        self._reload()
+        active = self._active
+        headers = {"kid": active.kid} if active.kid is not None else None
+        return jwt.encode(claims, active.signing_key, algorithm=active.algorithm, headers=headers)
+
+    def decode(self, token: str) -> Dict[str, Any]:
+        """
+        Verifica firma e scadenza del token con la chiave indicata dal suo `kid`.
+        Solleva `JWTError` se il token non è valido o la chiave è sconosciuta.
+        """
+        self._reload()
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self._keys.get(kid)
+        if key is None:
+            raise JWTError("Chiave di firma sconosciuta")
+        return jwt.decode(token, key.verify_key, algorithms=[key.algorithm])
+
+    def jwks(self) -> Tuple[bytes, str]:
+        """
+        Documento JWKS con le chiavi pubbliche già serializzato, e il relativo ETag.
+        """
+        self._reload()
+        return self._jwks
+
+    def kids(self) -> List[str]:
+        return sorted(kid for kid in self._keys if kid is not None)
+
+
+def generate_key(algorithm: str, keys_dir: str, kid: Optional[str] = None) -> str:
+    """
+    Genera una nuova chiave privata nella directory delle chiavi e ne restituisce il percorso.
+    Il file viene scritto con un nome temporaneo e poi rinominato, così che i worker non leggano mai
+    una chiave incompleta.
+    """
+    if algorithm == "RS256":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm == "ES256":
+        private_key = ec.generate_private_key(ec.SECP256R1())
+    else:
+        raise ValueError(f"Algoritmo non supportato per la generazione di chiavi: {algorithm}")
+    kid = kid or f"{algorithm.lower()}-{datetime.utcnow():%Y%m%d%H%M%S}"
+    data = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption())
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, kid + KEY_FILE_SUFFIX)
+    temporary_path = os.path.join(keys_dir, f".{kid}.tmp")
+    descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as key_file:
+        key_file.write(data)
+    os.replace(temporary_path, path)
+    return path
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Gestione delle chiavi di firma JWT")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="Genera una nuova chiave privata")
+    generate.add_argument("--algorithm", choices=ASYMMETRIC_ALGORITHMS, default="RS256")
+    generate.add_argument("--dir", default="keys", help="Directory delle chiavi")
+    generate.add_argument("--kid", help="Identificativo della chiave (default: algoritmo e data)")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        print(generate_key(args.algorithm, args.dir, args.kid))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,639 @@
+"""
+Accesso ai dati: database degli utenti (`database`, con `users_collection` e `tokens_collection`)
+e database creati dagli utenti.
+
+Tre implementazioni dell'interfaccia `Storage`, scelte con `storage_backend`:
+- `GatewayStorage`: il servizio gateway HTTP in `MONGO_SERVICE_URL` (comportamento storico);
+- `MongoStorage`: MongoDB direttamente con il driver `pymongo` e il suo pool di connessioni, senza
+  il passaggio HTTP e la doppia serializzazione JSON del gateway;
+- `MemoryStorage` (`app.memory_storage`): dati in memoria nel processo, per prove e benchmark.
+
+Le chiamate sono sincrone e bloccanti (`requests`, `pymongo`): le rotte che le usano sono funzioni
+`def`, eseguite da FastAPI nel threadpool, oppure le chiamano con `run_in_threadpool`; una rotta
+`async def` non deve mai chiamarle direttamente, perché bloccherebbe il loop degli eventi. Le rotte
+`async def` sui documenti usano invece `app.async_storage`.
+Gli identificativi dei documenti sono sempre stringhe e i documenti restituiti contengono solo
+tipi JSON, come nelle risposte del gateway.
+"""
+import json
+import logging
+import sys
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import requests
+
+from app.settings import Settings
+
+try:
+    import pymongo
+    from bson import ObjectId
+    from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure, PyMongoError
+except ImportError:  # il backend `mongodb` è opzionale
+    pymongo = None
+
+logger = logging.getLogger(__name__)
+
+# Database con le collezioni degli utenti e dei token
+USERS_DATABASE = "database"
+USERS_COLLECTION = "users_collection"
+TOKENS_COLLECTION = "tokens_collection"
+
+# Tipi BSON di `_id` percorsi da `find_page`, nell'ordine in cui MongoDB li confronta
+ID_TYPES = ("number", "string", "object", "objectId", "bool", "date")
+# Tipi che nel JSON del gateway arrivano come stringhe, con l'operatore che li riconverte
+_CONVERTED_ID_TYPES = {"objectId": "$toObjectId", "date": "$toDate"}
+
+# Posizione di `find_page`: indice in `ID_TYPES` e ultimo id restituito, nel suo tipo nativo
+PageCursor = Tuple[int, Any]
+
+
+class StorageError(Exception):
+    """
+    L'archivio non è raggiungibile o ha rifiutato l'operazione. `status_code` è lo stato HTTP
+    della risposta del gateway, se disponibile.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UnsupportedOperation(StorageError):
+    """
+    L'archivio non offre l'operazione richiesta.
+    """
+
+
+class PartialInsert(StorageError):
+    """
+    Di un inserimento multiplo sono stati inseriti solo i primi `inserted` documenti, nell'ordine ricevuto.
+    """
+
+    def __init__(self, message: str, inserted: int, status_code: Optional[int] = None):
+        super().__init__(message, status_code)
+        self.inserted = inserted
+
+
+class ResultTooLarge(StorageError):
+    """
+    Il risultato di un'aggregazione supera la dimensione massima richiesta.
+    """
+
+
+class ResultBuffer:
+    """
+    Lista JSON costruita un documento alla volta, interrotta con `ResultTooLarge` appena supera `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.body = bytearray(b"[")
+
+    def add(self, document: Dict[str, Any]):
+        if len(self.body) > 1:
+            self.body.extend(b",")
+        self.body.extend(json.dumps(document, default=str).encode())
+        if len(self.body) > self.max_bytes:
+            raise ResultTooLarge(f"Il risultato supera {self.max_bytes} byte")
+
+    def result(self) -> bytes:
+        return bytes(self.body + b"]")
+
+
+def encode_results(documents: Iterable[Dict[str, Any]], max_bytes: int) -> bytes:
+    """
+    Lista JSON dei documenti, interrotta con `ResultTooLarge` appena supera `max_bytes`.
+    """
+    buffer = ResultBuffer(max_bytes)
+    for document in documents:
+        buffer.add(document)
+    return buffer.result()
+
+
+class Storage(ABC):
+    # L'archivio applica `update_one` con operatori atomici (`$set`, `$inc`, `$push`, `$pull`)
+    supports_update_operators = True
+
+    # --- Database e collezioni ---
+    @abstractmethod
+    def create_database(self, db_name: str, credentials: Dict[str, Any]):
+        """Crea il database `db_name`; `credentials` contiene host e porta registrati per l'utente."""
+
+    @abstractmethod
+    def delete_database(self, db_name: str) -> bool:
+        """Elimina il database; False se non esiste."""
+
+    @abstractmethod
+    def create_collection(self, db_name: str, collection_name: str):
+        """Crea la collezione (nessun errore se esiste già)."""
+
+    @abstractmethod
+    def list_collections(self, db_name: str) -> List[str]:
+        """Nomi delle collezioni del database."""
+
+    @abstractmethod
+    def delete_collection(self, db_name: str, collection_name: str):
+        """Elimina la collezione."""
+
+    @abstractmethod
+    def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        """Associa alla collezione gli schemi YAML (`filename`, `content`) usati per convalidare gli inserimenti."""
+
+    # --- Documenti ---
+    @abstractmethod
+    def insert(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> str:
+        """Inserisce il documento e ne restituisce l'id."""
+
+    def add_item(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Inserisce il documento e restituisce la risposta della rotta `add_item`, con l'id in `id`.
+        """
+        return {"message": "Item added successfully.", "id": self.insert(db_name, collection_name, document)}
+
+    def insert_many(self, db_name: str, collection_name: str, documents: Sequence[Dict[str, Any]],
+                    concurrency: int = 1) -> int:
+        """
+        Inserisce i documenti e restituisce quanti ne sono stati inseriti. Senza un inserimento
+        multiplo nativo usa `concurrency` inserimenti concorrenti. Se un inserimento fallisce solleva
+        `PartialInsert` con la sola parte iniziale dei documenti inserita: quelli successivi già
+        inseriti dagli altri thread vengono eliminati, così che una ripresa non li duplichi.
+        """
+        failed = threading.Event()
+
+        def insert(document: Dict[str, Any]) -> Optional[str]:
+            # Dopo il primo errore i documenti non ancora avviati non vengono inseriti
+            if failed.is_set():
+                return None
+            try:
+                return self.insert(db_name, collection_name, document)
+            except StorageError:
+                failed.set()
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(documents)))) as executor:
+            ids = list(executor.map(insert, documents))
+        if not failed.is_set():
+            return len(documents)
+        prefix = ids.index(None)
+        for item_id in ids[prefix + 1:]:
+            try:
+                if item_id is not None:
+                    self.delete(db_name, collection_name, item_id)
+            except StorageError as e:
+                logger.warning("Documento %s inserito dopo un errore e non eliminato: %s", item_id, e)
+        raise PartialInsert(f"{len(documents) - prefix} documenti del gruppo non inseriti", prefix)
+
+    @abstractmethod
+    def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+             fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        """Documenti che corrispondono al filtro, limitati ai campi `fields` se indicati."""
+
+    @abstractmethod
+    def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        """Il documento con id `item_id`, o None."""
+
+    @abstractmethod
+    def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        """Sovrascrive i campi indicati del documento; False se non esiste."""
+
+    @abstractmethod
+    def update_one(self, db_name: str, collection_name: str, filter_data: Dict[str, Any],
+                   update: Dict[str, Any]) -> int:
+        """Applica gli operatori di aggiornamento al primo documento del filtro; restituisce i documenti trovati (0 o 1)."""
+
+    @abstractmethod
+    def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        """Elimina il documento; False se non esiste."""
+
+    @abstractmethod
+    def delete_many(self, db_name: str, collection_name: str, filter_data: Dict[str, Any]) -> int:
+        """Elimina i documenti che corrispondono al filtro e restituisce quanti sono stati eliminati."""
+
+    # --- Interrogazioni ---
+    @abstractmethod
+    def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        """Documenti di tutte le collezioni del database che corrispondono al filtro, paginati."""
+
+    @abstractmethod
+    def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                  options: Dict[str, Any], max_bytes: int) -> bytes:
+        """
+        Esegue la pipeline con le opzioni `maxTimeMS`/`allowDiskUse` e restituisce il risultato come
+        lista JSON; solleva `ResultTooLarge` oltre `max_bytes`.
+        """
+
+    def find_page(self, db_name: str, collection_name: str, cursor: Optional[PageCursor], size: int,
+                  options: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Optional[PageCursor]]:
+        """
+        Al più `size` documenti in ordine di `_id` dopo `cursor` (None per la prima pagina), con le
+        opzioni delle aggregazioni; restituisce anche il cursore della pagina successiva, None dopo l'ultima.
+
+        MongoDB confronta solo valori dello stesso tipo e un id riletto dal JSON come stringa non
+        corrisponde a un `ObjectId`: la collezione viene quindi percorsa un tipo di `_id` alla volta,
+        e il cursore conserva l'ultimo id nel tipo nativo dell'archivio. Con id di tipi non previsti
+        da `ID_TYPES` la prima pagina solleva `StorageError`.
+        """
+        if cursor is None and self._has_unsupported_ids(db_name, collection_name, options):
+            raise StorageError(f"La collezione {collection_name} contiene id di tipo non esportabile", 400)
+        type_index, after = cursor or (0, None)
+        documents: List[Dict[str, Any]] = []
+        while type_index < len(ID_TYPES):
+            page, last_id = self._id_page(db_name, collection_name, ID_TYPES[type_index], after,
+                                          size - len(documents), options)
+            documents.extend(page)
+            if len(documents) >= size:
+                return documents, (type_index, last_id)
+            type_index, after = type_index + 1, None
+        return documents, None
+
+    def _id_page(self, db_name: str, collection_name: str, id_type: str, after: Any, size: int,
+                 options: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Any]:
+        # Paginazione per chiave sull'indice di `_id` con una pipeline di aggregazione; gli id letti
+        # come stringhe vengono riconvertiti nel confronto, che da MongoDB 5.0 usa l'indice anche in `$expr`
+        match: Dict[str, Any] = {"_id": {"$type": id_type}}
+        if after is not None and id_type in _CONVERTED_ID_TYPES:
+            match["$expr"] = {"$gt": ["$_id", {_CONVERTED_ID_TYPES[id_type]: after}]}
+        elif after is not None:
+            match["_id"]["$gt"] = after
+        pipeline = [{"$match": match}, {"$sort": {"_id": 1}}, {"$limit": size}]
+        # La dimensione della pagina è limitata dal numero di documenti, non dai byte
+        documents = json.loads(self.aggregate(db_name, collection_name, pipeline, options, sys.maxsize))
+        return documents, documents[-1]["_id"] if documents else None
+
+    def _has_unsupported_ids(self, db_name: str, collection_name: str, options: Dict[str, Any]) -> bool:
+        pipeline = [{"$match": {"_id": {"$not": {"$type": list(ID_TYPES)}}}}, {"$limit": 1}]
+        return bool(json.loads(self.aggregate(db_name, collection_name, pipeline, options, sys.maxsize)))
+
+    def warm_up(self, connections: int):
+        """Apre in anticipo `connections` connessioni verso l'archivio."""
+
+    def close(self):
+        """Rilascia le connessioni dell'archivio."""
+
+
+# ----------------------------------------------------------------------------------
+# Gateway HTTP
+# ----------------------------------------------------------------------------------
+class GatewayStorage(Storage):
+    def __init__(self, base_url: str, session: requests.Session, atomic_updates: Optional[bool] = None):
+        self.base_url = base_url
+        self.session = session
+        # Con `atomic_updates` None gli operatori atomici vengono usati finché il gateway non
+        # dimostra, alla prima chiamata, di non offrire `update_one`
+        self.supports_update_operators = atomic_updates is not False
+        self._detect_update_operators = atomic_updates is None
+
+    def _request(self, method: str, path: str, operation: str, allow_not_found: bool = False,
+                 **kwargs) -> Optional[requests.Response]:
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        except requests.RequestException as error:
+            raise StorageError(f"{operation}: {error}") from error
+        if allow_not_found and response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise StorageError(f"{operation}: HTTP {response.status_code}", response.status_code)
+        return response
+
+    def create_database(self, db_name: str, credentials: Dict[str, Any]):
+        self._request("POST", "/create_database/", "create_database", json=credentials)
+
+    def delete_database(self, db_name: str) -> bool:
+        return self._request("DELETE", f"/delete_database/{db_name}/", "delete_database", allow_not_found=True) is not None
+
+    def create_collection(self, db_name: str, collection_name: str):
+        self._request("POST", f"/{db_name}/create_collection/", "create_collection",
+                      params={"collection_name": collection_name})
+
+    def list_collections(self, db_name: str) -> List[str]:
+        return self._request("GET", f"/{db_name}/list_collections/", "list_collections").json()
+
+    def delete_collection(self, db_name: str, collection_name: str):
+        self._request("DELETE", f"/{db_name}/delete_collection/{collection_name}/", "delete_collection")
+
+    def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        self._request("POST", f"/upload_schema/{db_name}/{collection_name}/", "upload_schema", json={"files": files})
+
+    def insert(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> str:
+        return self.add_item(db_name, collection_name, document).get("id")
+
+    def add_item(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> Dict[str, Any]:
+        # La risposta del gateway viene restituita così com'è, come prima dell'interfaccia `Storage`
+        return self._request("POST", f"/{db_name}/{collection_name}/add_item/", "add_item", json=document).json()
+
+    def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+             fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        documents = self._request("POST", f"/{db_name}/get_items/{collection_name}/", "get_items",
+                                  json=filter_data or {}).json()
+        # Il gateway non supporta proiezioni: i campi vengono selezionati appena ricevuta la risposta
+        if fields is not None:
+            documents = [{field: document[field] for field in fields if field in document} for document in documents]
+        return documents
+
+    def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        response = self._request("GET", f"/{db_name}/get_item/{collection_name}/{item_id}/", "get_item",
+                                 allow_not_found=True)
+        return response.json() if response is not None else None
+
+    def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        return self._request("PUT", f"/{db_name}/update_item/{collection_name}/{item_id}/", "update_item",
+                             allow_not_found=True, json=fields) is not None
+
+    def update_one(self, db_name: str, collection_name: str, filter_data: Dict[str, Any],
+                   update: Dict[str, Any]) -> int:
+        try:
+            response = self._request("PATCH", f"/{db_name}/update_one/{collection_name}/", "update_one",
+                                     json={"filter": filter_data, "update": update})
+        except StorageError as error:
+            # Rotta assente alla prima chiamata: il gateway non offre `update_one`
+            if self._detect_update_operators and error.status_code in (404, 405):
+                self.supports_update_operators = False
+                self._detect_update_operators = False
+                raise UnsupportedOperation("update_one non supportato dal gateway", error.status_code) from error
+            raise
+        self._detect_update_operators = False
+        return response.json().get("matched_count", 0)
+
+    def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        return self._request("DELETE", f"/{db_name}/delete_item/{collection_name}/{item_id}/", "delete_item",
+                             allow_not_found=True) is not None
+
+    def delete_many(self, db_name: str, collection_name: str, filter_data: Dict[str, Any]) -> int:
+        response = self._request("DELETE", f"/{db_name}/{collection_name}/delete_item", "delete_item", json=filter_data)
+        return response.json().get("deleted_count", 0)
+
+    def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        return self._request("POST", f"/{db_name}/search", "search",
+                             json={"filter": filter_data, "skip": skip, "size": size}).json()
+
+    def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                  options: Dict[str, Any], max_bytes: int) -> bytes:
+        payload = {"pipeline": pipeline, "options": options}
+        # Il gateway interrompe l'aggregazione dopo `maxTimeMS`: il timeout HTTP lascia un margine
+        timeout = options.get("maxTimeMS", 0) / 1000 + getattr(self.session, "timeout", 30)
+        try:
+            with self.session.post(f"{self.base_url}/{db_name}/aggregate/{collection_name}/", json=payload,
+                                   timeout=timeout, stream=True) as response:
+                if response.status_code != 200:
+                    raise StorageError(f"aggregate: {response.text[:500]}", response.status_code)
+                # La risposta del gateway è già JSON: letta fino a `max_bytes` senza decodificarla
+                body = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    body.extend(chunk)
+                    if len(body) > max_bytes:
+                        raise ResultTooLarge(f"Il risultato supera {max_bytes} byte")
+        except requests.RequestException as error:
+            raise StorageError(f"aggregate: {error}") from error
+        return bytes(body)
+
+    def warm_up(self, connections: int):
+        """
+        Apre `connections` connessioni verso il gateway in parallelo e le lascia nel pool.
+        Lo stato della risposta non è rilevante: serve solo a stabilire le connessioni.
+        """
+        if connections <= 0:
+            return
+
+        def touch(_):
+            try:
+                self.session.head(f"{self.base_url}/", timeout=5).close()
+                return True
+            except requests.RequestException as e:
+                logger.warning("Connessione di riscaldamento al gateway fallita: %s", e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            opened = sum(executor.map(touch, range(connections)))
+        logger.info("Aperte %d connessioni verso il gateway", opened)
+
+    def close(self):
+        self.session.close()
+
+
+# ----------------------------------------------------------------------------------
+# MongoDB diretto
+# ----------------------------------------------------------------------------------
+def plain(value: Any) -> Any:
+    """
+    Converte i tipi BSON in tipi JSON, come nelle risposte del gateway.
+    """
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def id_condition(item_id: str) -> Any:
+    """
+    Condizione su `_id` per un id ricevuto come stringa: l'`ObjectId` equivalente o la stringa stessa.
+    """
+    if ObjectId.is_valid(item_id):
+        return {"$in": [ObjectId(item_id), item_id]}
+    return item_id
+
+
+def id_filter(filter_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Il filtro con `id_condition` al posto di un `_id` stringa.
+    """
+    filter_data = filter_data or {}
+    condition = filter_data.get("_id")
+    if isinstance(condition, str):
+        return {**filter_data, "_id": id_condition(condition)}
+    return filter_data
+
+
+def mongo_error(operation: str, error: Exception) -> StorageError:
+    """
+    `StorageError` per un errore del driver: operazione rifiutata dal server (come un 400 del gateway)
+    o server non raggiungibile.
+    """
+    return StorageError(f"{operation}: {error}", 400 if isinstance(error, OperationFailure) else None)
+
+
+class MongoStorage(Storage):
+    """
+    MongoDB tramite `pymongo`. Il client è thread-safe e mantiene un pool di `pool_size` connessioni
+    per processo; viene collegato al primo utilizzo, quindi dopo il fork dei worker.
+
+    Gli id generati da MongoDB (`ObjectId`) vengono restituiti come stringhe; un id ricevuto come
+    stringa corrisponde sia all'`ObjectId` equivalente sia alla stringa stessa.
+    Gli schemi YAML sono interpretati dal gateway e non sono disponibili con questo backend.
+    """
+
+    def __init__(self, uri: str, pool_size: int, timeout_seconds: float):
+        if pymongo is None:
+            raise RuntimeError("Il backend 'mongodb' richiede il pacchetto pymongo")
+        timeout_ms = int(timeout_seconds * 1000)
+        self.client = pymongo.MongoClient(uri, maxPoolSize=pool_size, connect=False, serverSelectionTimeoutMS=timeout_ms,
+                                          socketTimeoutMS=timeout_ms, connectTimeoutMS=timeout_ms)
+
+    def _collection(self, db_name: str, collection_name: str):
+        return self.client[db_name][collection_name]
+
+    def _run(self, operation: str, call, *args, **kwargs):
+        try:
+            return call(*args, **kwargs)
+        except PyMongoError as error:
+            raise mongo_error(operation, error) from error
+
+    def create_database(self, db_name: str, credentials: Dict[str, Any]):
+        # MongoDB crea il database alla prima scrittura: non serve alcuna operazione
+        pass
+
+    def delete_database(self, db_name: str) -> bool:
+        if db_name not in self._run("delete_database", self.client.list_database_names):
+            return False
+        self._run("delete_database", self.client.drop_database, db_name)
+        return True
+
+    def create_collection(self, db_name: str, collection_name: str):
+        try:
+            self._run("create_collection", self.client[db_name].create_collection, collection_name)
+        except CollectionInvalid:
+            pass
+
+    def list_collections(self, db_name: str) -> List[str]:
+        return self._run("list_collections", self.client[db_name].list_collection_names)
+
+    def delete_collection(self, db_name: str, collection_name: str):
+        self._run("delete_collection", self.client[db_name].drop_collection, collection_name)
+
+    def upload_schema(self, db_name: str, collection_name: str, files: List[Dict[str, str]]):
+        raise StorageError("Gli schemi YAML sono gestiti dal gateway: non disponibili con il backend mongodb")
+
+    def insert(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> str:
+        result = self._run("add_item", self._collection(db_name, collection_name).insert_one, dict(document))
+        return str(result.inserted_id)
+
+    def insert_many(self, db_name: str, collection_name: str, documents: Sequence[Dict[str, Any]],
+                    concurrency: int = 1) -> int:
+        if not documents:
+            return 0
+        collection = self._collection(db_name, collection_name)
+        try:
+            # Inserimento ordinato: al primo errore MongoDB si ferma e riporta i documenti inseriti
+            result = collection.insert_many([dict(document) for document in documents], ordered=True)
+        except BulkWriteError as error:
+            raise PartialInsert(f"insert_many: {error}", error.details.get("nInserted", 0), 400) from error
+        except PyMongoError as error:
+            raise mongo_error("insert_many", error) from error
+        return len(result.inserted_ids)
+
+    def find(self, db_name: str, collection_name: str, filter_data: Optional[Dict[str, Any]] = None,
+             fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        projection = None
+        if fields is not None:
+            projection = {field: 1 for field in fields}
+            if "_id" not in projection:
+                projection["_id"] = 0
+        cursor = self._run("get_items", self._collection(db_name, collection_name).find,
+                           id_filter(filter_data), projection)
+        return self._run("get_items", lambda: [plain(document) for document in cursor])
+
+    def get(self, db_name: str, collection_name: str, item_id: str) -> Optional[Dict[str, Any]]:
+        document = self._run("get_item", self._collection(db_name, collection_name).find_one, {"_id": id_condition(item_id)})
+        return plain(document) if document is not None else None
+
+    def update(self, db_name: str, collection_name: str, item_id: str, fields: Dict[str, Any]) -> bool:
+        fields = {field: value for field, value in fields.items() if field != "_id"}
+        if not fields:
+            return self.get(db_name, collection_name, item_id) is not None
+        result = self._run("update_item", self._collection(db_name, collection_name).update_one,
+                           {"_id": id_condition(item_id)}, {"$set": fields})
+        return result.matched_count > 0
+
+    def update_one(self, db_name: str, collection_name: str, filter_data: Dict[str, Any],
+                   update: Dict[str, Any]) -> int:
+        result = self._run("update_one", self._collection(db_name, collection_name).update_one,
+                           id_filter(filter_data), update)
+        return result.matched_count
+
+    def delete(self, db_name: str, collection_name: str, item_id: str) -> bool:
+        result = self._run("delete_item", self._collection(db_name, collection_name).delete_one,
+                           {"_id": id_condition(item_id)})
+        return result.deleted_count > 0
+
+    def delete_many(self, db_name: str, collection_name: str, filter_data: Dict[str, Any]) -> int:
+        result = self._run("delete_item", self._collection(db_name, collection_name).delete_many,
+                           id_filter(filter_data))
+        return result.deleted_count
+
+    def search(self, db_name: str, filter_data: Dict[str, Any], skip: int, size: int) -> List[Dict[str, Any]]:
+        # Stesso ordine del gateway: le collezioni una dopo l'altra, con la paginazione sull'insieme
+        filter_data = id_filter(filter_data)
+        results: List[Dict[str, Any]] = []
+        for collection_name in self.list_collections(db_name):
+            if len(results) >= size:
+                break
+            collection = self._collection(db_name, collection_name)
+            if skip:
+                matched = self._run("search", collection.count_documents, filter_data)
+                if matched <= skip:
+                    skip -= matched
+                    continue
+            cursor = collection.find(filter_data).skip(skip).limit(size - len(results))
+            results.extend(self._run("search", lambda: [plain(document) for document in cursor]))
+            skip = 0
+        return results
+
+    def aggregate(self, db_name: str, collection_name: str, pipeline: List[Dict[str, Any]],
+                  options: Dict[str, Any], max_bytes: int) -> bytes:
+        collection = self._collection(db_name, collection_name)
+        pipeline = [{"$match": id_filter(stage["$match"])} if "$match" in stage else stage for stage in pipeline]
+        cursor = self._run("aggregate", collection.aggregate, pipeline, **options)
+        try:
+            return encode_results((plain(document) for document in cursor), max_bytes)
+        except PyMongoError as error:
+            raise mongo_error("aggregate", error) from error
+        finally:
+            cursor.close()
+
+    def _id_page(self, db_name: str, collection_name: str, id_type: str, after: Any, size: int,
+                 options: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Any]:
+        # Il cursore conserva l'id restituito dal driver (`ObjectId`, `datetime`): confronto diretto sull'indice
+        condition: Dict[str, Any] = {"$type": id_type}
+        if after is not None:
+            condition["$gt"] = after
+        cursor = self._collection(db_name, collection_name).find({"_id": condition}).sort("_id", 1).limit(size)
+        if "maxTimeMS" in options:
+            cursor = cursor.max_time_ms(options["maxTimeMS"])
+        documents = self._run("export", list, cursor)
+        return [plain(document) for document in documents], documents[-1]["_id"] if documents else None
+
+    def _has_unsupported_ids(self, db_name: str, collection_name: str, options: Dict[str, Any]) -> bool:
+        document = self._run("export", self._collection(db_name, collection_name).find_one,
+                             {"_id": {"$not": {"$type": list(ID_TYPES)}}}, {"_id": 1})
+        return document is not None
+
+    def warm_up(self, connections: int):
+        # Un comando `ping` verifica il collegamento; il pool si riempie alle prime richieste
+        if connections > 0:
+            try:
+                self.client.admin.command("ping")
+            except PyMongoError as e:
+                logger.warning("Connessione di riscaldamento a MongoDB fallita: %s", e)
+
+    def close(self):
+        self.client.close()
+
+
+def create_storage(settings: Settings, session: requests.Session) -> Storage:
+    backend = settings.storage_backend
+    if backend == "gateway":
+        return GatewayStorage(settings.mongodb_service_url, session, settings.gateway_atomic_updates)
+    if backend == "mongodb":
+        return MongoStorage(settings.mongodb_uri, settings.mongodb_pool_size, settings.mongodb_timeout_seconds)
+    if backend == "memory":
+        from app.memory_storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Archivio dei dati non supportato: {backend}")
@@ -0,0 +1,217 @@
+"""
+Archivio dei token emessi, consultato a ogni richiesta autenticata per riconoscere i token revocati.
+
+Due implementazioni:
+- `CollectionTokenStore`: la collezione `tokens_collection` dell'archivio dei dati (comportamento
+  storico, condivisa tra tutti gli host);
+- `SQLiteTokenStore`: un file SQLite locale in modalità WAL, condiviso dai worker dello stesso host,
+  senza chiamate di rete né servizi esterni.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+from app.storage import TOKENS_COLLECTION, USERS_DATABASE, Storage, StorageError
+
+logger = logging.getLogger(__name__)
+
+
+class TokenInDB(BaseModel):
+    username: str = Field(..., title="Username", description="Nome utente associato al token.")
+    token: str = Field(..., title="Token", description="Il token JWT.")
+    token_type: str = Field(..., title="Tipo di Token", description="Tipo di token, es. access_token o refresh_token.")
+    expires_at: str = Field(..., title="Data di Scadenza", description="Data e ora di scadenza del token in formato ISO 8601.")
+    session_id: Optional[str] = Field(None, title="Sessione", description="Sessione di login a cui appartiene il token.")
+
+
+class TokenStoreError(Exception):
+    """
+    L'archivio dei token non è raggiungibile o ha rifiutato l'operazione.
+    """
+
+
+class TokenStore(ABC):
+    @abstractmethod
+    def store(self, token: TokenInDB):
+        """Registra un token appena emesso."""
+
+    @abstractmethod
+    def get(self, token: str) -> Optional[TokenInDB]:
+        """Restituisce il token registrato, o None se sconosciuto o revocato."""
+
+    @abstractmethod
+    def revoke(self, token: str):
+        """Rimuove il token: le richieste successive che lo usano vengono rifiutate."""
+
+    @abstractmethod
+    def revoke_session(self, username: str, session_id: str):
+        """Rimuove tutti i token (di accesso e di refresh) della sessione di login dell'utente."""
+
+    def close(self):
+        """Rilascia le risorse (connessioni, file) dell'archivio."""
+
+
+class CollectionTokenStore(TokenStore):
+    """
+    Token nella collezione `tokens_collection` dell'archivio dei dati (gateway o MongoDB).
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    def store(self, token: TokenInDB):
+        try:
+            self.storage.insert(USERS_DATABASE, TOKENS_COLLECTION, token.model_dump())
+        except StorageError as error:
+            raise TokenStoreError(str(error)) from error
+
+    def get(self, token: str) -> Optional[TokenInDB]:
+        try:
+            tokens = self.storage.find(USERS_DATABASE, TOKENS_COLLECTION, {"token": token})
+        except StorageError as error:
+            raise TokenStoreError(str(error)) from error
+        if tokens:
+            token_data = tokens[-1]  # Assuming only one token will match
+            return TokenInDB(**token_data)
+        return None
+
+    def revoke(self, token: str):
+        try:
+            self.storage.delete_many(USERS_DATABASE, TOKENS_COLLECTION, {"token": token})
+        except StorageError as error:
+            raise TokenStoreError(str(error)) from error
+
+    def revoke_session(self, username: str, session_id: str):
+        try:
+            self.storage.delete_many(USERS_DATABASE, TOKENS_COLLECTION, {"username": username, "session_id": session_id})
+        except StorageError as error:
+            raise TokenStoreError(str(error)) from error
+
+
+class SQLiteTokenStore(TokenStore):
+    """
+    Token in un file SQLite in modalità WAL: le letture non bloccano le scritture e più processi
+    (i worker di Gunicorn) possono usare lo stesso file. Ogni thread apre la propria connessione,
+    al primo utilizzo, per cui nessuna connessione viene condivisa tra processi dopo il fork.
+
+    I token scaduti vengono eliminati al più ogni `purge_interval` secondi, durante le scritture.
+    """
+
+    def __init__(self, path: str, purge_interval: float = 300, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.purge_interval = purge_interval
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._purged_at = time.monotonic()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                " token TEXT PRIMARY KEY,"
+                " username TEXT NOT NULL,"
+                " token_type TEXT NOT NULL,"
+                " expires_at TEXT NOT NULL,"
+                " expires_ts REAL NOT NULL,"
+                " session_id TEXT"
+                ") WITHOUT ROWID"
+            )
+            # File creati prima dell'introduzione delle sessioni
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(tokens)")}
+            if "session_id" not in columns:
+                connection.execute("ALTER TABLE tokens ADD COLUMN session_id TEXT")
+            connection.execute("CREATE INDEX IF NOT EXISTS tokens_expires_ts ON tokens (expires_ts)")
+            connection.execute("CREATE INDEX IF NOT EXISTS tokens_session ON tokens (username, session_id)")
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                                     check_same_thread=False)
+        # Con WAL, NORMAL esegue fsync solo ai checkpoint: un crash dell'host può perdere gli ultimi
+        # token emessi (l'utente ripete il login), mai corrompere il file
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def store(self, token: TokenInDB):
+        expires_ts = datetime.fromisoformat(token.expires_at).timestamp()
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO tokens (token, username, token_type, expires_at, expires_ts, session_id)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (token.token, token.username, token.token_type, token.expires_at, expires_ts, token.session_id),
+            )
+            self._purge_expired(connection)
+        except sqlite3.Error as error:
+            raise TokenStoreError(str(error)) from error
+
+    def get(self, token: str) -> Optional[TokenInDB]:
+        try:
+            row = self._connection().execute(
+                "SELECT username, token, token_type, expires_at, session_id FROM tokens WHERE token = ?", (token,)
+            ).fetchone()
+        except sqlite3.Error as error:
+            raise TokenStoreError(str(error)) from error
+        if row is None:
+            return None
+        username, token, token_type, expires_at, session_id = row
+        return TokenInDB(username=username, token=token, token_type=token_type, expires_at=expires_at,
+                         session_id=session_id)
+
+    def revoke(self, token: str):
+        try:
+            self._connection().execute("DELETE FROM tokens WHERE token = ?", (token,))
+        except sqlite3.Error as error:
+            raise TokenStoreError(str(error)) from error
+
+    def revoke_session(self, username: str, session_id: str):
+        try:
+            self._connection().execute("DELETE FROM tokens WHERE username = ? AND session_id = ?", (username, session_id))
+        except sqlite3.Error as error:
+            raise TokenStoreError(str(error)) from error
+
+    def _purge_expired(self, connection: sqlite3.Connection):
+        now = time.monotonic()
+        if now - self._purged_at < self.purge_interval:
+            return
+        self._purged_at = now
+        # `expires_at` è in UTC senza fuso (datetime.utcnow()): stesso riferimento per il confronto
+        deleted = connection.execute("DELETE FROM tokens WHERE expires_ts < ?", (datetime.utcnow().timestamp(),)).rowcount
+        if deleted:
+            logger.info("Eliminati %d token scaduti da %s", deleted, self.path)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+def create_token_store(backend: str, storage: Storage, path: str) -> TokenStore:
+    if backend == "gateway":
+        return CollectionTokenStore(storage)
+    if backend == "sqlite":
+        return SQLiteTokenStore(path)
+    raise ValueError(f"Archivio dei token non supportato: {backend}")
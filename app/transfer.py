@@ -0,0 +1,189 @@
+"""
+Esportazione e importazione in streaming dei documenti di una collezione, in formato NDJSON
+(un documento JSON per riga), eventualmente compresso con gzip.
+
+L'esportazione legge la collezione a pagine di `export_page_size` documenti con `Storage.find_page`,
+ordinate per `_id` e individuate dall'ultimo id della pagina precedente, e scrive ogni pagina appena
+ricevuta, per cui la memoria usata non dipende dalla dimensione della collezione.
+L'importazione legge il corpo della richiesta a blocchi, inserisce i documenti a gruppi di
+`import_batch_size` e restituisce l'avanzamento come NDJSON; ogni riga di avanzamento indica
+`committed`, il numero di righe del file già elaborate, da passare come `resume_from` per
+riprendere un'importazione interrotta. Un gruppo viene inserito in ordine: se fallisce, `resume_from`
+indica la riga dell'ultimo documento inserito.
+"""
+import json
+import zlib
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+
+from app.settings import TransferSettings
+from app.storage import PartialInsert, Storage
+
+GZIP_MAGIC = b"\x1f\x8b"
+DECOMPRESS_CHUNK_SIZE = 256 * 1024
+
+
+# ----------------------------------------------------------------------------------
+# Esportazione
+# ----------------------------------------------------------------------------------
+def export_documents(storage: Storage, db_name: str, collection_name: str, page_size: int,
+                     options: Dict[str, Any]) -> Iterator[bytes]:
+    """
+    Righe NDJSON della collezione, una pagina per blocco; `options` sono le opzioni delle aggregazioni
+    (`aggregate_options`).
+    """
+    # Paginazione per chiave sull'indice di `_id`: ogni pagina riparte dall'ultimo id della precedente,
+    # con costo costante per pagina; inserimenti ed eliminazioni concorrenti non spostano le pagine successive
+    cursor = None
+    while True:
+        page, cursor = storage.find_page(db_name, collection_name, cursor, page_size, options)
+        if page:
+            yield b"".join(json.dumps(document, separators=(",", ":")).encode() + b"\n" for document in page)
+        if cursor is None:
+            return
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+# ----------------------------------------------------------------------------------
+# Importazione
+# ----------------------------------------------------------------------------------
+class ProgressResponse(StreamingResponse):
+    """
+    Risposta in streaming prodotta mentre si legge ancora il corpo della richiesta.
+
+    `StreamingResponse` ascolta la disconnessione del client leggendo dal canale della richiesta,
+    sottraendo i blocchi del corpo all'importazione; qui la disconnessione emerge invece dalla
+    lettura del corpo stesso.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+def _line(event: Dict[str, Any]) -> bytes:
+    return json.dumps(event).encode() + b"\n"
+
+
+async def import_documents(storage: Storage, chunks: AsyncIterator[bytes], db_name: str, collection_name: str,
+                           limits: TransferSettings, resume_from: int = 0,
+                           preserve_ids: bool = False) -> AsyncIterator[bytes]:
+    """
+    Legge il file NDJSON (gzip riconosciuto automaticamente) e produce le righe di avanzamento.
+
+    Le righe sono numerate dalla prima del file, righe vuote comprese; con `resume_from` le prime
+    righe vengono lette ma non inserite.
+    """
+    decompressor: Optional[Any] = None
+    first_chunk = True
+    pending = b""
+    line_number = committed = 0
+    inserted = 0
+    batch: List[Dict[str, Any]] = []
+    # Riga del file di ogni documento del gruppo
+    batch_lines: List[int] = []
+    batch_end = 0
+
+    async def flush() -> Optional[bytes]:
+        # Inserisce il gruppo in attesa; restituisce la riga di errore se l'inserimento fallisce
+        nonlocal batch, batch_lines, committed, inserted
+        if not batch:
+            return None
+        try:
+            await run_in_threadpool(storage.insert_many, db_name, collection_name, batch, limits.import_concurrency)
+        except PartialInsert as e:
+            # Inserita solo la parte iniziale del gruppo: la ripresa parte dal primo documento mancante
+            if e.inserted:
+                inserted += e.inserted
+                committed = batch_lines[e.inserted - 1]
+            return _line({"type": "error", "detail": str(e), "resume_from": committed})
+        except Exception as e:
+            return _line({"type": "error", "detail": str(e), "resume_from": committed})
+        inserted += len(batch)
+        committed = batch_end
+        batch, batch_lines = [], []
+        return None
+
+    def parse(raw: bytes) -> Dict[str, Any]:
+        document = json.loads(raw)
+        if not isinstance(document, dict):
+            raise ValueError("la riga non contiene un oggetto JSON")
+        if not preserve_ids:
+            document.pop("_id", None)
+        return document
+
+    def decompressed(chunk: bytes) -> Iterator[bytes]:
+        # Decompressione a blocchi limitati: un file molto compresso non viene espanso tutto in memoria
+        if decompressor is None:
+            yield chunk
+            return
+        yield decompressor.decompress(chunk, DECOMPRESS_CHUNK_SIZE)
+        while decompressor.unconsumed_tail:
+            yield decompressor.decompress(decompressor.unconsumed_tail, DECOMPRESS_CHUNK_SIZE)
+
+    async def lines() -> AsyncIterator[bytes]:
+        nonlocal decompressor, first_chunk, pending
+        async for chunk in chunks:
+            if first_chunk and chunk:
+                first_chunk = False
+                if chunk.startswith(GZIP_MAGIC):
+                    decompressor = zlib.decompressobj(31)
+            for piece in decompressed(chunk):
+                pending += piece
+                *complete, pending = pending.split(b"\n")
+                for raw in complete:
+                    if len(raw) > limits.import_max_line_bytes:
+                        raise ValueError(f"riga più lunga di {limits.import_max_line_bytes} byte")
+                    yield raw
+                if len(pending) > limits.import_max_line_bytes:
+                    raise ValueError(f"riga più lunga di {limits.import_max_line_bytes} byte")
+        if decompressor is not None:
+            pending += decompressor.flush()
+        if pending:
+            yield pending
+
+    try:
+        async for raw in lines():
+            line_number += 1
+            if line_number <= resume_from:
+                committed = line_number
+                continue
+            if raw.strip():
+                try:
+                    document = parse(raw)
+                except ValueError as e:
+                    # Le righe precedenti vengono inserite: la ripresa parte dalla riga non valida
+                    error = await flush()
+                    yield error or _line({"type": "error", "line": line_number, "detail": f"JSON non valido: {e}",
+                                          "resume_from": committed})
+                    return
+                batch.append(document)
+                batch_lines.append(line_number)
+            batch_end = line_number
+            if not batch:
+                committed = line_number
+            if len(batch) >= limits.import_batch_size:
+                error = await flush()
+                if error:
+                    yield error
+                    return
+                yield _line({"type": "progress", "committed": committed, "inserted": inserted})
+    except (ValueError, zlib.error) as e:
+        error = await flush()
+        yield error or _line({"type": "error", "line": line_number + 1, "detail": str(e), "resume_from": committed})
+        return
+
+    error = await flush()
+    if error:
+        yield error
+        return
+    yield _line({"type": "done", "committed": committed, "inserted": inserted})
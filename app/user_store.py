@@ -0,0 +1,133 @@
+"""
+Aggiornamenti parziali dei documenti utente.
+
+Un `UserUpdate` descrive solo le modifiche (`$set`, `$inc`, `$push`, `$pull`) invece del documento
+o degli array completi. Ogni aggiornamento incrementa il campo `version` del documento; passando
+`expected_version` l'aggiornamento viene applicato solo se il documento non è cambiato dalla lettura
+(concorrenza ottimistica) e in caso contrario `update_user` restituisce False.
+
+Se l'archivio supporta gli operatori di aggiornamento (MongoDB diretto, la memoria e il gateway, salvo
+`gateway_atomic_updates: false` o un gateway senza `update_one`) l'aggiornamento è una sola chiamata
+`update_one`, con gli operatori MongoDB e la versione nel filtro, ed è atomico. Altrimenti il documento
+viene letto, la versione controllata e solo i campi modificati vengono riscritti con `update_item`: il
+controllo di versione restringe la finestra di conflitto ma, senza supporto del gateway, non la elimina.
+"""
+import copy
+from typing import Any, Dict, List, Optional
+
+from app.storage import USERS_COLLECTION, USERS_DATABASE, Storage, StorageError, UnsupportedOperation
+
+# Campo del documento utente incrementato a ogni aggiornamento
+VERSION_FIELD = "version"
+
+
+class UserStoreError(Exception):
+    """
+    L'archivio ha rifiutato l'aggiornamento o non è raggiungibile.
+    """
+
+
+class UserUpdate:
+    """
+    Modifiche da applicare a un documento utente, limitate ai campi di primo livello.
+    """
+
+    def __init__(self):
+        self.set_fields: Dict[str, Any] = {}
+        self.inc_fields: Dict[str, int] = {}
+        self.push_items: Dict[str, List[Any]] = {}
+        self.pull_matches: Dict[str, Dict[str, Any]] = {}
+
+    def set(self, field: str, value: Any) -> "UserUpdate":
+        self.set_fields[field] = value
+        return self
+
+    def inc(self, field: str, amount: int = 1) -> "UserUpdate":
+        self.inc_fields[field] = self.inc_fields.get(field, 0) + amount
+        return self
+
+    def push(self, field: str, item: Any) -> "UserUpdate":
+        self.push_items.setdefault(field, []).append(item)
+        return self
+
+    def pull(self, field: str, match: Dict[str, Any]) -> "UserUpdate":
+        """
+        Rimuove dall'array `field` gli elementi che hanno tutti i valori di `match`.
+        """
+        self.pull_matches[field] = match
+        return self
+
+    def __bool__(self) -> bool:
+        return bool(self.set_fields or self.inc_fields or self.push_items or self.pull_matches)
+
+    def to_mongo(self) -> Dict[str, Any]:
+        """
+        Operatori di aggiornamento MongoDB, con l'incremento della versione.
+        """
+        update: Dict[str, Any] = {"$inc": {**self.inc_fields, VERSION_FIELD: 1}}
+        if self.set_fields:
+            update["$set"] = dict(self.set_fields)
+        if self.push_items:
+            update["$push"] = {field: {"$each": items} for field, items in self.push_items.items()}
+        if self.pull_matches:
+            update["$pull"] = dict(self.pull_matches)
+        return update
+
+    def apply(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Valori aggiornati dei soli campi modificati, calcolati sul documento indicato
+        (versione compresa). Il documento non viene modificato.
+        """
+        changed: Dict[str, Any] = {field: copy.deepcopy(value) for field, value in self.set_fields.items()}
+        for field, amount in self.inc_fields.items():
+            changed[field] = (document.get(field) or 0) + amount
+        for field, match in self.pull_matches.items():
+            changed[field] = [item for item in document.get(field) or [] if not _matches_item(item, match)]
+        for field, items in self.push_items.items():
+            changed[field] = list(changed.get(field, document.get(field) or [])) + copy.deepcopy(items)
+        changed[VERSION_FIELD] = (document.get(VERSION_FIELD) or 0) + 1
+        return changed
+
+
+def _matches_item(item: Any, match: Dict[str, Any]) -> bool:
+    return isinstance(item, dict) and all(item.get(key) == value for key, value in match.items())
+
+
+def version_filter(expected_version: int) -> Dict[str, Any]:
+    # I documenti creati prima dell'introduzione della versione non hanno il campo: valgono come versione 0
+    if expected_version == 0:
+        return {VERSION_FIELD: {"$in": [0, None]}}
+    return {VERSION_FIELD: expected_version}
+
+
+def update_user(storage: Storage, user_id: str, update: UserUpdate, expected_version: Optional[int] = None) -> bool:
+    """
+    Applica `update` al documento utente `user_id` in `storage`. Restituisce False se il documento
+    non esiste o, con `expected_version`, se la sua versione è cambiata; solleva `UserStoreError`
+    se il gateway rifiuta l'aggiornamento.
+    """
+    try:
+        if storage.supports_update_operators:
+            try:
+                return _update_one(storage, user_id, update, expected_version)
+            except UnsupportedOperation:
+                pass  # Gateway senza `update_one`: da qui in poi lettura e riscrittura dei campi modificati
+        return _read_modify_write(storage, user_id, update, expected_version)
+    except StorageError as error:
+        raise UserStoreError(str(error)) from error
+
+
+def _update_one(storage: Storage, user_id: str, update: UserUpdate, expected_version: Optional[int]) -> bool:
+    filter_data: Dict[str, Any] = {"_id": user_id}
+    if expected_version is not None:
+        filter_data.update(version_filter(expected_version))
+    return storage.update_one(USERS_DATABASE, USERS_COLLECTION, filter_data, update.to_mongo()) > 0
+
+
+def _read_modify_write(storage: Storage, user_id: str, update: UserUpdate, expected_version: Optional[int]) -> bool:
+    document = storage.get(USERS_DATABASE, USERS_COLLECTION, user_id)
+    if document is None:
+        return False
+    if expected_version is not None and (document.get(VERSION_FIELD) or 0) != expected_version:
+        return False
+    return storage.update(USERS_DATABASE, USERS_COLLECTION, user_id, update.apply(document))
@@ -1,28 +1,26 @@
-import json
-
 from fastapi import FastAPI, HTTPException, status, Depends
-from pydantic import BaseModel, EmailStr, Field
-from typing import List, Optional, Union, Any, Dict
+from pydantic import BaseModel, EmailStr, Field, PrivateAttr
+from typing import Callable, List, Optional, Union, Any, Dict, Tuple
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from jose import JWTError, jwt
-import requests
 from datetime import datetime, timedelta
 import os
 
+from app.invalidation import USER_TOPIC
+from app.profiling import span
+from app.resources import Resources, get_resources
+from app.storage import USERS_COLLECTION, USERS_DATABASE, StorageError
+from app.token_store import TokenInDB, TokenStoreError
+from app.user_store import VERSION_FIELD, UserStoreError, UserUpdate, update_user
 
-# Configurazione per il sistema di sicurezza
-SECRET_KEY = "your_secret_key"
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 30
-REFRESH_TOKEN_EXPIRE_DAYS = 7
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
-config_file = open("config.json")
-config_dict = json.load(config_file)
-# URL del servizio MongoDB
-MONGO_SERVICE_URL = config_dict["mongodb_service_url"]
+# Claim JWT con la generazione delle sessioni dell'utente al momento dell'emissione del token
+SESSION_GENERATION_CLAIM = "gen"
+# Claim JWT con l'identificativo della sessione di login, comune ai token di accesso e di refresh
+SESSION_ID_CLAIM = "sid"
 
 
 # Modello per i permessi
@@ -81,6 +79,8 @@ class UserInDB(User):
     id: str = Field("", alias="_id", title="ID Utente", description="ID univoco dell'utente nel database.")
     hashed_password: str = Field(..., title="Password Hashata", description="Password dell'utente in forma hashata per sicurezza.")
     databases: Optional[List[Dict[str, Union[str, int]]]] = Field([], title="Databases", description="Lista dei database creati dall'utente.")
+    session_generation: int = Field(0, title="Generazione Sessioni", description="Contatore incrementato per invalidare tutti i token emessi.")
+    version: int = Field(0, title="Versione", description="Versione del documento, incrementata a ogni aggiornamento.")
 
     class Config:
         json_schema_extra = {
@@ -95,6 +95,45 @@ class UserInDB(User):
             }
         }
 
+# Dati minimi dell'utente necessari per autenticazione e autorizzazione
+class Principal(BaseModel):
+    id: str = Field("", alias="_id", title="ID Utente", description="ID univoco dell'utente nel database.")
+    username: str = Field(..., title="Username", description="Nome utente unico per l'autenticazione.")
+    email: str = Field(..., title="Email", description="Email associata all'account dell'utente.")
+    disabled: Optional[bool] = Field(False, title="Disabilitato", description="Indica se l'account utente è disabilitato.")
+    hashed_password: str = Field(..., title="Password Hashata", description="Password dell'utente in forma hashata.")
+    databases: List[Dict[str, Union[str, int]]] = Field([], title="Databases", description="Lista dei database creati dall'utente.")
+    session_generation: int = Field(0, title="Generazione Sessioni", description="Generazione corrente delle sessioni dell'utente.")
+    version: int = Field(0, title="Versione", description="Versione del documento utente letto.")
+    _database_index: Dict[str, Dict[str, Union[str, int]]] = PrivateAttr(default_factory=dict)
+
+    class Config:
+        populate_by_name = True
+
+    def model_post_init(self, __context: Any):
+        self._database_index = {database["db_name"]: database for database in self.databases}
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "Principal":
+        """
+        Costruisce il `Principal` dal documento utente letto con `PRINCIPAL_FIELDS`. I permessi
+        delegati non fanno parte del `Principal`: li concede il proprietario del database e si
+        leggono dall'indice delle relazioni (`app.hierarchy`).
+        """
+        return cls(**document)
+
+    def database(self, db_name: str) -> Optional[Dict[str, Union[str, int]]]:
+        return self._database_index.get(db_name)
+
+
+# Campi del documento utente letti per costruire un `Principal`
+PRINCIPAL_FIELDS = ("_id", "username", "email", "disabled", "hashed_password", "databases", "session_generation",
+                    VERSION_FIELD)
+
+# Tentativi di un aggiornamento del documento utente in caso di conflitto di versione
+USER_UPDATE_RETRIES = 3
+
+
 class Token(BaseModel):
     access_token: str = Field(..., title="Token di Accesso", description="Token di accesso JWT.")
     token_type: str = Field(..., title="Tipo di Token", description="Tipo di token di autenticazione.")
@@ -105,13 +144,6 @@ class TokenData(BaseModel):
     username: Optional[str] = Field(None, title="Username", description="Nome utente estratto dal token JWT.")
 
 
-class TokenInDB(BaseModel):
-    username: str = Field(..., title="Username", description="Nome utente associato al token.")
-    token: str = Field(..., title="Token", description="Il token JWT.")
-    token_type: str = Field(..., title="Tipo di Token", description="Tipo di token, es. access_token o refresh_token.")
-    expires_at: str = Field(..., title="Data di Scadenza", description="Data e ora di scadenza del token in formato ISO 8601.")
-
-
 class UserDeleteRequest(BaseModel):
     username: str = Field(..., title="Username", description="Nome utente da eliminare.")
     email: EmailStr = Field(..., title="Email", description="Email associata all'utente.")
@@ -155,90 +187,220 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+def create_access_token(resources: Resources, data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = resources.key_ring.encode(to_encode)
     return encoded_jwt
 
 
-def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
+def create_refresh_token(resources: Resources, data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+        expire = datetime.utcnow() + timedelta(days=resources.settings.refresh_token_expire_days)
     to_encode.update({"exp": expire})
-    refresh_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    refresh_jwt = resources.key_ring.encode(to_encode)
     return refresh_jwt
 
 
-def store_token_in_db(username: str, token: Union[str, Any], token_type: str, expires_at: datetime):
+def store_token_in_db(resources: Resources, username: str, token: Union[str, Any], token_type: str, expires_at: datetime,
+                      session_id: Optional[str] = None):
     if not isinstance(token, str):
         token = str(token)
     token_data = TokenInDB(
         username=username,
         token=token,
         token_type=token_type,
-        expires_at=str(expires_at.isoformat())
+        expires_at=str(expires_at.isoformat()),
+        session_id=session_id
     )
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/tokens_collection/add_item", json=token_data.dict())
-    if response.status_code != 200:
+    try:
+        resources.token_store.store(token_data)
+    except TokenStoreError:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Errore durante la memorizzazione del token")
 
 
-def revoke_token_in_db(token: Union[str, Any]):
+def revoke_token_in_db(resources: Resources, token: Union[str, Any]):
     if not isinstance(token, str):
         token = str(token)
-    filter_data = {"token": token}
-    response = requests.delete(f"{MONGO_SERVICE_URL}/database/tokens_collection/delete_item", json=filter_data)
-    if response.status_code != 200:
+    try:
+        resources.token_store.revoke(token)
+    except TokenStoreError:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Errore durante la revoca del token")
+
+
+def revoke_session_in_db(resources: Resources, username: str, session_id: str):
+    """
+    Revoca tutti i token della sessione di login, compreso il token di refresh.
+    """
+    try:
+        resources.token_store.revoke_session(username, session_id)
+    except TokenStoreError:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Errore durante la revoca del token")
 
 
-def get_token_from_db(token: Union[str, Any]) -> Optional[TokenInDB]:
+def get_token_from_db(resources: Resources, token: Union[str, Any]) -> Optional[TokenInDB]:
     if not isinstance(token, str):
         token = str(token)
-    filter_data = {"token": token}
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/tokens_collection", json=filter_data)
-    if response.status_code == 200 and response.json():
-        token_data = response.json()[-1]  # Assuming only one token will match
-        return TokenInDB(**token_data)
-    return None
+    try:
+        return resources.token_store.get(token)
+    except TokenStoreError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Archivio dei token non disponibile")
+
 
+def find_user_document(resources: Resources, filter_data: Dict[str, Any],
+                       fields: Optional[Tuple[str, ...]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Recupera il documento dell'utente che corrisponde al filtro, limitato ai campi `fields` se indicati.
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+    Con MongoDB diretto i campi sono selezionati dal database; il gateway non supporta proiezioni e
+    restituisce i documenti completi, ridotti appena ricevuti, prima di qualsiasi validazione, così da
+    non validare relazioni e permessi annidati.
+    """
+    try:
+        users = resources.storage.find(USERS_DATABASE, USERS_COLLECTION, filter_data, fields)
+    except StorageError:
+        return None
+    if not users:
+        return None
+    return users[-1]  # Assuming only one user will match the filter
+
+
+def load_principal(resources: Resources, username: str) -> Optional[Principal]:
+    """
+    Legge il `Principal` dal gateway, senza passare dalla cache.
+    """
+    with span("user_lookup"):
+        user = find_user_document(resources, {"username": username}, PRINCIPAL_FIELDS)
+    if user is None:
+        return None
+    with span("user_validation"):
+        return Principal.from_document(user)
+
+
+def get_principal(resources: Resources, username: str) -> Optional[Principal]:
+    """
+    Restituisce il `Principal` dell'utente, dalla cache o con una lettura proiettata dal gateway.
+    """
+    principal = resources.principal_cache.get(username)
+    if principal is not None:
+        return principal
+    principal = load_principal(resources, username)
+    if principal is not None:
+        resources.principal_cache.set(username, principal)
+    return principal
+
+
+def get_token_claims(resources: Resources = Depends(get_resources), token: str = Depends(oauth2_scheme)) -> Dict[str, Any]:
+    """
+    Claim del token della richiesta, verificato e ancora registrato nell'archivio dei token.
+    Dipendenza condivisa nella stessa richiesta: il token viene decodificato una sola volta.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+        with span("jwt_decode"):
+            payload = resources.key_ring.decode(token)
+        if payload.get("sub") is None:
             raise credentials_exception
-        token_data = TokenData(username=username)
 
         # Check if the token is revoked
-        stored_token = get_token_from_db(token)
+        with span("token_lookup"):
+            stored_token = get_token_from_db(resources, token)
         if not stored_token or datetime.fromisoformat(stored_token.expires_at) < datetime.utcnow():
             raise credentials_exception
 
     except JWTError:
         raise credentials_exception
+    return payload
 
-    # Using a POST request with a filter in the body to get the specific user
-    filter_data = {"username": token_data.username}
-    response = requests.post(f"{MONGO_SERVICE_URL}/database/get_items/users_collection/", json=filter_data)
 
-    if response.status_code != 200 or not response.json():
-        raise credentials_exception
+def get_current_principal(resources: Resources = Depends(get_resources),
+                          payload: Dict[str, Any] = Depends(get_token_claims)) -> Principal:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    token_data = TokenData(username=payload["sub"])
 
-    user = response.json()[-1]  # Assuming only one user will match the username
+    principal = get_principal(resources, token_data.username)
+    if principal is None:
+        raise credentials_exception
 
-    return UserInDB(**user)
+    # I token emessi prima dell'ultimo "logout ovunque" o cambio password non sono più validi
+    if payload.get(SESSION_GENERATION_CLAIM, 0) != principal.session_generation:
+        raise credentials_exception
+    return principal
+
+
+def update_principal(resources: Resources, principal: Principal,
+                     build: Callable[[Principal], Optional[UserUpdate]]) -> Optional[Principal]:
+    """
+    Aggiorna il documento utente con concorrenza ottimistica: `build` riceve lo stato letto e
+    restituisce le modifiche (o None se non serve alcuna modifica); se nel frattempo il documento
+    è cambiato, lo stato viene riletto e `build` chiamata di nuovo.
+
+    Restituisce il `Principal` su cui è stato calcolato l'aggiornamento applicato. Solleva
+    `HTTPException` 409 se i conflitti persistono dopo `USER_UPDATE_RETRIES` tentativi.
+    """
+    for _ in range(USER_UPDATE_RETRIES):
+        update = build(principal)
+        if not update:
+            return principal
+        try:
+            if update_user(resources.storage, principal.id, update, expected_version=principal.version):
+                return principal
+        except UserStoreError:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                                detail="Errore durante l'aggiornamento delle informazioni dell'utente")
+        principal = load_principal(resources, principal.username)
+        if principal is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Utente non trovato")
+    raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                        detail="L'utente è stato modificato da un'altra richiesta, riprova")
+
+
+def bump_session_generation(resources: Resources, principal: Principal, fields: Optional[Dict[str, Any]] = None):
+    """
+    Invalida tutti i token dell'utente incrementando la generazione delle sessioni, con un'unica
+    scrittura sul documento utente (insieme agli eventuali altri `fields` da aggiornare).
+    """
+    update = UserUpdate().inc("session_generation")
+    for field, value in (fields or {}).items():
+        update.set(field, value)
+    try:
+        updated = update_user(resources.storage, principal.id, update)
+    except UserStoreError:
+        updated = False
+    if not updated:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail="Errore durante l'invalidazione delle sessioni")
+    resources.invalidation_bus.publish(USER_TOPIC, {"username": principal.username})
+
+
+def get_current_user(resources: Resources = Depends(get_resources),
+                     principal: Principal = Depends(get_current_principal)) -> UserInDB:
+    """
+    Profilo completo dell'utente corrente, incluse le relazioni con altri utenti.
+    Da usare solo negli endpoint che ne hanno bisogno: gli altri usano `get_current_principal`.
+    """
+    with span("user_profile_lookup"):
+        user = find_user_document(resources, {"username": principal.username})
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    with span("user_profile_validation"):
+        return UserInDB(**user)
@@ -0,0 +1,185 @@
+import asyncio
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+from app.memory_storage import MemoryStorage
+from app.storage import StorageError
+
+
+class FakeGateway:
+    """
+    Sostituto in memoria del servizio gateway MongoDB (`MONGO_SERVICE_URL`).
+
+    Emula le rotte usate dal backend con una latenza configurabile: `latency_ms` è il ritardo
+    di base di ogni chiamata, `jitter_ms` un ritardo casuale aggiuntivo e `operation_latency_ms`
+    permette di sovrascrivere il ritardo di base per singola operazione (es. `{"get_items": 20}`).
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 operation_latency_ms: Optional[Dict[str, float]] = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.operation_latency_ms = operation_latency_ms or {}
+        # I dati sono quelli dell'archivio in memoria del backend (`storage_backend: memory`)
+        self.storage = MemoryStorage()
+        self.calls: Dict[str, int] = {}
+        self.app = self._build_app()
+
+    @property
+    def databases(self) -> Dict[str, Dict[str, Dict[str, Dict[str, Any]]]]:
+        return self.storage.databases
+
+    @property
+    def schemas(self) -> Dict[str, List[Dict[str, str]]]:
+        return self.storage.schemas
+
+    # ----------------------------------------------------------------------------------
+    # Accesso diretto allo stato (usato dagli scenari per preparare i dati)
+    # ----------------------------------------------------------------------------------
+    def collection(self, db_name: str, collection_name: str) -> Dict[str, Dict[str, Any]]:
+        return self.storage.collection(db_name, collection_name)
+
+    def insert(self, db_name: str, collection_name: str, document: Dict[str, Any]) -> str:
+        return self.storage.insert(db_name, collection_name, document)
+
+    def find(self, db_name: str, collection_name: str, query: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        # Documenti senza copie: gli scenari possono modificarli direttamente
+        return self.storage.matching(db_name, collection_name, query)
+
+    # ----------------------------------------------------------------------------------
+    # Rotte HTTP
+    # ----------------------------------------------------------------------------------
+    async def _delay(self, operation: str):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        delay = self.operation_latency_ms.get(operation, self.latency_ms)
+        if self.jitter_ms:
+            delay += random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI(title="Fake MongoDB gateway")
+
+        def route(method: str, path: str):
+            # Il backend chiama alcune rotte con e senza "/" finale: registra entrambe le forme
+            def decorator(handler):
+                app.add_api_route(path.rstrip("/"), handler, methods=[method])
+                app.add_api_route(path.rstrip("/") + "/", handler, methods=[method])
+                return handler
+            return decorator
+
+        async def json_body(request: Request) -> Any:
+            body = await request.body()
+            return await request.json() if body else {}
+
+        @route("POST", "/create_database/")
+        async def create_database(request: Request):
+            await self._delay("create_database")
+            credentials = await json_body(request)
+            self.storage.create_database(credentials["db_name"], credentials)
+            return {"message": f"Database '{credentials['db_name']}' created successfully."}
+
+        @route("DELETE", "/delete_database/{db_name}/")
+        async def delete_database(db_name: str):
+            await self._delay("delete_database")
+            if not self.storage.delete_database(db_name):
+                return JSONResponse(status_code=404, content={"detail": "Database not found"})
+            return {"message": f"Database '{db_name}' deleted successfully."}
+
+        @route("POST", "/upload_schema/{db_name}/{collection_name}/")
+        async def upload_schema(db_name: str, collection_name: str, request: Request):
+            await self._delay("upload_schema")
+            payload = await json_body(request)
+            self.storage.upload_schema(db_name, collection_name, payload.get("files", []))
+            return {"message": "Schemas uploaded successfully."}
+
+        @route("POST", "/{db_name}/create_collection/")
+        async def create_collection(db_name: str, collection_name: str):
+            await self._delay("create_collection")
+            self.storage.create_collection(db_name, collection_name)
+            return {"message": f"Collection '{collection_name}' created successfully."}
+
+        @route("GET", "/{db_name}/list_collections/")
+        async def list_collections(db_name: str):
+            await self._delay("list_collections")
+            return self.storage.list_collections(db_name)
+
+        @route("DELETE", "/{db_name}/delete_collection/{collection_name}/")
+        async def delete_collection(db_name: str, collection_name: str):
+            await self._delay("delete_collection")
+            self.storage.delete_collection(db_name, collection_name)
+            return {"message": f"Collection '{collection_name}' deleted successfully."}
+
+        @route("POST", "/{db_name}/search")
+        async def search(db_name: str, request: Request):
+            await self._delay("search")
+            payload = await json_body(request)
+            return self.storage.search(db_name, payload.get("filter") or {}, int(payload.get("skip", 0)),
+                                       int(payload.get("size", 10)))
+
+        @route("POST", "/{db_name}/aggregate/{collection_name}/")
+        async def aggregate(db_name: str, collection_name: str, request: Request):
+            await self._delay("aggregate")
+            payload = await json_body(request)
+            try:
+                # Il limite di dimensione è applicato dal backend durante la lettura della risposta
+                body = self.storage.aggregate(db_name, collection_name, payload.get("pipeline") or [],
+                                              payload.get("options") or {}, max_bytes=sys.maxsize)
+            except StorageError as error:
+                return JSONResponse(status_code=400, content={"detail": str(error)})
+            return Response(content=body, media_type="application/json")
+
+        @route("POST", "/{db_name}/get_items/{collection_name}/")
+        async def get_items(db_name: str, collection_name: str, request: Request):
+            await self._delay("get_items")
+            return self.storage.find(db_name, collection_name, await json_body(request))
+
+        @route("GET", "/{db_name}/get_item/{collection_name}/{item_id}/")
+        async def get_item(db_name: str, collection_name: str, item_id: str):
+            await self._delay("get_item")
+            document = self.storage.get(db_name, collection_name, item_id)
+            if document is None:
+                return JSONResponse(status_code=404, content={"detail": "Item not found"})
+            return document
+
+        @route("POST", "/{db_name}/{collection_name}/add_item/")
+        async def add_item(db_name: str, collection_name: str, request: Request):
+            await self._delay("add_item")
+            item_id = self.storage.insert(db_name, collection_name, await json_body(request))
+            return {"message": "Item added successfully.", "id": item_id}
+
+        @route("PUT", "/{db_name}/update_item/{collection_name}/{item_id}/")
+        async def update_item(db_name: str, collection_name: str, item_id: str, request: Request):
+            await self._delay("update_item")
+            if not self.storage.update(db_name, collection_name, item_id, await json_body(request)):
+                return JSONResponse(status_code=404, content={"detail": "Item not found"})
+            return {"message": "Item updated successfully."}
+
+        @route("PATCH", "/{db_name}/update_one/{collection_name}/")
+        async def update_one(db_name: str, collection_name: str, request: Request):
+            # Aggiornamento atomico del primo documento che corrisponde al filtro
+            await self._delay("update_one")
+            payload = await json_body(request)
+            matched = self.storage.update_one(db_name, collection_name, payload.get("filter") or {},
+                                              payload.get("update") or {})
+            return {"matched_count": matched, "modified_count": matched}
+
+        @route("DELETE", "/{db_name}/delete_item/{collection_name}/{item_id}/")
+        async def delete_item(db_name: str, collection_name: str, item_id: str):
+            await self._delay("delete_item")
+            if not self.storage.delete(db_name, collection_name, item_id):
+                return JSONResponse(status_code=404, content={"detail": "Item not found"})
+            return {"message": "Item deleted successfully."}
+
+        @route("DELETE", "/{db_name}/{collection_name}/delete_item/")
+        async def delete_items_by_filter(db_name: str, collection_name: str, request: Request):
+            # Variante usata per la revoca dei token: il filtro è nel corpo della richiesta
+            await self._delay("delete_item")
+            deleted = self.storage.delete_many(db_name, collection_name, await json_body(request))
+            return {"message": "Items deleted successfully.", "deleted_count": deleted}
+
+        return app
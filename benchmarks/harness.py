@@ -0,0 +1,127 @@
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+
+# Radice del repository: il backend legge `config.json` dalla directory corrente
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ThreadedServer:
+    """
+    Esegue un'applicazione ASGI con uvicorn in un thread del processo corrente.
+    """
+
+    def __init__(self, app, host: str = "127.0.0.1"):
+        # Porta libera scelta dal sistema operativo. Il socket non viene passato a uvicorn:
+        # i socket passati con `sockets=` non ricevono TCP_NODELAY e le connessioni keep-alive
+        # subirebbero i ritardi dell'ACK ritardato (~40 ms per richiesta).
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.bind((host, 0))
+            self.host, self.port = probe.getsockname()
+        config = uvicorn.Config(app, host=self.host, port=self.port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self, timeout: float = 10.0) -> "ThreadedServer":
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"Server on {self.url} did not start")
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def load_backend_app(gateway_url: str):
+    """
+    Importa il backend puntandolo al gateway indicato.
+    Va chiamata prima di qualsiasi altro import del pacchetto `app`.
+    """
+    os.environ["MONGO_SERVICE_URL"] = gateway_url
+    os.chdir(REPO_ROOT)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    from app.main import app
+    return app
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    Percentile con il metodo nearest-rank su una lista già ordinata.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies_ms: List[float], errors: int, duration_s: float) -> Dict[str, Any]:
+    ordered = sorted(latencies_ms)
+    count = len(ordered)
+    return {
+        "requests": count,
+        "errors": errors,
+        "duration_s": round(duration_s, 4),
+        "throughput_rps": round(count / duration_s, 2) if duration_s > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(sum(ordered) / count, 3) if count else 0.0,
+            "p50": round(percentile(ordered, 0.50), 3),
+            "p95": round(percentile(ordered, 0.95), 3),
+            "p99": round(percentile(ordered, 0.99), 3),
+            "max": round(ordered[-1], 3) if count else 0.0,
+        },
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_metadata(**parameters) -> Dict[str, Any]:
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": parameters,
+    }
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any]) -> str:
+    """
+    Tabella testuale con le variazioni percentuali tra due report (throughput e percentili).
+    """
+    lines = [f"{'scenario':<14}{'metric':<16}{'baseline':>12}{'current':>12}{'delta':>10}"]
+    for name, result in current.get("scenarios", {}).items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        metrics = [("throughput_rps", previous["throughput_rps"], result["throughput_rps"])]
+        metrics += [(f"latency_{key}", previous["latency_ms"][key], result["latency_ms"][key])
+                    for key in ("p50", "p95", "p99")]
+        for metric, old, new in metrics:
+            delta = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            lines.append(f"{name:<14}{metric:<16}{old:>12.2f}{new:>12.2f}{delta:>10}")
+    return "\n".join(lines)
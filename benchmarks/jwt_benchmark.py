@@ -0,0 +1,85 @@
+"""
+Micro-benchmark del costo di firma e verifica dei token per algoritmo (HS256, RS256, ES256),
+misurato attraverso `KeyRing` come negli endpoint, con chiavi generate in una directory temporanea.
+
+Esempio:
+    python -m benchmarks.jwt_benchmark --iterations 2000 --output jwt.json
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from benchmarks.harness import REPO_ROOT, percentile, run_metadata
+
+sys.path.insert(0, REPO_ROOT)
+from app.signing import KeyRing, generate_key  # noqa: E402
+
+ALGORITHMS = ("HS256", "RS256", "ES256")
+
+
+def measure(operation: Callable[[], Any], iterations: int, repeats: int) -> Dict[str, float]:
+    """
+    Microsecondi per operazione, misurati singolarmente: mediana e p95 su `repeats * iterations` chiamate.
+    """
+    samples: List[float] = []
+    for _ in range(repeats):
+        for _ in range(iterations):
+            start = time.perf_counter()
+            operation()
+            samples.append((time.perf_counter() - start) * 1_000_000)
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        "median_us": round(median, 2),
+        "p95_us": round(percentile(samples, 0.95), 2),
+        "ops_per_second": round(1_000_000 / median, 1),
+    }
+
+
+def benchmark(algorithm: str, keys_dir: str, iterations: int, repeats: int) -> Dict[str, Any]:
+    kid = None if algorithm == "HS256" else f"bench-{algorithm.lower()}"
+    if kid is not None:
+        generate_key(algorithm, keys_dir, kid)
+    key_ring = KeyRing(algorithm, "benchmark-secret", keys_dir, active_kid=kid)
+    claims = {"sub": "jwt-bench", "gen": 0, "exp": datetime.utcnow() + timedelta(hours=1)}
+    token = key_ring.encode(claims)
+    key_ring.decode(token)
+    return {
+        "token_bytes": len(token),
+        "sign": measure(lambda: key_ring.encode(claims), iterations, repeats),
+        "verify": measure(lambda: key_ring.decode(token), iterations, repeats),
+    }
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Costo di firma e verifica dei JWT per algoritmo")
+    parser.add_argument("--iterations", type=int, default=1000, help="Operazioni per ripetizione")
+    parser.add_argument("--repeats", type=int, default=5, help="Ripetizioni per misura")
+    parser.add_argument("--algorithms", nargs="+", choices=ALGORITHMS, default=list(ALGORITHMS))
+    parser.add_argument("--output", help="File in cui salvare il report JSON (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report: Dict[str, Any] = {
+        "meta": run_metadata(iterations=args.iterations, repeats=args.repeats),
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as keys_dir:
+        for algorithm in args.algorithms:
+            report["results"][algorithm] = benchmark(algorithm, keys_dir, args.iterations, args.repeats)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
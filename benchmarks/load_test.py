@@ -0,0 +1,202 @@
+"""
+Benchmark di carico del backend contro un gateway MongoDB finto eseguito nello stesso processo.
+
+Esempio:
+    python -m benchmarks.load_test --concurrency 16 --requests 500 --output bench.json
+    python -m benchmarks.load_test --compare bench.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import requests
+
+from benchmarks.fake_gateway import FakeGateway
+from benchmarks.harness import ThreadedServer, compare_reports, load_backend_app, run_metadata, summarize
+
+SCENARIOS = ["register", "login", "me", "get_items", "search", "bulk_write"]
+PASSWORD = "BenchPassword123!"
+COLLECTION = "items"
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    # Una sessione per thread: le connessioni keep-alive vengono riutilizzate tra le richieste
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+class BenchUser:
+    def __init__(self, username: str):
+        self.username = username
+        self.token = ""
+        self.db_name = f"{username}-bench"
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+
+class LoadTest:
+    def __init__(self, backend_url: str, gateway: FakeGateway, args: argparse.Namespace):
+        self.url = backend_url
+        self.gateway = gateway
+        self.args = args
+        self.users: List[BenchUser] = []
+
+    # ----------------------------------------------------------------------------------
+    # Preparazione dei dati
+    # ----------------------------------------------------------------------------------
+    def setup(self):
+        for index in range(self.args.users):
+            user = BenchUser(f"bench{index}-{uuid.uuid4().hex[:6]}")
+            self._register(user.username)
+            user.token = self._login(user.username)
+            self._seed_database(user)
+            self.users.append(user)
+
+    def _register(self, username: str) -> requests.Response:
+        return _session().post(f"{self.url}/register/", json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "hashed_password": PASSWORD,
+        })
+
+    def _login(self, username: str) -> str:
+        response = _session().post(f"{self.url}/login/", data={"username": username, "password": PASSWORD})
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    def _seed_database(self, user: BenchUser):
+        # Il database viene registrato direttamente nel gateway finto, senza passare dal backend
+        document = self.gateway.find("database", "users_collection", {"username": user.username})[-1]
+        document["databases"] = [{"db_name": user.db_name, "host": "localhost", "port": 27017}]
+        for index in range(self.args.documents):
+            self.gateway.insert(user.db_name, COLLECTION, {"index": index, "group": index % 10, "payload": "x" * 64})
+
+    # ----------------------------------------------------------------------------------
+    # Operazioni dei singoli scenari
+    # ----------------------------------------------------------------------------------
+    def op_register(self, user: BenchUser) -> bool:
+        return self._register(f"reg-{uuid.uuid4().hex}").status_code == 200
+
+    def op_login(self, user: BenchUser) -> bool:
+        response = _session().post(f"{self.url}/login/", data={"username": user.username, "password": PASSWORD})
+        return response.status_code == 200
+
+    def op_me(self, user: BenchUser) -> bool:
+        return _session().get(f"{self.url}/users_collection/me/", headers=user.headers).status_code == 200
+
+    def op_get_items(self, user: BenchUser) -> bool:
+        response = _session().post(f"{self.url}/mongo/{user.db_name}/get_items/{COLLECTION}/",
+                                   json={"group": 3}, headers=user.headers)
+        return response.status_code == 200
+
+    def op_search(self, user: BenchUser) -> bool:
+        response = _session().post(f"{self.url}/mongo/{user.db_name}/search", params={"skip": 0, "size": 20},
+                                   json={"group": {"$in": [1, 2]}}, headers=user.headers)
+        return response.status_code == 200
+
+    def op_bulk_write(self, user: BenchUser) -> bool:
+        ok = True
+        for index in range(self.args.bulk_size):
+            response = _session().post(f"{self.url}/mongo/{user.db_name}/{COLLECTION}/add_item/",
+                                       json={"index": index, "group": index % 10, "payload": "y" * 64},
+                                       headers=user.headers)
+            ok = ok and response.status_code == 200
+        return ok
+
+    # ----------------------------------------------------------------------------------
+    # Esecuzione
+    # ----------------------------------------------------------------------------------
+    def run_scenario(self, name: str) -> Dict[str, Any]:
+        operation: Callable[[BenchUser], bool] = getattr(self, f"op_{name}")
+
+        def timed(index: int) -> Tuple[float, bool]:
+            user = self.users[index % len(self.users)]
+            start = time.perf_counter()
+            try:
+                ok = operation(user)
+            except requests.RequestException:
+                ok = False
+            return (time.perf_counter() - start) * 1000, ok
+
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(timed, range(self.args.warmup)))
+            start = time.perf_counter()
+            results = list(executor.map(timed, range(self.args.requests)))
+            duration = time.perf_counter() - start
+
+        latencies = [latency for latency, _ in results]
+        errors = sum(1 for _, ok in results if not ok)
+        return summarize(latencies, errors, duration)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test del backend con gateway MongoDB finto in-process")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Scenari da eseguire, separati da virgola ({', '.join(SCENARIOS)})")
+    parser.add_argument("--concurrency", type=int, default=16, help="Client concorrenti")
+    parser.add_argument("--requests", type=int, default=200, help="Operazioni misurate per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="Operazioni di riscaldamento non misurate")
+    parser.add_argument("--users", type=int, default=8, help="Utenti preparati prima degli scenari")
+    parser.add_argument("--documents", type=int, default=200, help="Documenti per collezione di ogni utente")
+    parser.add_argument("--bulk-size", type=int, default=10, help="Inserimenti per operazione di bulk_write")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Latenza di base del gateway finto")
+    parser.add_argument("--jitter-ms", type=float, default=1.0, help="Latenza casuale aggiuntiva del gateway finto")
+    parser.add_argument("--token-store", choices=["gateway", "sqlite"],
+                        help="Archivio dei token del backend (default: quello della configurazione)")
+    parser.add_argument("--output", help="File in cui salvare il report JSON (default: stdout)")
+    parser.add_argument("--compare", help="Report JSON di riferimento con cui confrontare i risultati")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str]) -> int:
+    args = parse_args(argv)
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        print(f"Scenari sconosciuti: {', '.join(sorted(unknown))}", file=sys.stderr)
+        return 2
+
+    if args.token_store:
+        os.environ["TOKEN_STORE_BACKEND"] = args.token_store
+    gateway = FakeGateway(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    gateway_server = ThreadedServer(gateway.app).start()
+    backend_server = ThreadedServer(load_backend_app(gateway_server.url)).start()
+    try:
+        load_test = LoadTest(backend_server.url, gateway, args)
+        load_test.setup()
+        report = {
+            "meta": run_metadata(**{key: value for key, value in vars(args).items()
+                                    if key not in ("output", "compare")}),
+            "scenarios": {name: load_test.run_scenario(name) for name in scenarios},
+            "gateway_calls": dict(gateway.calls),
+        }
+    finally:
+        backend_server.stop()
+        gateway_server.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            print(compare_reports(json.load(baseline_file), report), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,135 @@
+"""
+Benchmark dei tempi di avvio: import del backend, `create_app()`, completamento del lifespan
+e latenza delle prime richieste, con e senza riscaldamento.
+
+Ogni misura viene eseguita in un interprete nuovo, per includere i costi di import e di primo utilizzo.
+
+Esempio:
+    python -m benchmarks.startup_benchmark --runs 5 --latency-ms 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from benchmarks.fake_gateway import FakeGateway
+from benchmarks.harness import REPO_ROOT, ThreadedServer, run_metadata
+
+USERNAME = "startup-bench"
+
+
+def child(gateway_url: str, token: str) -> Dict[str, Any]:
+    """
+    Misure eseguite nel processo figlio; i tempi sono in millisecondi.
+    """
+    import requests
+
+    timings: Dict[str, Any] = {}
+    start = time.perf_counter()
+    os.environ["MONGO_SERVICE_URL"] = gateway_url
+    sys.path.insert(0, REPO_ROOT)
+    from app.main import create_app
+    timings["import_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    app = create_app()
+    timings["create_app_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    server = ThreadedServer(app).start()
+    timings["ready_ms"] = (time.perf_counter() - start) * 1000
+
+    client = requests.Session()
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies: List[float] = []
+    try:
+        for _ in range(3):
+            start = time.perf_counter()
+            response = client.get(f"{server.url}/users_collection/me/", headers=headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+        start = time.perf_counter()
+        client.get(f"{server.url}/openapi.json").raise_for_status()
+        timings["first_openapi_ms"] = (time.perf_counter() - start) * 1000
+    finally:
+        server.stop()
+    timings["first_request_ms"], timings["second_request_ms"], timings["third_request_ms"] = latencies
+    return timings
+
+
+def seed(gateway: FakeGateway, gateway_url: str) -> str:
+    os.environ["MONGO_SERVICE_URL"] = gateway_url
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    from app.resources import Resources
+    from app.settings import get_settings
+    from app.utils import create_access_token, get_password_hash, store_token_in_db
+
+    gateway.insert("database", "users_collection", {
+        "username": USERNAME,
+        "email": f"{USERNAME}@example.com",
+        "hashed_password": get_password_hash("password"),
+        "managed_users": [],
+        "manager_users": [],
+        "databases": [],
+    })
+    resources = Resources(get_settings())
+    try:
+        token = create_access_token(resources, {"sub": USERNAME}, expires_delta=timedelta(hours=1))
+        # Registrato nell'archivio dei token configurato, come al login
+        store_token_in_db(resources, USERNAME, token, "access_token", datetime.utcnow() + timedelta(hours=1))
+    finally:
+        resources.stop()
+    return token
+
+
+def run_child(gateway_url: str, token: str, warmup: bool) -> Dict[str, Any]:
+    env = dict(os.environ, WARMUP_ENABLED="true" if warmup else "false", PYTHONPATH=REPO_ROOT)
+    output = subprocess.check_output(
+        [sys.executable, "-m", "benchmarks.startup_benchmark", "--child", gateway_url, token],
+        cwd=REPO_ROOT, env=env, text=True,
+    )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark dei tempi di avvio del backend")
+    parser.add_argument("--runs", type=int, default=5, help="Avvii misurati per configurazione")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Latenza del gateway finto")
+    parser.add_argument("--output", help="File in cui salvare il report JSON (default: stdout)")
+    parser.add_argument("--child", nargs=2, metavar=("GATEWAY_URL", "TOKEN"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(child(*args.child)))
+        return 0
+
+    gateway = FakeGateway(latency_ms=args.latency_ms)
+    server = ThreadedServer(gateway.app).start()
+    try:
+        token = seed(gateway, server.url)
+        report: Dict[str, Any] = {"meta": run_metadata(runs=args.runs, latency_ms=args.latency_ms), "results": {}}
+        for warmup in (False, True):
+            runs = [run_child(server.url, token, warmup) for _ in range(args.runs)]
+            report["results"]["warm" if warmup else "cold"] = {
+                metric: round(statistics.median(run[metric] for run in runs), 3) for metric in runs[0]
+            }
+    finally:
+        server.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
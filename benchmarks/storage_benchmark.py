@@ -0,0 +1,187 @@
+"""
+Micro-benchmark delle operazioni sui documenti per archivio dei dati (`storage_backend`):
+gateway HTTP (il gateway finto in un thread, o uno reale con `--gateway-url`), memoria e,
+con `--mongodb-uri` e `pymongo` installato, MongoDB diretto con il driver sincrono (`mongodb`) e con
+quello asincrono delle rotte sui documenti (`mongodb-async`).
+
+Ogni archivio riceve una collezione di prova con `--documents` documenti, eliminata al termine.
+
+Esempio:
+    python -m benchmarks.storage_benchmark --iterations 500 --mongodb-uri mongodb://localhost:27017 --output storage.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import sys
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List
+
+import requests
+
+from benchmarks.fake_gateway import FakeGateway
+from benchmarks.harness import REPO_ROOT, ThreadedServer, percentile, run_metadata
+
+sys.path.insert(0, REPO_ROOT)
+from app.async_storage import AsyncMongoStorage, AsyncStorage  # noqa: E402
+from app.memory_storage import MemoryStorage  # noqa: E402
+from app.storage import GatewayStorage, MongoStorage, Storage, pymongo  # noqa: E402
+
+BACKENDS = ("gateway", "memory", "mongodb", "mongodb-async")
+DATABASE = "storage-bench"
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    samples.sort()
+    median = statistics.median(samples)
+    return {
+        "median_us": round(median, 2),
+        "p95_us": round(percentile(samples, 0.95), 2),
+        "ops_per_second": round(1_000_000 / median, 1),
+    }
+
+
+def measure(operation: Callable[[int], Any], iterations: int, repeats: int) -> Dict[str, float]:
+    """
+    Microsecondi per operazione, misurati singolarmente: mediana e p95 su `repeats * iterations` chiamate.
+    L'operazione riceve il numero progressivo della chiamata.
+    """
+    samples: List[float] = []
+    counter = itertools.count()
+    for _ in range(repeats):
+        for _ in range(iterations):
+            index = next(counter)
+            start = time.perf_counter()
+            operation(index)
+            samples.append((time.perf_counter() - start) * 1_000_000)
+    return summarize(samples)
+
+
+async def measure_async(operation: Callable[[int], Awaitable[Any]], iterations: int, repeats: int) -> Dict[str, float]:
+    """
+    Come `measure`, per un'operazione asincrona attesa nel loop degli eventi.
+    """
+    samples: List[float] = []
+    counter = itertools.count()
+    for _ in range(repeats):
+        for _ in range(iterations):
+            index = next(counter)
+            start = time.perf_counter()
+            await operation(index)
+            samples.append((time.perf_counter() - start) * 1_000_000)
+    return summarize(samples)
+
+
+def benchmark(storage: Storage, documents: int, iterations: int, repeats: int) -> Dict[str, Any]:
+    collection = f"bench_{uuid.uuid4().hex[:8]}"
+    storage.create_collection(DATABASE, collection)
+    try:
+        seed = [{"group": i % 10, "n": i, "payload": "x" * 64} for i in range(documents)]
+        storage.insert_many(DATABASE, collection, seed, concurrency=8)
+        ids = [document["_id"] for document in storage.find(DATABASE, collection, fields=["_id"])]
+        pipeline = [{"$match": {"group": 3}}, {"$count": "n"}]
+        return {
+            "insert": measure(lambda i: storage.insert(DATABASE, collection, {"group": -1, "n": i}),
+                              iterations, repeats),
+            "get": measure(lambda i: storage.get(DATABASE, collection, ids[i % len(ids)]), iterations, repeats),
+            "find": measure(lambda i: storage.find(DATABASE, collection, {"n": i % documents}), iterations, repeats),
+            "update_one": measure(lambda i: storage.update_one(DATABASE, collection, {"_id": ids[i % len(ids)]},
+                                                               {"$set": {"n": i}}), iterations, repeats),
+            "aggregate_count": measure(lambda i: storage.aggregate(DATABASE, collection, pipeline, {}, sys.maxsize),
+                                       iterations, repeats),
+        }
+    finally:
+        storage.delete_collection(DATABASE, collection)
+
+
+def benchmark_async(storage: Storage, async_storage: AsyncStorage, documents: int, iterations: int,
+                    repeats: int) -> Dict[str, Any]:
+    # Le operazioni delle rotte sui documenti; la collezione viene preparata con l'archivio sincrono
+    collection = f"bench_{uuid.uuid4().hex[:8]}"
+    storage.create_collection(DATABASE, collection)
+    try:
+        seed = [{"group": i % 10, "n": i, "payload": "x" * 64} for i in range(documents)]
+        storage.insert_many(DATABASE, collection, seed)
+        ids = [document["_id"] for document in storage.find(DATABASE, collection, fields=["_id"])]
+        pipeline = [{"$match": {"group": 3}}, {"$count": "n"}]
+
+        async def run() -> Dict[str, Any]:
+            try:
+                return {
+                    "insert": await measure_async(
+                        lambda i: async_storage.add_item(DATABASE, collection, {"group": -1, "n": i}), iterations, repeats),
+                    "get": await measure_async(lambda i: async_storage.get(DATABASE, collection, ids[i % len(ids)]),
+                                               iterations, repeats),
+                    "find": await measure_async(lambda i: async_storage.find(DATABASE, collection, {"n": i % documents}),
+                                                iterations, repeats),
+                    "update": await measure_async(
+                        lambda i: async_storage.update(DATABASE, collection, ids[i % len(ids)], {"n": i}), iterations, repeats),
+                    "aggregate_count": await measure_async(
+                        lambda i: async_storage.aggregate(DATABASE, collection, pipeline, {}, sys.maxsize), iterations, repeats),
+                }
+            finally:
+                await async_storage.close()
+
+        return asyncio.run(run())
+    finally:
+        storage.delete_collection(DATABASE, collection)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Latenza delle operazioni sui documenti per archivio dei dati")
+    parser.add_argument("--iterations", type=int, default=200, help="Operazioni per ripetizione")
+    parser.add_argument("--repeats", type=int, default=3, help="Ripetizioni per misura")
+    parser.add_argument("--documents", type=int, default=1000, help="Documenti inseriti prima delle misure")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--gateway-url", help="Gateway reale da misurare (default: gateway finto in un thread)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latenza del gateway finto")
+    parser.add_argument("--mongodb-uri", help="URI di MongoDB; senza, il backend `mongodb` viene saltato")
+    parser.add_argument("--output", help="File in cui salvare il report JSON (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report: Dict[str, Any] = {
+        "meta": run_metadata(iterations=args.iterations, repeats=args.repeats, documents=args.documents,
+                             gateway_url=args.gateway_url, latency_ms=args.latency_ms),
+        "results": {},
+    }
+    for backend in args.backends:
+        server = None
+        if backend == "gateway":
+            gateway_url = args.gateway_url
+            if gateway_url is None:
+                server = ThreadedServer(FakeGateway(latency_ms=args.latency_ms).app).start()
+                gateway_url = server.url
+            # Operatori atomici: il gateway finto li supporta, come `gateway_atomic_updates`
+            storage: Storage = GatewayStorage(gateway_url, requests.Session(), atomic_updates=True)
+        elif backend == "memory":
+            storage = MemoryStorage()
+        else:
+            if args.mongodb_uri is None or pymongo is None:
+                report["results"][backend] = {"skipped": "serve --mongodb-uri e il pacchetto pymongo"}
+                continue
+            storage = MongoStorage(args.mongodb_uri, pool_size=8, timeout_seconds=10)
+        try:
+            if backend == "mongodb-async":
+                async_storage = AsyncMongoStorage(args.mongodb_uri, pool_size=8, timeout_seconds=10)
+                report["results"][backend] = benchmark_async(storage, async_storage, args.documents, args.iterations,
+                                                             args.repeats)
+            else:
+                report["results"][backend] = benchmark(storage, args.documents, args.iterations, args.repeats)
+        finally:
+            storage.close()
+            if server is not None:
+                server.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+"""
+Configurazione comune dei test.
+
+Il backend viene importato con l'archivio dei dati in memoria (`storage_backend: memory`) e con file
+temporanei per token, job, chiavi e socket di invalidazione: i test non richiedono il gateway,
+MongoDB o altri servizi. Le impostazioni vanno fissate prima del primo import del pacchetto `app`.
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Callable, Dict
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix="backend-tests-")
+
+os.environ.update({
+    "STORAGE_BACKEND": "memory",
+    "TOKEN_STORE_PATH": os.path.join(TEST_DIR, "tokens.sqlite3"),
+    "JOBS_STORE_PATH": os.path.join(TEST_DIR, "jobs.sqlite3"),
+    "JOBS_RETRY_DELAY_SECONDS": "0",
+    "JOBS_POLL_SECONDS": "0.05",
+    "INVALIDATION_SOCKET_DIR": os.path.join(TEST_DIR, "invalidation"),
+    "JWT_KEYS_DIR": os.path.join(TEST_DIR, "keys"),
+    "WARMUP_ENABLED": "false",
+    # Diverso dal default di AnyIO (40), per verificare che il ciclo di vita lo applichi
+    "THREADPOOL_THREADS": "24",
+})
+# Il backend legge `config.json` dalla directory corrente
+os.chdir(REPO_ROOT)
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+PASSWORD = "password123"
+
+
+class Account:
+    """
+    Utente registrato durante un test, con i token del suo login.
+    """
+
+    def __init__(self, username: str, access_token: str, refresh_token: str):
+        self.username = username
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def resources(client):
+    return client.app.state.resources
+
+
+@pytest.fixture
+def storage(resources):
+    return resources.storage
+
+
+@pytest.fixture
+def make_account(client) -> Callable[..., Account]:
+    """
+    Registra un utente con nome univoco ed esegue il login.
+    """
+    def make(prefix: str = "user") -> Account:
+        username = f"{prefix}-{uuid.uuid4().hex[:8]}"
+        response = client.post("/register/", json={"username": username, "email": f"{username}@example.com",
+                                                   "hashed_password": PASSWORD})
+        assert response.status_code == 200, response.text
+        tokens = client.post("/login/", data={"username": username, "password": PASSWORD}).json()
+        return Account(username, tokens["access_token"], tokens["refresh_token"])
+
+    return make
+
+
+def wait_for_job(client, account: Account, job_id: str, timeout: float = 10) -> Dict[str, Any]:
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/mongo/jobs/{job_id}", headers=account.headers).json()
+        if job["status"] in ("succeeded", "failed") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def make_database(client) -> Callable[[Account, str], str]:
+    """
+    Crea un database dell'utente attendendo il job e ne restituisce il nome completo.
+    """
+    def make(account: Account, name: str = "db") -> str:
+        response = client.post("/mongo/create_user_database/", json={"db_name": name}, headers=account.headers)
+        assert response.status_code == 202, response.text
+        job = wait_for_job(client, account, response.json()["id"])
+        assert job["status"] == "succeeded", job
+        return job["result"]["db_name"]
+
+    return make
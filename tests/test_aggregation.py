@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+from app.aggregation import PipelineError, aggregate_options, validate_pipeline
+from app.settings import AggregationSettings
+
+LIMITS = AggregationSettings(max_stages=3, max_results=50, max_result_bytes=1024, max_time_ms=1000)
+
+
+def test_validate_pipeline_appends_limit():
+    pipeline = [{"$match": {"status": "paid"}}, {"$group": {"_id": "$customer", "total": {"$sum": "$amount"}}}]
+    assert validate_pipeline(pipeline, LIMITS) == pipeline + [{"$limit": 50}]
+    assert aggregate_options(LIMITS) == {"maxTimeMS": 1000, "allowDiskUse": False}
+
+
+@pytest.mark.parametrize("pipeline", [
+    [],
+    [{"$lookup": {"from": "other", "as": "joined"}}],
+    [{"$out": "copy"}],
+    [{"$match": {"$where": "this.a > 1"}}],
+    [{"$group": {"_id": None, "x": {"$accumulator": {}}}}],
+    [{"$limit": -1}],
+    [{"$skip": True}],
+    [{"$match": {}, "$limit": 1}],
+    [{"$match": {}}] * 4,
+])
+def test_validate_pipeline_rejects(pipeline):
+    with pytest.raises(PipelineError):
+        validate_pipeline(pipeline, LIMITS)
+
+
+@pytest.fixture
+def orders(client, make_account, make_database):
+    account = make_account()
+    db_name = make_database(account)
+    for index in range(6):
+        client.post(f"/mongo/{db_name}/orders/add_item/", json={"customer": "a" if index < 4 else "b", "amount": index},
+                    headers=account.headers)
+    for index in range(3):
+        client.post(f"/mongo/{db_name}/refunds/add_item/", json={"customer": "a", "amount": index}, headers=account.headers)
+    return account, db_name
+
+
+def test_aggregate_endpoint(client, orders):
+    account, db_name = orders
+    pipeline = [{"$group": {"_id": "$customer", "total": {"$sum": "$amount"}}}, {"$sort": {"_id": 1}}]
+    response = client.post(f"/mongo/{db_name}/orders/aggregate", json={"pipeline": pipeline}, headers=account.headers)
+    assert response.status_code == 200
+    assert response.json() == [{"_id": "a", "total": 6}, {"_id": "b", "total": 9}]
+
+    response = client.post(f"/mongo/{db_name}/orders/aggregate", json={"pipeline": [{"$out": "copy"}]},
+                           headers=account.headers)
+    assert response.status_code == 400
+
+
+def test_aggregate_result_size_is_limited(client, resources, orders, monkeypatch):
+    account, db_name = orders
+    monkeypatch.setattr(resources.settings.aggregation, "max_result_bytes", 20)
+    response = client.post(f"/mongo/{db_name}/orders/aggregate", json={"pipeline": [{"$match": {}}]},
+                           headers=account.headers)
+    assert response.status_code == 400
+
+
+def test_search_count_runs_collection_counts_in_parallel(client, resources, storage, orders, monkeypatch):
+    account, db_name = orders
+    for name in ("c1", "c2", "c3"):
+        storage.create_collection(db_name, name)
+    monkeypatch.setattr(resources.settings.aggregation, "count_concurrency", 2)
+
+    original_aggregate = storage.aggregate
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def slow_aggregate(*args, **kwargs):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        try:
+            return original_aggregate(*args, **kwargs)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    monkeypatch.setattr(storage, "aggregate", slow_aggregate)
+    response = client.post(f"/mongo/{db_name}/search", params={"count": True, "size": 2},
+                           json={"customer": "a"}, headers=account.headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert len(body["items"]) == 2
+    assert body["total"] == 7
+    assert peak[0] == 2
@@ -0,0 +1,41 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from benchmarks.fake_gateway import FakeGateway
+from benchmarks.harness import compare_reports, percentile, summarize
+
+
+def test_percentile_nearest_rank():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 1.0) == 100
+    assert percentile([], 0.5) == 0.0
+
+
+def test_summarize_and_compare():
+    baseline = {"scenarios": {"me": summarize([1.0, 2.0, 3.0, 4.0], errors=0, duration_s=2)}}
+    current = {"scenarios": {"me": summarize([1.0, 1.0, 2.0, 2.0], errors=1, duration_s=1),
+                             "new": summarize([1.0], errors=0, duration_s=1)}}
+    assert baseline["scenarios"]["me"]["throughput_rps"] == 2.0
+    assert current["scenarios"]["me"]["errors"] == 1
+
+    table = compare_reports(baseline, current).splitlines()
+    # Gli scenari assenti dal report di riferimento non vengono confrontati
+    assert len(table) == 1 + 4
+    assert table[1].split()[:2] == ["me", "throughput_rps"] and table[1].endswith("+100.0%")
+
+
+def test_fake_gateway_counts_calls_and_applies_latency():
+    gateway = FakeGateway(operation_latency_ms={"get_items": 50})
+    client = TestClient(gateway.app)
+
+    client.post("/create_database/", json={"db_name": "bench"})
+    item_id = client.post("/bench/items/add_item/", json={"name": "a"}).json()["id"]
+    assert client.get(f"/bench/get_item/items/{item_id}").json() == {"_id": item_id, "name": "a"}
+
+    start = time.perf_counter()
+    assert client.post("/bench/get_items/items/", json={"name": "a"}).json() == [{"_id": item_id, "name": "a"}]
+    assert time.perf_counter() - start >= 0.05
+    assert gateway.calls == {"create_database": 1, "add_item": 1, "get_item": 1, "get_items": 1}
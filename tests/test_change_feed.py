@@ -0,0 +1,140 @@
+import asyncio
+import json
+from typing import Any, Callable, Dict, List
+
+import pytest
+
+from app.change_feed import RESET_FRAME, ChangeFeed
+from app.invalidation import CHANGE_TOPIC, RESYNC_TOPIC, InvalidationBus
+
+
+class WorkerBus(InvalidationBus):
+    """
+    Canale di un worker simulato: più worker nello stesso processo, distinti dal nome del socket.
+    """
+
+    def __init__(self, socket_dir: str, name: str):
+        super().__init__(socket_dir)
+        self.name = name
+        self.sent: List[Dict[str, Any]] = []
+
+    @property
+    def worker_id(self) -> str:
+        return self.name
+
+    def publish(self, topic, payload, workers=None):
+        if topic == CHANGE_TOPIC:
+            self.sent.append({"payload": payload, "workers": None if workers is None else list(workers)})
+        return super().publish(topic, payload, workers)
+
+
+@pytest.fixture
+def make_worker(tmp_path):
+    workers: List[WorkerBus] = []
+
+    def make(name: str) -> ChangeFeed:
+        bus = WorkerBus(str(tmp_path), name)
+        bus.start()
+        workers.append(bus)
+        feed = ChangeFeed(bus, buffer_size=10, max_subscribers=10)
+        feed.start()
+        return feed
+
+    yield make
+    for bus in workers:
+        bus.stop()
+
+
+async def eventually(condition: Callable[[], bool]):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condizione non verificata")
+
+
+def frame_event(frame: bytes) -> Dict[str, Any]:
+    return json.loads(frame.decode().split("data: ", 1)[1])
+
+
+def test_publish_without_subscribers_sends_nothing(make_worker):
+    feed = make_worker("a")
+    feed.publish("insert", "db", "items", "1", {"name": "x"})
+    assert feed.bus.sent == []
+
+
+def test_events_reach_only_workers_with_subscribers(make_worker):
+    async def scenario():
+        a, b, c = make_worker("a"), make_worker("b"), make_worker("c")
+        subscription = b.subscribe("db", "items")
+        await eventually(lambda: "b" in a._remote)
+
+        a.publish("insert", "db", "items", "1", {"name": "x"})
+        a.publish("insert", "db", "other", "2", {"name": "y"})
+        event = frame_event(await asyncio.wait_for(subscription.queue.get(), 5))
+        assert event == {"type": "insert", "db": "db", "collection": "items", "id": "1", "document": {"name": "x"}}
+        # Solo il worker con iscritti riceve l'evento; la collezione senza iscritti non viene inviata
+        assert a.bus.sent == [{"payload": event, "workers": ["b"]}]
+        assert c.bus.sent == []
+
+        b.unsubscribe(subscription)
+        await eventually(lambda: "b" not in a._remote)
+        a.publish("update", "db", "items", "1", {"name": "z"})
+        assert len(a.bus.sent) == 1
+
+    asyncio.run(scenario())
+
+
+def test_new_worker_learns_existing_subscriptions(make_worker):
+    async def scenario():
+        b = make_worker("b")
+        b.subscribe("db", "items")
+        a = make_worker("a")
+        await eventually(lambda: a._remote.get("b") == {("db", "items")})
+
+    asyncio.run(scenario())
+
+
+def test_terminated_worker_is_forgotten(make_worker):
+    async def scenario():
+        a, b = make_worker("a"), make_worker("b")
+        b.subscribe("db", "items")
+        await eventually(lambda: "b" in a._remote)
+
+        # Worker terminato senza annunciarlo
+        b.bus.stop()
+        a.publish("delete", "db", "items", "1")
+        assert a._remote == {}
+        a.publish("delete", "db", "items", "2")
+        assert len(a.bus.sent) == 1
+
+    asyncio.run(scenario())
+
+
+def test_local_subscribers_do_not_use_the_channel(make_worker):
+    async def scenario():
+        a = make_worker("a")
+        subscription = a.subscribe("db", "items")
+        a.publish("delete", "db", "items", "1")
+        event = frame_event(await asyncio.wait_for(subscription.queue.get(), 5))
+        assert event["type"] == "delete"
+        assert a.bus.sent == []
+
+    asyncio.run(scenario())
+
+
+def test_resync_resets_subscribers(make_worker):
+    async def scenario():
+        a, b = make_worker("a"), make_worker("b")
+        subscription = a.subscribe("db", "items")
+        a.publish("delete", "db", "items", "1")
+        await eventually(lambda: "a" in b._remote)
+        b._remote.clear()
+
+        # Notifiche perse da "a": gli iscritti rileggono la collezione e gli annunci vengono ripetuti
+        a.bus._dispatch(RESYNC_TOPIC, {"worker": "b"})
+        assert await asyncio.wait_for(subscription.queue.get(), 5) == RESET_FRAME
+        assert subscription.queue.empty()
+        await eventually(lambda: "a" in b._remote)
+
+    asyncio.run(scenario())
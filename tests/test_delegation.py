@@ -0,0 +1,106 @@
+from typing import List, Tuple
+
+import pytest
+
+from app.invalidation import RELATIONS_TOPIC
+from app.permissions import ADMIN, READ, WRITE, PermissionRegistry, allows
+from app.storage import USERS_COLLECTION, USERS_DATABASE
+
+
+def test_permission_bitsets():
+    registry = PermissionRegistry()
+    assert [registry.bit(code) for code in ("read", "write", "read")] == [1, 2, 1]
+    assert registry.mask(["write", "export"]) == 2 | 4
+
+    assert allows(READ | WRITE, READ)
+    assert allows(READ | WRITE, READ | WRITE)
+    assert not allows(READ, READ | WRITE)
+    assert not allows(0, READ)
+    assert allows(ADMIN, READ | WRITE)
+
+
+def set_relations(resources, username: str, field: str, relations: List[Tuple[str, List[str]]]):
+    """
+    Scrive `managed_users` o `manager_users` nel documento utente, come uno strumento di amministrazione,
+    e pubblica la modifica delle relazioni dell'utente.
+    """
+    entries = [{"username": name, "email": f"{name}@example.com", "permissions": [{"code": code} for code in codes]}
+               for name, codes in relations]
+    assert resources.storage.update_one(USERS_DATABASE, USERS_COLLECTION, {"username": username},
+                                        {"$set": {field: entries}}) == 1
+    resources.invalidation_bus.publish(RELATIONS_TOPIC, {"usernames": [username]})
+
+
+@pytest.fixture
+def alice_database(client, make_account, make_database):
+    alice = make_account("alice")
+    db_name = make_database(alice)
+    assert client.post(f"/mongo/{db_name}/orders/add_item/", json={"n": 1}, headers=alice.headers).status_code == 200
+    return alice, db_name
+
+
+def test_manager_declared_relation_grants_no_access(client, resources, make_account, alice_database):
+    alice, db_name = alice_database
+    mallory = make_account("mallory")
+    set_relations(resources, mallory.username, "managed_users", [(alice.username, ["admin_access"])])
+
+    response = client.post(f"/mongo/{db_name}/get_items/orders/", headers=mallory.headers)
+    assert response.status_code == 403
+    response = client.delete(f"/mongo/{db_name}/delete_collection/orders/", headers=mallory.headers)
+    assert response.status_code == 403
+
+
+def test_owner_grants_permissions_to_its_managers(client, resources, make_account, alice_database):
+    alice, db_name = alice_database
+    bob = make_account("bob")
+    set_relations(resources, alice.username, "manager_users", [(bob.username, ["read_access"])])
+
+    managers = client.get("/users_collection/me/manager_users/all/", headers=alice.headers).json()
+    assert [(entry["username"], entry["permissions"]) for entry in managers] == [(bob.username, ["read_access"])]
+
+    response = client.post(f"/mongo/{db_name}/get_items/orders/", headers=bob.headers)
+    assert response.status_code == 200
+    assert [document["n"] for document in response.json()] == [1]
+    # Sola lettura: scrittura e amministrazione restano negate
+    assert client.post(f"/mongo/{db_name}/orders/add_item/", json={"n": 2}, headers=bob.headers).status_code == 403
+    assert client.delete(f"/mongo/delete_database/{db_name}/", headers=bob.headers).status_code == 403
+
+    # L'owner revoca il permesso: il controllo successivo lo nega su tutti i worker
+    set_relations(resources, alice.username, "manager_users", [])
+    assert client.post(f"/mongo/{db_name}/get_items/orders/", headers=bob.headers).status_code == 403
+
+
+def test_admin_access_includes_write(client, resources, make_account, alice_database):
+    alice, db_name = alice_database
+    bob = make_account("bob")
+    set_relations(resources, alice.username, "manager_users", [(bob.username, ["admin_access"])])
+
+    assert client.post(f"/mongo/{db_name}/orders/add_item/", json={"n": 2}, headers=bob.headers).status_code == 200
+    assert client.post(f"/mongo/{db_name}/create_collection/", params={"collection_name": "audit"},
+                       headers=bob.headers).status_code == 200
+
+
+def test_profile_update_refreshes_relations(client, resources, make_account):
+    alice = make_account("alice")
+    bob = make_account("bob")
+    set_relations(resources, alice.username, "managed_users", [(bob.username, ["read_access"])])
+    managed = client.get("/users_collection/me/managed_users/", headers=alice.headers).json()
+    assert managed[0]["full_name"] == ""
+
+    response = client.put("/users_collection/me/", json={"username": bob.username, "email": f"{bob.username}@example.com",
+                                                         "full_name": "Bob"}, headers=bob.headers)
+    assert response.status_code == 200
+    managed = client.get("/users_collection/me/managed_users/", headers=alice.headers).json()
+    assert managed[0]["full_name"] == "Bob"
+
+
+def test_bulk_relation_changes_rebuild_the_index(client, resources, make_account, alice_database):
+    alice, db_name = alice_database
+    bob = make_account("bob")
+    # Scrittura in blocco senza elenco degli utenti: l'indice viene ricostruito alla query successiva
+    entries = [{"username": bob.username, "email": f"{bob.username}@example.com",
+                "permissions": [{"code": "read_access"}]}]
+    assert resources.storage.update_one(USERS_DATABASE, USERS_COLLECTION, {"username": alice.username},
+                                        {"$set": {"manager_users": entries}}) == 1
+    resources.invalidation_bus.publish(RELATIONS_TOPIC, {})
+    assert client.post(f"/mongo/{db_name}/get_items/orders/", headers=bob.headers).status_code == 200
@@ -0,0 +1,129 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from app.hierarchy import HierarchyIndex
+
+
+class FakeUsers:
+    """
+    Documenti utente letti dall'indice, con il conteggio delle letture.
+    """
+
+    def __init__(self, documents: List[Dict[str, Any]]):
+        self.documents = {document["username"]: document for document in documents}
+        self.full_reads = 0
+        self.partial_reads: List[List[str]] = []
+        self.block: Optional[threading.Event] = None
+        self.fail = False
+
+    def __call__(self, usernames: Optional[List[str]]) -> List[Dict[str, Any]]:
+        if usernames is None:
+            self.full_reads += 1
+            if self.block is not None:
+                self.block.wait(5)
+            if self.fail:
+                raise RuntimeError("archivio non raggiungibile")
+            return [dict(document) for document in self.documents.values()]
+        self.partial_reads.append(sorted(usernames))
+        return [dict(self.documents[name]) for name in usernames if name in self.documents]
+
+
+def wait_for_rebuild(index: HierarchyIndex):
+    for _ in range(500):
+        if not index._rebuilding:
+            return
+        time.sleep(0.01)
+    raise AssertionError("ricostruzione non terminata")
+
+
+def user(username: str, managed=(), managers=(), databases=()) -> Dict[str, Any]:
+    return {
+        "username": username,
+        "email": f"{username}@example.com",
+        "managed_users": [{"username": name, "email": f"{name}@example.com",
+                           "permissions": [{"code": code} for code in codes]} for name, codes in managed],
+        "manager_users": [{"username": name, "email": f"{name}@example.com",
+                           "permissions": [{"code": code} for code in codes]} for name, codes in managers],
+        "databases": [{"db_name": db_name} for db_name in databases],
+    }
+
+
+def test_transitive_managed_users_with_permission_filter():
+    users = FakeUsers([
+        user("boss", managed=[("lead", ["read_access", "write_access"])]),
+        user("lead", managed=[("dev", ["read_access"])]),
+        # Relazione dichiarata dal lato del gestito
+        user("dev", managers=[("auditor", ["read_access"])]),
+        user("auditor"),
+    ])
+    index = HierarchyIndex(users, ttl=300)
+
+    managed = index.managed_users("boss", max_depth=10)
+    assert [(entry["username"], entry["depth"], entry["via"]) for entry in managed] == [
+        ("lead", 1, "boss"), ("dev", 2, "lead")]
+    assert [entry["username"] for entry in index.managed_users("boss", 10, ["write_access"])] == ["lead"]
+    assert [entry["username"] for entry in index.managed_users("boss", max_depth=1)] == ["lead"]
+    assert [entry["username"] for entry in index.manager_users("dev", 10)] == ["auditor", "lead", "boss"]
+
+
+def test_dirty_users_are_reread_individually():
+    users = FakeUsers([user("boss", managed=[("lead", [])]), user("lead")])
+    index = HierarchyIndex(users, ttl=300)
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["lead"]
+
+    users.documents["boss"] = user("boss", managed=[("other", [])])
+    users.documents.pop("lead")
+    index.mark_dirty("boss")
+    index.mark_dirty("lead")
+
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["other"]
+    assert users.full_reads == 1
+    assert users.partial_reads == [["boss", "lead"]]
+
+
+def test_expired_index_is_rebuilt_in_background():
+    users = FakeUsers([user("boss", managed=[("lead", [])]), user("lead")])
+    index = HierarchyIndex(users, ttl=0)
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["lead"]
+
+    users.documents["boss"] = user("boss", managed=[("other", [])])
+    users.block = threading.Event()
+    # Durante la ricostruzione le query usano l'indice precedente, senza attendere la lettura
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["lead"]
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["lead"]
+    assert users.full_reads == 2
+
+    users.block.set()
+    wait_for_rebuild(index)
+    users.block = None
+    index.ttl = 300
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["other"]
+
+
+def test_failed_rebuild_keeps_previous_index():
+    users = FakeUsers([user("boss", managed=[("lead", [])], databases=["boss-db"]), user("lead")])
+    index = HierarchyIndex(users, ttl=300)
+    assert index.database_owner("boss-db") == "boss"
+
+    users.fail = True
+    index._loaded_at -= 301
+    assert index.database_owner("boss-db") == "boss"
+    wait_for_rebuild(index)
+    assert index.database_owner("boss-db") == "boss"
+
+
+def test_relations_changed():
+    users = FakeUsers([user("boss", managed=[("lead", [])]), user("lead")])
+    index = HierarchyIndex(users, ttl=300)
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["lead"]
+
+    users.documents["boss"] = user("boss", managed=[("other", [])])
+    index.relations_changed({"usernames": ["boss"]})
+    assert [entry["username"] for entry in index.managed_users("boss", 1)] == ["other"]
+    assert users.full_reads == 1 and users.partial_reads == [["boss"]]
+
+    users.documents["boss"] = user("boss")
+    index.relations_changed({"usernames": None})
+    assert index.managed_users("boss", 1) == []
+    assert users.full_reads == 2
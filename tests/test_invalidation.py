@@ -0,0 +1,151 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from app.cache import TTLCache
+import json
+
+from app.invalidation import RESYNC_TOPIC, USER_TOPIC, InvalidationBus, clear_sockets
+
+
+class WorkerBus(InvalidationBus):
+    # Worker simulato nello stesso processo: il nome sostituisce il PID
+    def __init__(self, socket_dir: str, name: str):
+        super().__init__(socket_dir)
+        self.name = name
+
+    @property
+    def worker_id(self) -> str:
+        return self.name
+
+
+@pytest.fixture
+def buses(tmp_path):
+    started = [WorkerBus(str(tmp_path), name) for name in ("a", "b")]
+    for bus in started:
+        bus.start()
+    yield started
+    for bus in started:
+        bus.stop()
+
+
+def received(bus: InvalidationBus, topic: str):
+    payloads = []
+    event = threading.Event()
+
+    def handler(payload):
+        payloads.append(payload)
+        event.set()
+
+    bus.subscribe(topic, handler)
+    return payloads, event
+
+
+def test_publish_reaches_local_and_other_workers(buses):
+    a, b = buses
+    local, _ = received(a, USER_TOPIC)
+    remote, delivered = received(b, USER_TOPIC)
+
+    assert a.publish(USER_TOPIC, {"username": "ada"}) == []
+    assert local == [{"username": "ada"}]
+    assert delivered.wait(5)
+    assert remote == [{"username": "ada"}]
+
+
+def test_dead_worker_socket_is_removed(buses, tmp_path):
+    a, _ = buses
+    stale = os.path.join(tmp_path, "dead.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.bind(stale)
+
+    assert a.publish(USER_TOPIC, {"username": "ada"}) == ["dead"]
+    assert not os.path.exists(stale)
+    assert a.publish(USER_TOPIC, {"username": "ada"}, workers=["gone"]) == ["gone"]
+
+
+def test_oversized_message_stays_local(buses):
+    a, b = buses
+    local, _ = received(a, USER_TOPIC)
+    remote, delivered = received(b, USER_TOPIC)
+    a.publish(USER_TOPIC, {"username": "x" * (70 * 1024)})
+    assert len(local) == 1
+    assert not delivered.wait(0.3)
+
+
+@pytest.fixture
+def slow_worker(tmp_path):
+    # Worker che non legge il proprio socket finché il test non lo decide
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(os.path.join(tmp_path, "slow.sock"))
+    sock.settimeout(5)
+    yield sock
+    sock.close()
+
+
+def read_messages(sock: socket.socket, count: int):
+    return [json.loads(sock.recv(64 * 1024)) for _ in range(count)]
+
+
+def test_slow_worker_does_not_block_and_loses_nothing(buses, slow_worker):
+    a, _ = buses
+    start = time.perf_counter()
+    for index in range(200):
+        a.publish(USER_TOPIC, {"username": f"user{index}"}, workers=["slow"])
+    # La coda del socket si riempie: i messaggi restano in attesa senza bloccare chi pubblica
+    assert time.perf_counter() - start < 1
+    messages = read_messages(slow_worker, 200)
+    assert [message["payload"]["username"] for message in messages] == [f"user{index}" for index in range(200)]
+
+
+def test_pending_overflow_becomes_resync(tmp_path, slow_worker):
+    bus = WorkerBus(str(tmp_path), "a")
+    bus.max_pending = 5
+    bus.start()
+    try:
+        for index in range(100):
+            bus.publish(USER_TOPIC, {"username": f"user{index}"}, workers=["slow"])
+        messages = []
+        while not messages or messages[-1]["payload"].get("username") != "user99":
+            messages.extend(read_messages(slow_worker, 1))
+    finally:
+        bus.stop()
+    topics = [message["topic"] for message in messages]
+    assert RESYNC_TOPIC in topics and len(messages) < 100
+    assert messages[topics.index(RESYNC_TOPIC)]["payload"] == {"worker": "a"}
+
+
+def test_clear_sockets(tmp_path):
+    bus = WorkerBus(str(tmp_path), "old")
+    bus.start()
+    bus._sock.close()
+    clear_sockets(str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_ttl_cache_expiry_and_lru():
+    cache: TTLCache[int] = TTLCache(ttl=0.05, maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    # "b" è la voce usata meno di recente
+    assert cache.get("b") is None
+    assert cache.pop("a") == 1 and cache.get("a") is None
+    time.sleep(0.06)
+    assert cache.get("c") is None
+
+    disabled: TTLCache[int] = TTLCache(ttl=0, maxsize=10)
+    disabled.set("a", 1)
+    assert disabled.get("a") is None
+
+
+def test_logout_all_invalidates_cached_principal(client, resources, make_account):
+    principal_cache = resources.principal_cache
+    account = make_account()
+    assert client.get("/users_collection/me/", headers=account.headers).status_code == 200
+    assert principal_cache.get(account.username) is not None
+    client.post("/logout_all/", headers=account.headers)
+    assert principal_cache.get(account.username) is None
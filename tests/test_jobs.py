@@ -0,0 +1,198 @@
+import sqlite3
+import time
+
+import pytest
+
+from app.invalidation import InvalidationBus
+from app.jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, IdempotencyConflict, JobFailed, JobQueue, JobStore, TooManyJobs
+from app.settings import JobSettings
+from conftest import wait_for_job
+
+
+@pytest.fixture
+def store(tmp_path):
+    job_store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    yield job_store
+    job_store.close()
+
+
+@pytest.fixture
+def queue(store, tmp_path):
+    # Coda non avviata: i job vengono presi ed eseguiti dal test
+    limits = JobSettings(store_path="unused", max_attempts=2, retry_delay_seconds=0)
+    return JobQueue(store, InvalidationBus(str(tmp_path)), limits)
+
+
+def test_idempotency_key(store):
+    job, created = store.submit("ada", "create_database", {"db_name": "ada-db"}, "key-1", 10)
+    assert created and job.status == QUEUED
+    again, created = store.submit("ada", "create_database", {"db_name": "ada-db"}, "key-1", 10)
+    assert not created and again.id == job.id
+    # La chiave è dell'utente: un altro utente può usarla
+    assert store.submit("bob", "create_database", {"db_name": "bob-db"}, "key-1", 10)[1]
+    with pytest.raises(IdempotencyConflict):
+        store.submit("ada", "create_database", {"db_name": "other"}, "key-1", 10)
+    with pytest.raises(IdempotencyConflict):
+        store.submit("ada", "delete_database", {"db_name": "ada-db"}, "key-1", 10)
+
+
+def test_too_many_pending_jobs(store):
+    for index in range(2):
+        store.submit("ada", "create_database", {"db_name": f"db{index}"}, None, 2)
+    with pytest.raises(TooManyJobs):
+        store.submit("ada", "create_database", {"db_name": "db2"}, None, 2)
+    # I job terminati non contano
+    job = store.claim(1, 60, 3)
+    store.finish(job.id, SUCCEEDED)
+    assert store.submit("ada", "create_database", {"db_name": "db2"}, None, 2)[1]
+
+
+def test_claim_respects_per_user_limit(store):
+    first, _ = store.submit("ada", "create_database", {"db_name": "a1"}, None, 10)
+    store.submit("ada", "create_database", {"db_name": "a2"}, None, 10)
+    other, _ = store.submit("bob", "create_database", {"db_name": "b1"}, None, 10)
+
+    claimed = store.claim(1, 60, 3)
+    assert claimed.id == first.id and claimed.status == RUNNING and claimed.attempts == 1
+    # Il secondo job di "ada" aspetta che il primo termini
+    assert store.claim(1, 60, 3).id == other.id
+    assert store.claim(1, 60, 3) is None
+    store.finish(first.id, SUCCEEDED)
+    assert store.claim(1, 60, 3).params == {"db_name": "a2"}
+
+
+def test_expired_lease_is_claimed_again(store):
+    job, _ = store.submit("ada", "create_database", {"db_name": "a1"}, None, 10)
+    store.claim(1, 0.05, 2)
+    assert store.claim(1, 0.05, 2) is None
+    # Il worker che lo eseguiva si è fermato: il lease scade e il job viene ripreso
+    time.sleep(0.06)
+    resumed = store.claim(1, 0.05, 2)
+    assert resumed.id == job.id and resumed.attempts == 2
+
+    time.sleep(0.06)
+    assert store.claim(1, 0.05, 2) is None
+    interrupted = store.get(job.id)
+    assert interrupted.status == FAILED and interrupted.detail == "Esecuzione interrotta"
+
+
+def test_retry_waits_for_delay(store):
+    job, _ = store.submit("ada", "create_database", {"db_name": "a1"}, None, 10)
+    store.claim(1, 60, 3)
+    store.retry(job.id, "gateway non raggiungibile", 60)
+    assert store.get(job.id).status == QUEUED
+    assert store.claim(1, 60, 3) is None
+
+
+def test_purge_keeps_pending_jobs(store):
+    done, _ = store.submit("ada", "create_database", {"db_name": "a1"}, None, 10)
+    pending, _ = store.submit("ada", "create_database", {"db_name": "a2"}, None, 10)
+    store.claim(1, 60, 3)
+    store.finish(done.id, SUCCEEDED)
+    assert store.purge(0) == 1
+    assert store.get(done.id) is None
+    assert store.get(pending.id) is not None
+
+
+def test_retry_resumes_from_completed_step(queue):
+    seen_steps = []
+
+    def handler(job, progress):
+        seen_steps.append(job.step)
+        if job.step is None:
+            progress("database")
+            raise RuntimeError("gateway non raggiungibile")
+        progress("user")
+        return {"db_name": job.params["db_name"]}
+
+    queue.register("create_database", handler)
+    job, _ = queue.submit("ada", "create_database", {"db_name": "a1"})
+    queue._execute(queue.store.claim(1, 60, 2))
+    retried = queue.get(job.id)
+    assert retried.status == QUEUED and retried.step == "database"
+    assert retried.detail == "gateway non raggiungibile"
+
+    queue._execute(queue.store.claim(1, 60, 2))
+    finished = queue.get(job.id)
+    assert seen_steps == [None, "database"]
+    assert finished.status == SUCCEEDED and finished.step == "user" and finished.attempts == 2
+    assert finished.result == {"db_name": "a1"}
+
+
+def test_failures_after_last_attempt_and_job_failed(queue):
+    def unreachable(job, progress):
+        raise RuntimeError("gateway non raggiungibile")
+
+    def rejected(job, progress):
+        raise JobFailed("Nome del database non valido")
+
+    queue.register("create_database", unreachable)
+    queue.register("delete_database", rejected)
+    with pytest.raises(ValueError):
+        queue.submit("ada", "unknown", {})
+
+    job, _ = queue.submit("ada", "create_database", {"db_name": "a1"})
+    for _ in range(2):
+        queue._execute(queue.store.claim(1, 60, 2))
+    failed = queue.get(job.id)
+    assert failed.status == FAILED and failed.attempts == 2
+
+    # Errore definitivo: nessun altro tentativo
+    job, _ = queue.submit("ada", "delete_database", {"db_name": "a1"})
+    queue._execute(queue.store.claim(1, 60, 2))
+    failed = queue.get(job.id)
+    assert failed.status == FAILED and failed.attempts == 1 and failed.detail == "Nome del database non valido"
+
+
+def test_worker_survives_store_errors(store, tmp_path, monkeypatch):
+    limits = JobSettings(store_path="unused", workers=1, lease_seconds=0.2, poll_seconds=0.02, retry_delay_seconds=0)
+    queue = JobQueue(store, InvalidationBus(str(tmp_path)), limits)
+    queue.register("create_database", lambda job, progress: {"db_name": job.params["db_name"]})
+    original_finish = store.finish
+    failures = []
+
+    def locked_finish(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise sqlite3.OperationalError("database is locked")
+        return original_finish(*args, **kwargs)
+
+    monkeypatch.setattr(store, "finish", locked_finish)
+    job, _ = queue.submit("ada", "create_database", {"db_name": "a1"})
+    queue.start()
+    try:
+        deadline = time.monotonic() + 5
+        while store.get(job.id).status != SUCCEEDED and time.monotonic() < deadline:
+            time.sleep(0.02)
+        # Il thread è sopravvissuto all'errore e ha ripreso il job alla scadenza del lease
+        assert all(thread.is_alive() for thread in queue._threads)
+    finally:
+        queue.stop()
+    finished = store.get(job.id)
+    assert failures and finished.status == SUCCEEDED and finished.attempts == 2
+
+
+def test_job_routes(client, make_account):
+    owner = make_account()
+    other = make_account()
+    headers = {**owner.headers, "Idempotency-Key": "create-1"}
+    response = client.post("/mongo/create_user_database/", json={"db_name": "jobs"}, headers=headers)
+    assert response.status_code == 202
+    job = response.json()
+    assert response.headers["Location"].endswith(f"/mongo/jobs/{job['id']}")
+
+    # Stessa chiave: stesso job; parametri diversi: conflitto
+    again = client.post("/mongo/create_user_database/", json={"db_name": "jobs"}, headers=headers)
+    assert again.status_code == 202 and again.json()["id"] == job["id"]
+    conflict = client.post("/mongo/create_user_database/", json={"db_name": "other"}, headers=headers)
+    assert conflict.status_code == 409
+
+    assert wait_for_job(client, owner, job["id"])["status"] == SUCCEEDED
+    assert client.get(f"/mongo/jobs/{job['id']}", headers=other.headers).status_code == 404
+    assert client.get(f"/mongo/jobs/{job['id']}/events", headers=other.headers).status_code == 404
+
+    # Job già terminato: un solo evento e il flusso si chiude
+    with client.stream("GET", f"/mongo/jobs/{job['id']}/events", headers=owner.headers) as events:
+        body = "".join(events.iter_text())
+    assert body.startswith("event: succeeded\n")
+    assert body.count("event: ") == 1
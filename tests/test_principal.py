@@ -0,0 +1,55 @@
+from typing import Any, List
+
+from app.storage import USERS_COLLECTION
+from app.utils import PRINCIPAL_FIELDS, Principal, get_principal
+
+
+def record_user_reads(storage, monkeypatch) -> List[Any]:
+    reads: List[Any] = []
+    original_find = storage.find
+
+    def recording_find(db, collection, filter_data=None, fields=None):
+        if collection == USERS_COLLECTION:
+            reads.append(fields)
+        return original_find(db, collection, filter_data, fields)
+
+    monkeypatch.setattr(storage, "find", recording_find)
+    return reads
+
+
+def test_principal_is_read_with_projection_and_cached(resources, storage, make_account, make_database, monkeypatch):
+    account = make_account()
+    db_name = make_database(account)
+    resources.principal_cache.pop(account.username)
+    reads = record_user_reads(storage, monkeypatch)
+
+    principal = get_principal(resources, account.username)
+    assert reads == [PRINCIPAL_FIELDS]
+    assert principal.username == account.username
+    assert principal.database(db_name)["db_name"] == db_name
+    assert principal.database("other") is None
+
+    assert get_principal(resources, account.username) is principal
+    assert len(reads) == 1
+
+
+def test_principal_ignores_relations():
+    principal = Principal.from_document({
+        "_id": "u1", "username": "ada", "email": "ada@example.com", "hashed_password": "x",
+        "databases": [{"db_name": "ada-db"}], "managed_users": [{"username": "bob"}]})
+    assert principal.id == "u1"
+    assert not hasattr(principal, "managed_users")
+    assert principal.database("ada-db") == {"db_name": "ada-db"}
+
+
+def test_authenticated_requests_use_projection(client, resources, storage, make_account, monkeypatch):
+    account = make_account()
+    resources.principal_cache.pop(account.username)
+    reads = record_user_reads(storage, monkeypatch)
+
+    assert client.get("/mongo/list_databases/", headers=account.headers).status_code == 200
+    assert reads == [PRINCIPAL_FIELDS]
+    # Il profilo completo viene letto solo dagli endpoint che lo restituiscono
+    profile = client.get("/users_collection/me/", headers=account.headers).json()
+    assert profile["username"] == account.username
+    assert reads[1:] == [None]
@@ -0,0 +1,73 @@
+import os
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app import profiling
+from app.profiling import PROFILE_FILE_HEADER, PROFILE_HEADER, format_server_timing, span
+from app.settings import ProfilingSettings
+from conftest import PASSWORD
+
+
+def test_format_server_timing_sums_repeated_spans():
+    header = format_server_timing([("db", 1.0), ("jwt", 0.5), ("db", 2.25)], 10)
+    assert header == "db;dur=3.25, jwt;dur=0.50, total;dur=10.00"
+
+
+def test_span_outside_request_is_ignored():
+    with span("nothing"):
+        pass
+
+
+def test_login_reports_spans(client, make_account):
+    account = make_account()
+    response = client.post("/login/", data={"username": account.username, "password": PASSWORD})
+    names = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert names[:2] == ["user_lookup", "user_validation"]
+    assert {"password_verify", "token_sign", "token_store", "total"} <= set(names)
+    assert PROFILE_FILE_HEADER not in response.headers
+
+
+def test_profile_written_on_request(tmp_path):
+    app = FastAPI()
+    profiling.register(app, ProfilingSettings(enabled=True, interval_ms=1, output_dir=str(tmp_path), secret="s3cret"))
+
+    @app.get("/slow")
+    def slow():
+        with span("work"):
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+        return {}
+
+    client = TestClient(app)
+    response = client.get("/slow")
+    assert response.headers["Server-Timing"].startswith("work;dur=")
+    assert PROFILE_FILE_HEADER not in response.headers
+
+    # Senza il segreto l'header viene ignorato
+    response = client.get("/slow", headers={PROFILE_HEADER: "1"})
+    assert PROFILE_FILE_HEADER not in response.headers
+
+    response = client.get("/slow", headers={PROFILE_HEADER: "s3cret"})
+    filename = response.headers[PROFILE_FILE_HEADER]
+    assert filename.endswith(".folded") and "-GET-slow-" in filename
+    with open(os.path.join(tmp_path, filename)) as profile_file:
+        lines = profile_file.read().splitlines()
+    assert any("slow (test_profiling.py" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+
+def test_profile_header_ignored_without_secret(tmp_path):
+    app = FastAPI()
+    profiling.register(app, ProfilingSettings(enabled=True, interval_ms=1, output_dir=str(tmp_path)))
+
+    @app.get("/fast")
+    def fast():
+        return {}
+
+    response = TestClient(app).get("/fast", headers={PROFILE_HEADER: "1"})
+    assert response.headers["Server-Timing"].startswith("total;dur=")
+    assert PROFILE_FILE_HEADER not in response.headers
+    assert not os.listdir(tmp_path)
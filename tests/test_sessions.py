@@ -0,0 +1,74 @@
+from conftest import PASSWORD
+
+
+def refresh(client, refresh_token: str):
+    return client.post("/refresh_token/", params={"refresh_token": refresh_token})
+
+
+def test_refresh_issues_access_token_in_same_session(client, make_account):
+    account = make_account()
+    response = refresh(client, account.refresh_token)
+    assert response.status_code == 200
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    assert client.get("/users_collection/me/", headers=headers).status_code == 200
+
+
+def test_logout_revokes_the_refresh_token_of_the_session(client, make_account):
+    account = make_account()
+    other_session = client.post("/login/", data={"username": account.username, "password": PASSWORD}).json()
+    refreshed = refresh(client, account.refresh_token).json()["access_token"]
+
+    assert client.post("/logout/", headers=account.headers).status_code == 200
+
+    assert client.get("/users_collection/me/", headers=account.headers).status_code == 401
+    assert refresh(client, account.refresh_token).status_code == 401
+    # Anche i token di accesso rinnovati nella stessa sessione sono revocati
+    assert client.get("/users_collection/me/", headers={"Authorization": f"Bearer {refreshed}"}).status_code == 401
+    # Le altre sessioni dell'utente restano valide
+    other_headers = {"Authorization": f"Bearer {other_session['access_token']}"}
+    assert client.get("/users_collection/me/", headers=other_headers).status_code == 200
+    assert refresh(client, other_session["refresh_token"]).status_code == 200
+
+
+def test_logout_decodes_the_token_once(client, resources, make_account, monkeypatch):
+    account = make_account()
+    decoded = []
+    original_decode = resources.key_ring.decode
+
+    def counting_decode(token):
+        decoded.append(token)
+        return original_decode(token)
+
+    monkeypatch.setattr(resources.key_ring, "decode", counting_decode)
+    assert client.post("/logout/", headers=account.headers).status_code == 200
+    assert decoded == [account.access_token]
+
+
+def test_logout_all_invalidates_every_session(client, make_account):
+    account = make_account()
+    other_session = client.post("/login/", data={"username": account.username, "password": PASSWORD}).json()
+
+    assert client.post("/logout_all/", headers=account.headers).status_code == 200
+
+    other_headers = {"Authorization": f"Bearer {other_session['access_token']}"}
+    assert client.get("/users_collection/me/", headers=account.headers).status_code == 401
+    assert client.get("/users_collection/me/", headers=other_headers).status_code == 401
+    assert refresh(client, account.refresh_token).status_code == 401
+    assert refresh(client, other_session["refresh_token"]).status_code == 401
+    # Un nuovo login apre una sessione della nuova generazione
+    assert client.post("/login/", data={"username": account.username, "password": PASSWORD}).status_code == 200
+
+
+def test_password_change_invalidates_existing_tokens(client, make_account):
+    account = make_account()
+    response = client.put("/users_collection/me/change_password/", headers=account.headers,
+                          json={"username": account.username, "old_password": PASSWORD, "new_password": "changed456"})
+    assert response.status_code == 200
+    assert client.get("/users_collection/me/", headers=account.headers).status_code == 401
+    assert refresh(client, account.refresh_token).status_code == 401
+    assert client.post("/login/", data={"username": account.username, "password": "changed456"}).status_code == 200
+
+
+def test_access_token_is_not_accepted_as_refresh_token(client, make_account):
+    account = make_account()
+    assert refresh(client, account.access_token).status_code == 401
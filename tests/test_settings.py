@@ -0,0 +1,75 @@
+import json
+
+import pytest
+from pydantic import ValidationError
+
+from app.settings import load_settings
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    # Solo le variabili d'ambiente del test: quelle fissate da conftest sono rimosse
+    for name in ("STORAGE_BACKEND", "TOKEN_STORE_PATH", "JOBS_STORE_PATH", "JOBS_RETRY_DELAY_SECONDS",
+                 "JOBS_POLL_SECONDS", "INVALIDATION_SOCKET_DIR", "JWT_KEYS_DIR", "WARMUP_ENABLED"):
+        monkeypatch.delenv(name, raising=False)
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"mongodb_service_url": "http://gateway", "aggregation": {"max_stages": 5}}))
+    return str(path)
+
+
+def test_load_settings_from_file(config_file):
+    settings = load_settings(config_file)
+    assert settings.mongodb_service_url == "http://gateway"
+    assert settings.aggregation.max_stages == 5
+    assert settings.aggregation.max_results == 1000
+    assert settings.storage_backend == "gateway"
+
+
+def test_environment_overrides(config_file, monkeypatch):
+    monkeypatch.setenv("MONGO_SERVICE_URL", "http://other")
+    monkeypatch.setenv("WARMUP_CONNECTIONS", "0")
+    monkeypatch.setenv("AGGREGATION_MAX_RESULTS", "10")
+    monkeypatch.setenv("PROFILING_ENABLED", "true")
+    settings = load_settings(config_file)
+    assert settings.mongodb_service_url == "http://other"
+    assert settings.warmup_connections == 0
+    # Le variabili di un gruppo si sommano ai valori del file
+    assert settings.aggregation.max_stages == 5
+    assert settings.aggregation.max_results == 10
+    assert settings.profiling.enabled
+
+
+def test_invalid_values_are_rejected(config_file, monkeypatch):
+    monkeypatch.setenv("JOBS_WORKERS", "0")
+    with pytest.raises(ValidationError):
+        load_settings(config_file)
+
+
+def test_create_app_and_warm_up(client, resources, monkeypatch):
+    from app.main import create_app, warm_up
+    from app.settings import get_settings
+
+    app = create_app()
+    assert app.state.settings is get_settings()
+    assert {"/login/", "/mongo/{db_name}/search"} <= set(app.openapi()["paths"])
+    # Le risorse vengono costruite dal ciclo di vita, non da `create_app`
+    assert not hasattr(app.state, "resources")
+
+    settings = get_settings().model_copy(update={"warmup_connections": 3})
+    app = create_app(settings)
+    assert app.state.settings is settings
+    connections = []
+    monkeypatch.setattr(resources, "settings", settings)
+    monkeypatch.setattr(resources.storage, "warm_up", connections.append)
+    warm_up(app, resources)
+    assert connections == [3]
+    # Lo schema OpenAPI è già generato prima della prima richiesta
+    assert app.openapi_schema is not None
+
+
+def test_lifespan_sizes_the_thread_limiter(client, resources):
+    from anyio.to_thread import current_default_thread_limiter
+
+    # Il limite di AnyIO vale per il loop degli eventi dell'app e segue `threadpool_threads`
+    tokens = client.portal.call(lambda: current_default_thread_limiter().total_tokens)
+    assert tokens == resources.settings.threadpool_threads
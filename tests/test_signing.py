@@ -0,0 +1,102 @@
+import json
+import os
+import time
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from jose import JWTError, jwt
+
+from app.signing import KeyRing, generate_key
+
+
+def make_key(keys_dir: str, kid: str, algorithm: str = "RS256", age: float = 0) -> str:
+    path = generate_key(algorithm, keys_dir, kid)
+    # Data di modifica distinta per ogni chiave: la più recente diventa attiva
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_rotation_keeps_previous_tokens_valid(tmp_path):
+    keys_dir = str(tmp_path)
+    make_key(keys_dir, "old", age=60)
+    ring = KeyRing("RS256", "unused", keys_dir, reload_interval=0)
+    old_token = ring.encode({"sub": "ada"})
+    assert jwt.get_unverified_header(old_token)["kid"] == "old"
+
+    make_key(keys_dir, "new")
+    new_token = ring.encode({"sub": "ada"})
+    assert jwt.get_unverified_header(new_token)["kid"] == "new"
+    assert ring.decode(old_token)["sub"] == "ada"
+    assert ring.kids() == ["new", "old"]
+
+    # Chiave ritirata: i token firmati con essa non sono più validi
+    os.remove(os.path.join(keys_dir, "old.pem"))
+    with pytest.raises(JWTError):
+        ring.decode(old_token)
+    assert ring.decode(new_token)["sub"] == "ada"
+
+
+def test_active_kid_and_verify_only_keys(tmp_path):
+    keys_dir = str(tmp_path)
+    make_key(keys_dir, "first", algorithm="ES256", age=60)
+    make_key(keys_dir, "second", algorithm="ES256")
+    ring = KeyRing("ES256", "unused", keys_dir, active_kid="first", reload_interval=0)
+    token = ring.encode({"sub": "ada"})
+    assert jwt.get_unverified_header(token) == {"alg": "ES256", "typ": "JWT", "kid": "first"}
+
+    # Una chiave solo pubblica verifica i token ma non può firmare
+    other_dir = tmp_path / "public"
+    other_dir.mkdir()
+    with open(os.path.join(keys_dir, "first.pem"), "rb") as key_file:
+        private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+    (other_dir / "first.pem").write_bytes(private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo))
+    make_key(str(other_dir), "signer", algorithm="ES256")
+    verifier = KeyRing("ES256", "unused", str(other_dir), reload_interval=0)
+    assert verifier.decode(token)["sub"] == "ada"
+    assert jwt.get_unverified_header(verifier.encode({"sub": "bob"}))["kid"] == "signer"
+
+
+def test_jwks_document_and_etag(tmp_path):
+    keys_dir = str(tmp_path)
+    make_key(keys_dir, "one", age=60)
+    ring = KeyRing("RS256", "unused", keys_dir, reload_interval=0)
+    body, etag = ring.jwks()
+    document = json.loads(body)
+    assert [key["kid"] for key in document["keys"]] == ["one"]
+    assert document["keys"][0]["alg"] == "RS256" and "d" not in document["keys"][0]
+
+    # Un altro servizio verifica il token con la sola chiave pubblica del documento
+    token = ring.encode({"sub": "ada"})
+    assert jwt.decode(token, document["keys"][0], algorithms=["RS256"])["sub"] == "ada"
+
+    make_key(keys_dir, "two")
+    assert ring.jwks()[1] != etag
+
+
+def test_missing_keys_are_rejected(tmp_path):
+    with pytest.raises(RuntimeError):
+        KeyRing("RS256", "unused", str(tmp_path / "missing"))
+    with pytest.raises(RuntimeError):
+        KeyRing("RS256", "unused", str(tmp_path))
+    with pytest.raises(ValueError):
+        KeyRing("none", "unused", str(tmp_path))
+
+
+def test_symmetric_ring_exposes_no_keys():
+    ring = KeyRing("HS256", "secret", "unused")
+    token = ring.encode({"sub": "ada"})
+    assert "kid" not in jwt.get_unverified_header(token)
+    assert ring.decode(token)["sub"] == "ada"
+    assert json.loads(ring.jwks()[0]) == {"keys": []}
+
+
+def test_jwks_endpoint_etag(client):
+    response = client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert "keys" in response.json()
+    assert response.headers["Cache-Control"].startswith("public, max-age=")
+
+    response = client.get("/.well-known/jwks.json", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
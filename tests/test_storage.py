@@ -0,0 +1,285 @@
+"""
+Contratto dell'interfaccia `Storage`, verificato su ogni archivio dei dati: memoria, gateway (il
+gateway finto in un thread) e, con `pymongo` installato e `MONGODB_TEST_URI` impostato, MongoDB.
+Lo stesso per `AsyncStorage`: archivio in memoria in thread e driver asincrono di MongoDB.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+import pytest
+import requests
+
+from app.async_storage import AsyncMongoStorage, ThreadedStorage
+from app.memory_storage import MemoryStorage
+from app.storage import GatewayStorage, MongoStorage, PartialInsert, ResultTooLarge, Storage, StorageError, pymongo
+
+MONGODB_TEST_URI = os.environ.get("MONGODB_TEST_URI")
+
+
+@pytest.fixture(scope="module")
+def gateway_url():
+    from benchmarks.fake_gateway import FakeGateway
+    from benchmarks.harness import ThreadedServer
+
+    server = ThreadedServer(FakeGateway().app).start()
+    yield server.url
+    server.stop()
+
+
+@pytest.fixture(params=["memory", "gateway", "mongodb"])
+def backend(request):
+    if request.param == "memory":
+        storage = MemoryStorage()
+    elif request.param == "gateway":
+        storage = GatewayStorage(request.getfixturevalue("gateway_url"), requests.Session(), atomic_updates=True)
+    else:
+        if pymongo is None or not MONGODB_TEST_URI:
+            pytest.skip("serve il pacchetto pymongo e MONGODB_TEST_URI")
+        storage = MongoStorage(MONGODB_TEST_URI, pool_size=4, timeout_seconds=5)
+    db_name = f"contract-{uuid.uuid4().hex[:8]}"
+    storage.create_database(db_name, {"db_name": db_name})
+    yield storage, db_name
+    storage.delete_database(db_name)
+    storage.close()
+
+
+def aggregate(storage, db_name, collection_name, pipeline, max_bytes=sys.maxsize):
+    return json.loads(storage.aggregate(db_name, collection_name, pipeline, {"maxTimeMS": 5000, "allowDiskUse": False},
+                                        max_bytes))
+
+
+def test_insert_get_update_delete(backend):
+    storage, db_name = backend
+    item_id = storage.insert(db_name, "items", {"name": "a", "n": 1})
+    assert isinstance(item_id, str)
+    assert storage.get(db_name, "items", item_id) == {"_id": item_id, "name": "a", "n": 1}
+
+    assert storage.update(db_name, "items", item_id, {"n": 2})
+    assert storage.get(db_name, "items", item_id)["n"] == 2
+    assert storage.find(db_name, "items", {"name": "a"}, fields=["n"]) == [{"n": 2}]
+
+    assert storage.delete(db_name, "items", item_id)
+    assert storage.get(db_name, "items", item_id) is None
+    assert not storage.delete(db_name, "items", item_id)
+
+
+def test_add_item_returns_id(backend):
+    storage, db_name = backend
+    result = storage.add_item(db_name, "items", {"name": "a"})
+    assert result["message"] == "Item added successfully."
+    assert storage.get(db_name, "items", result["id"])["name"] == "a"
+
+
+def test_update_one_with_version(backend):
+    storage, db_name = backend
+    item_id = storage.insert(db_name, "users", {"username": "ada", "version": 0, "databases": [{"db_name": "x"}]})
+
+    update = {"$push": {"databases": {"$each": [{"db_name": "y"}]}}, "$inc": {"version": 1}}
+    assert storage.update_one(db_name, "users", {"_id": item_id, "version": 0}, update) == 1
+    # Versione letta prima della modifica: nessun documento trovato, nessuna scrittura
+    assert storage.update_one(db_name, "users", {"_id": item_id, "version": 0}, update) == 0
+
+    update = {"$pull": {"databases": {"db_name": "x"}}, "$set": {"full_name": "Ada"}, "$inc": {"version": 1}}
+    assert storage.update_one(db_name, "users", {"_id": item_id, "version": 1}, update) == 1
+    document = storage.get(db_name, "users", item_id)
+    assert document["databases"] == [{"db_name": "y"}]
+    assert document["version"] == 2
+    assert document["full_name"] == "Ada"
+
+
+def test_insert_many_and_delete_many(backend):
+    storage, db_name = backend
+    assert storage.insert_many(db_name, "items", [{"group": n % 3, "n": n} for n in range(9)], concurrency=4) == 9
+    assert len(storage.find(db_name, "items")) == 9
+    assert storage.delete_many(db_name, "items", {"group": 0}) == 3
+    assert sorted(document["n"] for document in storage.find(db_name, "items")) == [1, 2, 4, 5, 7, 8]
+
+
+class FailingStorage(MemoryStorage):
+    # Inserimenti uno alla volta, come con il gateway, con un documento rifiutato
+    insert_many = Storage.insert_many
+
+    def insert(self, db_name, collection_name, document):
+        if document.get("fail"):
+            raise StorageError("documento rifiutato", 400)
+        return super().insert(db_name, collection_name, document)
+
+
+def test_concurrent_insert_many_keeps_only_the_prefix():
+    storage = FailingStorage()
+    documents = [{"n": n, "fail": n == 5} for n in range(12)]
+    with pytest.raises(PartialInsert) as error:
+        storage.insert_many("db", "items", documents, concurrency=4)
+    assert error.value.inserted == 5
+    assert sorted(document["n"] for document in storage.find("db", "items")) == list(range(5))
+
+
+def test_aggregate_and_count(backend):
+    storage, db_name = backend
+    storage.insert_many(db_name, "orders", [{"customer": "a" if n < 4 else "b", "amount": n} for n in range(6)])
+
+    pipeline = [{"$match": {"amount": {"$gte": 1}}}, {"$group": {"_id": "$customer", "total": {"$sum": "$amount"}}},
+                {"$sort": {"_id": 1}}]
+    assert aggregate(storage, db_name, "orders", pipeline) == [{"_id": "a", "total": 6}, {"_id": "b", "total": 9}]
+    assert aggregate(storage, db_name, "orders", [{"$match": {"customer": "a"}}, {"$count": "total"}]) == [{"total": 4}]
+    assert aggregate(storage, db_name, "orders", [{"$match": {"customer": "c"}}, {"$count": "total"}]) == []
+    with pytest.raises(ResultTooLarge):
+        aggregate(storage, db_name, "orders", [{"$match": {}}], max_bytes=10)
+
+
+def test_aggregate_keyset_pages(backend):
+    storage, db_name = backend
+    storage.insert_many(db_name, "items", [{"n": n} for n in range(7)])
+    ids = [document["_id"] for document in aggregate(storage, db_name, "items", [{"$sort": {"_id": 1}}])]
+
+    pages, last_id = [], None
+    while True:
+        pipeline = [{"$sort": {"_id": 1}}, {"$limit": 3}]
+        if last_id is not None:
+            pipeline.insert(0, {"$match": {"_id": {"$gt": last_id}}})
+        page = aggregate(storage, db_name, "items", pipeline)
+        pages.append([document["_id"] for document in page])
+        if len(page) < 3:
+            break
+        last_id = page[-1]["_id"]
+    assert pages == [ids[:3], ids[3:6], ids[6:]]
+
+
+def test_find_page(backend):
+    storage, db_name = backend
+    storage.insert_many(db_name, "items", [{"n": n} for n in range(7)])
+    ids = [document["_id"] for document in aggregate(storage, db_name, "items", [{"$sort": {"_id": 1}}])]
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = storage.find_page(db_name, "items", cursor, 3, {"maxTimeMS": 5000})
+        pages.append([document["_id"] for document in page])
+        if cursor is None:
+            break
+    assert pages == [ids[:3], ids[3:6], ids[6:]]
+
+
+def test_collections_and_search(backend):
+    storage, db_name = backend
+    storage.create_collection(db_name, "first")
+    storage.create_collection(db_name, "second")
+    storage.insert_many(db_name, "first", [{"kind": "x", "n": n} for n in range(3)])
+    storage.insert_many(db_name, "second", [{"kind": "x", "n": n} for n in range(3, 5)] + [{"kind": "y", "n": 9}])
+    assert sorted(storage.list_collections(db_name)) == ["first", "second"]
+
+    found = storage.search(db_name, {"kind": "x"}, 0, 10)
+    assert sorted(document["n"] for document in found) == [0, 1, 2, 3, 4]
+    assert len(storage.search(db_name, {"kind": "x"}, 2, 2)) == 2
+    assert len(storage.search(db_name, {"kind": "x"}, 4, 10)) == 1
+
+    storage.delete_collection(db_name, "first")
+    assert storage.list_collections(db_name) == ["second"]
+
+
+class StubResponse:
+    status_code = 200
+
+    def json(self):
+        return {"message": "Item added successfully.", "id": "abc", "validated_with": "schema.yaml"}
+
+
+class StubSession:
+    def request(self, method, url, **kwargs):
+        return StubResponse()
+
+
+def test_gateway_add_item_returns_gateway_response():
+    # La risposta del gateway arriva al client così com'è, campi aggiuntivi compresi
+    storage = GatewayStorage("http://gateway", StubSession())
+    assert storage.add_item("db", "items", {"name": "a"}) == StubResponse().json()
+    assert storage.insert("db", "items", {"name": "a"}) == "abc"
+
+
+def test_add_item_route_returns_storage_response(client, storage, make_account, make_database):
+    account = make_account()
+    db_name = make_database(account)
+    response = client.post(f"/mongo/{db_name}/items/add_item/", json={"name": "a"}, headers=account.headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert body == {"message": "Item added successfully.", "id": body["id"]}
+    assert storage.get(db_name, "items", body["id"])["name"] == "a"
+
+
+def test_threaded_storage_limits_concurrent_calls():
+    storage = MemoryStorage()
+    storage.insert("db", "items", {"_id": "a", "n": 1})
+    active, peak = [0], [0]
+    original_get = storage.get
+
+    def slow_get(db_name, collection_name, item_id):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        active[0] -= 1
+        return original_get(db_name, collection_name, item_id)
+
+    storage.get = slow_get
+    async_storage = ThreadedStorage(storage, threads=2)
+
+    async def scenario():
+        return await asyncio.gather(*(async_storage.get("db", "items", "a") for _ in range(8)))
+
+    assert [document["n"] for document in asyncio.run(scenario())] == [1] * 8
+    assert peak[0] == 2
+
+
+def test_async_mongo_errors_are_storage_errors():
+    # Server non raggiungibile: l'errore del driver asincrono diventa `StorageError`, senza stato HTTP
+    if pymongo is None:
+        pytest.skip("serve il pacchetto pymongo")
+    async_storage = AsyncMongoStorage("mongodb://127.0.0.1:1", pool_size=1, timeout_seconds=0.2)
+
+    async def scenario():
+        try:
+            await async_storage.get("db", "items", "a")
+        finally:
+            await async_storage.close()
+
+    with pytest.raises(StorageError) as error:
+        asyncio.run(scenario())
+    assert error.value.status_code is None
+
+
+@pytest.fixture(params=["threaded", "mongodb"])
+def async_backend(request):
+    if request.param == "threaded":
+        async_storage = ThreadedStorage(MemoryStorage(), threads=4)
+    else:
+        if pymongo is None or not MONGODB_TEST_URI:
+            pytest.skip("serve il pacchetto pymongo e MONGODB_TEST_URI")
+        async_storage = AsyncMongoStorage(MONGODB_TEST_URI, pool_size=4, timeout_seconds=5)
+    return async_storage, f"contract-{uuid.uuid4().hex[:8]}"
+
+
+def test_async_storage_documents(async_backend):
+    async_storage, db_name = async_backend
+
+    async def scenario():
+        try:
+            item_id = (await async_storage.add_item(db_name, "items", {"name": "a", "n": 1}))["id"]
+            await async_storage.add_item(db_name, "items", {"name": "b", "n": 2})
+            assert await async_storage.get(db_name, "items", item_id) == {"_id": item_id, "name": "a", "n": 1}
+            assert await async_storage.update(db_name, "items", item_id, {"n": 3})
+            assert await async_storage.find(db_name, "items", {"name": "a"}, fields=["n"]) == [{"n": 3}]
+            assert await async_storage.list_collections(db_name) == ["items"]
+            assert len(await async_storage.search(db_name, {}, 1, 10)) == 1
+            pipeline = [{"$group": {"_id": None, "total": {"$sum": "$n"}}}]
+            assert json.loads(await async_storage.aggregate(db_name, "items", pipeline, {}, sys.maxsize))[0]["total"] == 5
+            with pytest.raises(ResultTooLarge):
+                await async_storage.aggregate(db_name, "items", [{"$match": {}}], {}, 10)
+            assert await async_storage.delete(db_name, "items", item_id)
+            assert await async_storage.get(db_name, "items", item_id) is None
+            await async_storage.delete_collection(db_name, "items")
+        finally:
+            await async_storage.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.memory_storage import MemoryStorage
+from app.storage import StorageError
+from app.token_store import (CollectionTokenStore, SQLiteTokenStore, TokenInDB, TokenStoreError,
+                             create_token_store)
+
+
+def token(value: str, username: str = "ada", session_id: str = "s1", minutes: float = 30,
+          token_type: str = "access_token") -> TokenInDB:
+    expires_at = (datetime.utcnow() + timedelta(minutes=minutes)).isoformat()
+    return TokenInDB(username=username, token=value, token_type=token_type, expires_at=expires_at,
+                     session_id=session_id)
+
+
+@pytest.fixture(params=["sqlite", "collection"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        token_store = SQLiteTokenStore(str(tmp_path / "tokens.sqlite3"))
+    else:
+        token_store = CollectionTokenStore(MemoryStorage())
+    yield token_store
+    token_store.close()
+
+
+def test_store_get_revoke(store):
+    issued = token("t1")
+    store.store(issued)
+    assert store.get("t1") == issued
+    assert store.get("unknown") is None
+    store.revoke("t1")
+    assert store.get("t1") is None
+
+
+def test_revoke_session(store):
+    store.store(token("access-1", session_id="s1"))
+    store.store(token("refresh-1", session_id="s1", token_type="refresh_token"))
+    store.store(token("access-2", session_id="s2"))
+    store.store(token("other", username="bob", session_id="s1"))
+
+    store.revoke_session("ada", "s1")
+    assert store.get("access-1") is None
+    assert store.get("refresh-1") is None
+    assert store.get("access-2") is not None
+    assert store.get("other") is not None
+
+
+def test_sqlite_store_is_shared_between_threads_and_instances(tmp_path):
+    path = str(tmp_path / "tokens.sqlite3")
+    first = SQLiteTokenStore(path)
+    threads = [threading.Thread(target=lambda index=index: first.store(token(f"t{index}"))) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Un secondo processo (worker) vede gli stessi token
+    second = SQLiteTokenStore(path)
+    assert all(second.get(f"t{index}") is not None for index in range(8))
+    second.revoke("t0")
+    assert first.get("t0") is None
+    first.close()
+    second.close()
+
+
+def test_sqlite_purges_expired_tokens(tmp_path):
+    store = SQLiteTokenStore(str(tmp_path / "tokens.sqlite3"), purge_interval=0)
+    store.store(token("expired", minutes=-1))
+    store.store(token("valid"))
+    assert store.get("expired") is None
+    assert store.get("valid") is not None
+    store.close()
+
+
+def test_sqlite_migrates_files_without_sessions(tmp_path):
+    path = str(tmp_path / "tokens.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE tokens (token TEXT PRIMARY KEY, username TEXT NOT NULL, token_type TEXT NOT NULL,"
+                       " expires_at TEXT NOT NULL, expires_ts REAL NOT NULL) WITHOUT ROWID")
+    connection.execute("INSERT INTO tokens VALUES ('legacy', 'ada', 'access_token', '2999-01-01T00:00:00', 1e12)")
+    connection.commit()
+    connection.close()
+
+    store = SQLiteTokenStore(path)
+    assert store.get("legacy").session_id is None
+    store.store(token("new", session_id="s1"))
+    store.revoke_session("ada", "s1")
+    assert store.get("new") is None
+    assert store.get("legacy") is not None
+    store.close()
+
+
+def test_collection_store_errors(monkeypatch):
+    storage = MemoryStorage()
+    store = CollectionTokenStore(storage)
+
+    def unavailable(*args, **kwargs):
+        raise StorageError("gateway non raggiungibile")
+
+    monkeypatch.setattr(storage, "find", unavailable)
+    with pytest.raises(TokenStoreError):
+        store.get("t1")
+
+
+def test_create_token_store(tmp_path):
+    assert isinstance(create_token_store("gateway", MemoryStorage(), ""), CollectionTokenStore)
+    sqlite_store = create_token_store("sqlite", MemoryStorage(), str(tmp_path / "tokens.sqlite3"))
+    assert isinstance(sqlite_store, SQLiteTokenStore)
+    sqlite_store.close()
+    with pytest.raises(ValueError):
+        create_token_store("redis", MemoryStorage(), "")
@@ -0,0 +1,201 @@
+import functools
+import gzip
+import json
+from typing import Any, Dict, List
+
+import pytest
+
+from app.aggregation import aggregate_options
+from app.storage import GatewayStorage, Storage, StorageError
+from app.transfer import export_documents
+
+
+@pytest.fixture
+def small_transfers(resources, monkeypatch):
+    settings = resources.settings
+    monkeypatch.setattr(settings.transfer, "export_page_size", 3)
+    monkeypatch.setattr(settings.transfer, "import_batch_size", 4)
+    monkeypatch.setattr(settings.transfer, "import_max_line_bytes", 200)
+
+
+@pytest.fixture
+def account_database(make_account, make_database):
+    account = make_account()
+    return account, make_database(account)
+
+
+def ndjson(documents: List[Dict[str, Any]]) -> bytes:
+    return b"".join(json.dumps(document).encode() + b"\n" for document in documents)
+
+
+def events(response) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_export_uses_keyset_pages(resources, storage, account_database, small_transfers, monkeypatch):
+    _, db_name = account_database
+    storage.insert_many(db_name, "items", [{"n": index} for index in range(10)], 1)
+    ids = sorted(document["_id"] for document in storage.find(db_name, "items"))
+
+    pages: List[List[Dict[str, Any]]] = []
+    original_aggregate = storage.aggregate
+
+    def recording_aggregate(db, collection, pipeline, options, max_bytes):
+        if pipeline[0]["$match"].get("_id", {}).get("$type") == "string":
+            pages.append(pipeline)
+            if len(pages) == 2:
+                # Un documento della prima pagina eliminato durante l'esportazione non sposta le successive
+                storage.delete(db_name, "items", ids[0])
+        return original_aggregate(db, collection, pipeline, options, max_bytes)
+
+    monkeypatch.setattr(storage, "aggregate", recording_aggregate)
+    options = aggregate_options(resources.settings.aggregation)
+    lines = b"".join(export_documents(storage, db_name, "items", 3, options)).splitlines()
+    assert [json.loads(line)["_id"] for line in lines] == ids
+    assert pages[0] == [{"$match": {"_id": {"$type": "string"}}}, {"$sort": {"_id": 1}}, {"$limit": 3}]
+    assert pages[1] == [{"$match": {"_id": {"$type": "string", "$gt": ids[2]}}}, {"$sort": {"_id": 1}}, {"$limit": 3}]
+    assert len(pages) == 4
+    assert not any("$skip" in stage for pipeline in pages for stage in pipeline)
+
+
+class ObjectIdGateway:
+    """
+    Sessione HTTP finta di un gateway su MongoDB: i documenti hanno id `ObjectId`, numerici e stringhe
+    e la pipeline viene valutata con i confronti per tipo di MongoDB; le risposte serializzano gli
+    `ObjectId` come stringhe.
+    """
+
+    timeout = 5
+
+    def __init__(self, ids):
+        self.documents = [{"_id": item_id} for item_id in ids]
+
+    def post(self, url, **kwargs):
+        from bson import ObjectId
+
+        types = {ObjectId: "objectId", int: "number", str: "string"}
+        documents = self.documents
+        for stage in kwargs["json"]["pipeline"]:
+            (name, spec), = stage.items()
+            if name == "$match" and "$not" in spec["_id"]:
+                excluded = spec["_id"]["$not"]["$type"]
+                documents = [document for document in documents if types[type(document["_id"])] not in excluded]
+            elif name == "$match":
+                documents = [document for document in documents if types[type(document["_id"])] == spec["_id"]["$type"]]
+                if "$gt" in spec["_id"]:
+                    documents = [document for document in documents if document["_id"] > spec["_id"]["$gt"]]
+                if "$expr" in spec:
+                    after = ObjectId(spec["$expr"]["$gt"][1]["$toObjectId"])
+                    documents = [document for document in documents if document["_id"] > after]
+            elif name == "$sort":
+                documents = sorted(documents, key=lambda document: document["_id"])
+            elif name == "$limit":
+                documents = documents[:spec]
+        body = json.dumps([{"_id": str(document["_id"]) if isinstance(document["_id"], ObjectId)
+                                   else document["_id"]} for document in documents]).encode()
+        return StreamResponse(body)
+
+
+class StreamResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_content(self, size):
+        yield self.body
+
+
+def test_gateway_export_pages_object_ids():
+    # Gli ObjectId arrivano come stringhe: il cursore deve riconvertirli, non confrontarli con le stringhe
+    bson = pytest.importorskip("bson")
+    object_ids = [bson.ObjectId() for _ in range(7)]
+    gateway = ObjectIdGateway(object_ids + [3, 1, "b", "a"])
+    storage = GatewayStorage("http://gateway", gateway)
+
+    lines = b"".join(export_documents(storage, "db", "items", 3, {"maxTimeMS": 5000})).splitlines()
+    assert [json.loads(line)["_id"] for line in lines] == [1, 3, "a", "b"] + [str(item_id) for item_id in object_ids]
+
+
+def test_export_endpoint_gzip(client, storage, account_database, small_transfers):
+    account, db_name = account_database
+    storage.insert_many(db_name, "items", [{"n": index} for index in range(5)], 1)
+
+    response = client.get(f"/mongo/{db_name}/items/export", params={"gzip": True}, headers=account.headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    documents = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    assert sorted(document["n"] for document in documents) == list(range(5))
+
+
+def test_import_and_resume_after_invalid_line(client, storage, account_database, small_transfers):
+    account, db_name = account_database
+    body = ndjson([{"n": index} for index in range(5)]) + b"{not json\n" + ndjson([{"n": 5}, {"n": 6}])
+    url = f"/mongo/{db_name}/items/import"
+
+    response = client.post(url, content=body, headers=account.headers)
+    assert events(response) == [
+        {"type": "progress", "committed": 4, "inserted": 4},
+        {"type": "error", "line": 6, "detail": events(response)[-1]["detail"], "resume_from": 5},
+    ]
+    assert len(storage.find(db_name, "items")) == 5
+
+    fixed = body.replace(b"{not json", b'{"n": 99}')
+    response = client.post(url, params={"resume_from": 5}, content=gzip.compress(fixed), headers=account.headers)
+    assert events(response)[-1] == {"type": "done", "committed": 8, "inserted": 3}
+    assert sorted(document["n"] for document in storage.find(db_name, "items")) == [0, 1, 2, 3, 4, 5, 6, 99]
+
+
+def test_import_resumes_after_the_inserted_prefix(client, resources, storage, account_database, small_transfers,
+                                                  monkeypatch):
+    account, db_name = account_database
+    url = f"/mongo/{db_name}/items/import"
+    body = ndjson([{"n": index} for index in range(10)])
+    monkeypatch.setattr(resources.settings.transfer, "import_concurrency", 4)
+    original_insert = storage.insert
+
+    def failing_insert(db, collection, document):
+        if document["n"] == 6:
+            raise StorageError("documento rifiutato", 400)
+        return original_insert(db, collection, document)
+
+    # Inserimenti concorrenti del gruppo, come con il gateway
+    monkeypatch.setattr(storage, "insert_many", functools.partial(Storage.insert_many, storage))
+    monkeypatch.setattr(storage, "insert", failing_insert)
+    error = events(client.post(url, content=body, headers=account.headers))[-1]
+    assert error["type"] == "error"
+    assert error["resume_from"] == 6
+    assert sorted(document["n"] for document in storage.find(db_name, "items")) == list(range(6))
+
+    monkeypatch.setattr(storage, "insert", original_insert)
+    response = client.post(url, params={"resume_from": 6}, content=body, headers=account.headers)
+    assert events(response)[-1]["type"] == "done"
+    assert sorted(document["n"] for document in storage.find(db_name, "items")) == list(range(10))
+
+
+def test_import_rejects_long_lines_and_negative_resume(client, storage, account_database, small_transfers):
+    account, db_name = account_database
+    url = f"/mongo/{db_name}/items/import"
+    body = ndjson([{"n": 0}]) + json.dumps({"text": "x" * 300}).encode() + b"\n"
+
+    error = events(client.post(url, content=body, headers=account.headers))[-1]
+    assert error["type"] == "error"
+    assert error["resume_from"] == 1
+    assert len(storage.find(db_name, "items")) == 1
+    assert client.post(url, params={"resume_from": -1}, content=b"", headers=account.headers).status_code == 400
+
+
+def test_import_preserve_ids(client, storage, account_database):
+    account, db_name = account_database
+    url = f"/mongo/{db_name}/items/import"
+    client.post(url, params={"preserve_ids": True}, content=ndjson([{"_id": "kept", "n": 1}]), headers=account.headers)
+    client.post(url, content=ndjson([{"_id": "dropped", "n": 2}]), headers=account.headers)
+    ids = {document["n"]: document["_id"] for document in storage.find(db_name, "items")}
+    assert ids[1] == "kept"
+    assert ids[2] != "dropped"
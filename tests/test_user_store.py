@@ -0,0 +1,154 @@
+import threading
+from typing import Any, Dict, List
+
+import pytest
+
+from app.storage import USERS_COLLECTION, USERS_DATABASE, GatewayStorage, StorageError
+from app.user_store import UserUpdate, update_user
+from conftest import wait_for_job
+
+
+def test_user_update_operators():
+    update = UserUpdate().set("full_name", "Ada").inc("session_generation").push("databases", {"db_name": "a"}) \
+        .pull("databases", {"db_name": "b"})
+    assert update.to_mongo() == {
+        "$inc": {"session_generation": 1, "version": 1},
+        "$set": {"full_name": "Ada"},
+        "$push": {"databases": {"$each": [{"db_name": "a"}]}},
+        "$pull": {"databases": {"db_name": "b"}},
+    }
+    document = {"session_generation": 2, "version": 5, "databases": [{"db_name": "b"}, {"db_name": "c"}]}
+    assert update.apply(document) == {
+        "full_name": "Ada",
+        "session_generation": 3,
+        "databases": [{"db_name": "c"}, {"db_name": "a"}],
+        "version": 6,
+    }
+    assert not UserUpdate()
+
+
+def user_document(storage, username: str) -> Dict[str, Any]:
+    return storage.find(USERS_DATABASE, USERS_COLLECTION, {"username": username})[0]
+
+
+def test_expected_version_rejects_stale_update(storage, make_account):
+    account = make_account()
+    document = user_document(storage, account.username)
+    assert update_user(storage, document["_id"], UserUpdate().set("full_name", "first"), expected_version=document["version"])
+    assert not update_user(storage, document["_id"], UserUpdate().set("full_name", "second"), expected_version=document["version"])
+    assert user_document(storage, account.username)["full_name"] == "first"
+
+
+def test_concurrent_pushes_are_not_lost(storage, make_account):
+    account = make_account()
+    user_id = user_document(storage, account.username)["_id"]
+
+    def push(index: int):
+        assert update_user(storage, user_id, UserUpdate().push("databases", {"db_name": f"db-{index}"}))
+
+    threads = [threading.Thread(target=push, args=(index,)) for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    document = user_document(storage, account.username)
+    assert sorted(database["db_name"] for database in document["databases"]) == sorted(f"db-{i}" for i in range(20))
+    assert document["version"] == 20
+
+
+def test_profile_update_with_if_match(client, storage, make_account):
+    account = make_account()
+    version = user_document(storage, account.username)["version"]
+    body = {"username": account.username, "email": f"{account.username}@example.com", "full_name": "Ada"}
+
+    response = client.put("/users_collection/me/", json=body, headers={**account.headers, "If-Match": str(version)})
+    assert response.status_code == 200
+    response = client.put("/users_collection/me/", json=body, headers={**account.headers, "If-Match": str(version)})
+    assert response.status_code == 412
+
+
+def test_teardown_retries_when_databases_change_concurrently(client, storage, make_account, make_database,
+                                                           monkeypatch):
+    account = make_account()
+    db_name = make_database(account, "removed")
+    user_id = user_document(storage, account.username)["_id"]
+
+    # Un'altra richiesta aggiunge un database subito dopo la lettura dell'utente da parte del job
+    original_find = storage.find
+    original_update_one = storage.update_one
+    raced: List[bool] = []
+    filters: List[Dict[str, Any]] = []
+
+    def racing_find(db: str, collection: str, filter_data=None, fields=None):
+        documents = original_find(db, collection, filter_data, fields)
+        in_job = threading.current_thread().name.startswith("jobs-")
+        if in_job and collection == USERS_COLLECTION and filter_data == {"username": account.username} and not raced:
+            raced.append(True)
+            original_update_one(USERS_DATABASE, USERS_COLLECTION, {"_id": user_id},
+                                {"$push": {"databases": {"db_name": "concurrent"}}, "$inc": {"version": 1}})
+        return documents
+
+    def recording_update_one(db: str, collection: str, filter_data, update):
+        if collection == USERS_COLLECTION:
+            filters.append(filter_data)
+        return original_update_one(db, collection, filter_data, update)
+
+    monkeypatch.setattr(storage, "find", racing_find)
+    monkeypatch.setattr(storage, "update_one", recording_update_one)
+    response = client.delete(f"/mongo/delete_database/{db_name}/", headers=account.headers)
+    assert response.status_code == 202
+    assert wait_for_job(client, account, response.json()["id"])["status"] == "succeeded"
+
+    assert raced
+    # Il primo `$pull` porta la versione letta e fallisce; il secondo usa quella riletta
+    assert [filter_data["version"] for filter_data in filters] == [1, 2]
+    assert [database["db_name"] for database in user_document(storage, account.username)["databases"]] == ["concurrent"]
+
+
+class StubResponse:
+    def __init__(self, status_code: int, body: Any = None):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class StubSession:
+    def __init__(self, responses: Dict[str, StubResponse]):
+        self.responses = responses
+        self.calls: List[str] = []
+
+    def request(self, method: str, url: str, **kwargs):
+        self.calls.append(method)
+        return self.responses[method]
+
+
+def test_gateway_detects_missing_update_one():
+    session = StubSession({"PATCH": StubResponse(404, {"detail": "Not Found"}),
+                           "GET": StubResponse(200, {"_id": "u1", "version": 0}),
+                           "PUT": StubResponse(200, {"message": "Item updated successfully."})})
+    storage = GatewayStorage("http://gateway", session)
+    assert storage.supports_update_operators
+
+    assert update_user(storage, "u1", UserUpdate().set("full_name", "Ada"), expected_version=0)
+    assert update_user(storage, "u1", UserUpdate().set("full_name", "Bea"))
+    assert not storage.supports_update_operators
+    # `update_one` viene provato una sola volta, poi lettura e riscrittura
+    assert session.calls == ["PATCH", "GET", "PUT", "GET", "PUT"]
+
+
+def test_gateway_keeps_update_one_after_success():
+    session = StubSession({"PATCH": StubResponse(200, {"matched_count": 1})})
+    storage = GatewayStorage("http://gateway", session)
+    assert storage.update_one("database", "users_collection", {"_id": "u1"}, {"$set": {"a": 1}}) == 1
+
+    # Dopo la rilevazione un 404 è un errore dell'operazione, non l'assenza della rotta
+    session.responses["PATCH"] = StubResponse(404)
+    with pytest.raises(StorageError):
+        storage.update_one("database", "users_collection", {"_id": "u1"}, {"$set": {"a": 1}})
+    assert storage.supports_update_operators
+
+
+def test_gateway_atomic_updates_disabled():
+    assert not GatewayStorage("http://gateway", StubSession({}), atomic_updates=False).supports_update_operators